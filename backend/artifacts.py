@@ -0,0 +1,145 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def artifact_cache_key(language, image_id, code, command):
+    """言語・イメージID（ダイジェスト）・ソース・コンパイルコマンド（コンパイラとフラグ）からキーを作る"""
+    payload = json.dumps({
+        'language': language,
+        'image': image_id,
+        'code': code,
+        'command': command,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ArtifactCache:
+    """
+    コンパイル済み実行ファイルのキャッシュ。ローカルのディレクトリ（ボリューム）に key[:2]/key のファイルとして置き、
+    合計がmax_bytesを超えたら最近使われていないものから削除する（LRU）。
+    起動時にディレクトリを走査して索引を作り直す（更新時刻を最後に使われた時刻として扱う）。
+    get/putはファイルを読み書きするため、イベントループからはスレッドで呼ぶこと。
+    """
+
+    def __init__(self, directory=None, enabled=True, max_bytes=512 * 1024 * 1024):
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'errors': 0}
+        self.directory = None
+        self.configure(directory, enabled, max_bytes)
+
+    def configure(self, directory=None, enabled=True, max_bytes=512 * 1024 * 1024):
+        with self._lock:
+            self.enabled = enabled and bool(directory)
+            self.max_bytes = max_bytes
+            reload = directory != self.directory
+            self.directory = directory
+        if reload:
+            self.load()
+        with self._lock:
+            self._evict_locked()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self):
+        # ディレクトリの内容から索引を作り直す（作れなければキャッシュを無効にする）
+        entries = []
+        if self.enabled:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                for prefix in os.scandir(self.directory):
+                    if not prefix.is_dir():
+                        continue
+                    for entry in os.scandir(prefix.path):
+                        if entry.is_file() and not entry.name.startswith('.'):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, entry.name, stat.st_size))
+            except OSError as e:
+                logger.warning(f'artifact cache directory {self.directory} unavailable: {e}')
+                self.enabled = False
+        entries.sort()
+        with self._lock:
+            self._entries = collections.OrderedDict((key, size) for _, key, size in entries)
+            self._bytes = sum(size for _, _, size in entries)
+
+    def _evict_locked(self):
+        while self._entries and self._bytes > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._counters['evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _forget_locked(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._bytes -= size
+
+    def get(self, key):
+        """キャッシュ済みの実行ファイル（なければNone）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            known = key in self._entries
+            if not known:
+                self._counters['misses'] += 1
+                return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            # 外部から削除された
+            with self._lock:
+                self._forget_locked(key)
+                self._counters['misses'] += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+        return data
+
+    def put(self, key, data):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+            fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f'artifact cache write error: {e}')
+            with self._lock:
+                self._counters['errors'] += 1
+            return
+        with self._lock:
+            self._forget_locked(key)
+            self._entries[key] = len(data)
+            self._bytes += len(data)
+            self._counters['stores'] += 1
+            self._evict_locked()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['enabled'] = self.enabled
+        stats['max_bytes'] = self.max_bytes
+        stats['directory'] = self.directory
+        return stats
@@ -0,0 +1,287 @@
+"""
+ベンチマーク用のDockerクライアント代替（Dockerデーモン不要）。
+
+- runner='simulated': スレッド上の疑似runnerがrunnerプロトコルで応答する。
+  コード中に "# fake: sleep=0.1 stdout_bytes=100000 stderr_bytes=0 exit=0" のように書くと
+  実行時間・出力量・終了コードを調整できる（指定がなければ標準入力をそのまま標準出力へ返す）。
+  handlerを渡すと、ジョブごとのフレーム列をhandler(job)で作る（ジョブの "nonce" と連番 "seq" は
+  実際のrunnerと同じく付け足す。フレームに "nonce" / "seq" を含めるとその値のまま送る）。
+- runner='subprocess': 実際の runner/run.py / run.js をサブプロセスとして動かす。
+- rtt: Docker API呼び出し1回あたりの疑似往復遅延（秒）。
+- ncpu / mem_total: info()で返すホストのCPU数・メモリ量（複数ホストへの振り分けの確認用）。
+"""
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+RUNNER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'runner')
+RUNNER_COMMANDS = {
+    'python': [sys.executable, os.path.join(RUNNER_DIR, 'run.py')],
+    'node': ['node', os.path.join(RUNNER_DIR, 'run.js')],
+    # runner-gcc（c / cpp）
+    'gcc': [sys.executable, os.path.join(RUNNER_DIR, 'run_native.py')],
+}
+FRAME_HEADER = struct.Struct('>BxxxL')
+CHUNK_CHARS = 4096
+
+
+def parse_directives(code):
+    directives = {}
+    for line in code.splitlines():
+        line = line.strip()
+        if line.startswith('# fake:') or line.startswith('// fake:'):
+            for item in line.split(':', 1)[1].split():
+                key, _, value = item.partition('=')
+                directives[key] = value
+    return directives
+
+
+def simulated_frames(job):
+    """疑似runnerが1ジョブに対して返すフレーム列"""
+    directives = parse_directives(job.get('code', ''))
+    sleep = float(directives.get('sleep', 0))
+    if sleep:
+        time.sleep(sleep)
+    if 'stdout_bytes' in directives:
+        stdout = 'x' * int(directives['stdout_bytes'])
+    else:
+        stdout = job.get('stdin') or ''
+    stderr = 'e' * int(directives.get('stderr_bytes', 0))
+    for stream, data in (('stdout', stdout), ('stderr', stderr)):
+        for i in range(0, len(data), CHUNK_CHARS):
+            yield {'type': stream, 'data': data[i:i + CHUNK_CHARS]}
+    yield {'type': 'result', 'exit_code': int(directives.get('exit', 0)), 'time': sleep}
+
+
+class FakeContainer:
+    def __init__(self, container_id, image, language, labels, command):
+        self.id = container_id
+        self.image = image
+        self.language = language
+        self.labels = labels or {}
+        self.command = command
+        self.status = 'created'
+        self.created = time.time()
+        self.sock = None
+        self.proc = None
+
+    @property
+    def attrs(self):
+        return {'Id': self.id, 'Created': self.created, 'State': {'Status': self.status},
+                'Config': {'Labels': self.labels, 'Image': self.image}}
+
+
+class FakeImage:
+    def __init__(self, name, env=None):
+        self.id = 'sha256:' + uuid.uuid5(uuid.NAMESPACE_URL, name).hex
+        self.attrs = {'Id': self.id, 'Config': {'Env': env or ['CONTAINER_MAX_MEM=512m', 'CONTAINER_MAX_CPU=1.0']}}
+
+
+class FakeImages:
+    def __init__(self, client):
+        self.client = client
+        self.images = {}
+
+    def get(self, name):
+        self.client._round_trip()
+        if name not in self.images:
+            self.images[name] = FakeImage(name)
+        return self.images[name]
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, container_id):
+        self.client._round_trip()
+        return self.client.api._containers[container_id]
+
+    def list(self, all=False, filters=None):
+        self.client._round_trip()
+        containers = list(self.client.api._containers.values())
+        if not all:
+            containers = [c for c in containers if c.status == 'running']
+        for label in (filters or {}).get('label', []):
+            key, _, value = label.partition('=')
+            containers = [c for c in containers
+                          if key in c.labels and (not value or c.labels[key] == value)]
+        return containers
+
+
+class FakeAPI:
+    def __init__(self, client):
+        self.client = client
+        self._containers = {}
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        self.client._round_trip()
+
+    def create_host_config(self, **kwargs):
+        # 実際のdocker SDKでもローカルで辞書を作るだけ（API呼び出しなし）
+        return dict(kwargs)
+
+    def create_container(self, image, command=None, entrypoint=None, host_config=None,
+                         stdin_open=False, detach=False, labels=None, **kwargs):
+        self._call('create_container')
+        if self.client.fail_create:
+            raise RuntimeError('fake create_container failure')
+        language = image.split(':')[0].rsplit('-', 1)[-1]
+        container = FakeContainer(uuid.uuid4().hex, image, language, labels, command)
+        with self._lock:
+            self._containers[container.id] = container
+        return {'Id': container.id}
+
+    def attach_socket(self, container_id, params=None):
+        self._call('attach_socket')
+        ours, theirs = socket.socketpair()
+        self._containers[container_id].sock = theirs
+        return ours
+
+    def start(self, container_id):
+        self._call('start')
+        container = self._containers[container_id]
+        container.status = 'running'
+        if self.client.runner == 'subprocess':
+            self._start_subprocess(container)
+        else:
+            threading.Thread(target=self._serve_simulated, args=(container,), daemon=True).start()
+
+    def _send_frames(self, sock, job):
+        for seq, frame in enumerate(self.client.handler(job)):
+            data = json.dumps({'nonce': job.get('nonce'), 'seq': seq, **frame}).encode('utf-8') + b'\n'
+            sock.sendall(FRAME_HEADER.pack(1, len(data)) + data)
+
+    def _serve_simulated(self, container):
+        sock = container.sock
+        try:
+            with sock.makefile('rb') as reader:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    self._send_frames(sock, json.loads(line))
+        except OSError:
+            pass
+        finally:
+            container.status = 'exited'
+
+    def _start_subprocess(self, container):
+        sock = container.sock
+        command = container.command or []
+        if isinstance(command, str):
+            command = command.split()
+        proc = subprocess.Popen(RUNNER_COMMANDS[container.language] + list(command), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        container.proc = proc
+
+        def pump_in():
+            try:
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except OSError:
+                pass
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        def pump_out():
+            while True:
+                data = proc.stdout.read1(65536)
+                if not data:
+                    break
+                try:
+                    sock.sendall(FRAME_HEADER.pack(1, len(data)) + data)
+                except OSError:
+                    break
+            container.status = 'exited'
+
+        threading.Thread(target=pump_in, daemon=True).start()
+        threading.Thread(target=pump_out, daemon=True).start()
+
+    def containers(self, all=False, filters=None):
+        # 低レベルAPIの一覧（ラベル・状態で絞り込んだ辞書のリスト）
+        self._call('containers')
+        with self._lock:
+            containers = list(self._containers.values())
+        filters = filters or {}
+        if not all:
+            containers = [c for c in containers if c.status == 'running']
+        labels = filters.get('label', [])
+        for label in [labels] if isinstance(labels, str) else labels:
+            key, _, value = label.partition('=')
+            containers = [c for c in containers
+                          if key in c.labels and (not value or c.labels[key] == value)]
+        statuses = filters.get('status', [])
+        if statuses:
+            statuses = [statuses] if isinstance(statuses, str) else statuses
+            containers = [c for c in containers if c.status in statuses]
+        return [{'Id': c.id, 'Created': int(c.created), 'State': c.status, 'Labels': dict(c.labels)}
+                for c in containers]
+
+    def kill(self, container_id):
+        self._call('kill')
+        container = self._containers.get(container_id)
+        if container is not None:
+            self._stop(container)
+
+    def _stop(self, container):
+        container.status = 'exited'
+        if container.proc is not None:
+            container.proc.kill()
+        if container.sock is not None:
+            try:
+                # 実際のDockerと同じく、削除したコンテナのattachストリームは閉じる（読み込み中の側にEOFを返す）
+                container.sock.shutdown(socket.SHUT_RDWR)
+                container.sock.close()
+            except OSError:
+                pass
+
+    def remove_container(self, container_id, force=False):
+        self._call('remove_container')
+        with self._lock:
+            container = self._containers.pop(container_id, None)
+        if container is not None:
+            self._stop(container)
+
+
+class FakeDockerClient:
+    """docker.DockerClientのうちバックエンドが使う部分だけを真似る"""
+
+    def __init__(self, runner='simulated', rtt=0.0, handler=None, connect_rtt=None, ncpu=4, mem_total=8 << 30):
+        self.runner = runner
+        self.rtt = rtt
+        self.ncpu = ncpu
+        self.mem_total = mem_total
+        self.handler = handler or simulated_frames
+        self.fail_create = False
+        self.api = FakeAPI(self)
+        self.images = FakeImages(self)
+        self.containers = FakeContainers(self)
+        # docker.from_env()はAPIバージョン確認のため接続時に1往復する
+        time.sleep(rtt if connect_rtt is None else connect_rtt)
+
+    def _round_trip(self):
+        if self.rtt:
+            time.sleep(self.rtt)
+
+    def info(self):
+        self._round_trip()
+        return {'NCPU': self.ncpu, 'MemTotal': self.mem_total}
+
+    def close(self):
+        pass
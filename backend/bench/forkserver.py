@@ -0,0 +1,116 @@
+"""
+Pythonランナーの1ジョブあたりのレイテンシを実行方式ごとに比較するベンチマーク（Docker不要）。
+
+- cold:        ジョブごとに run.py を起動する（インタプリタ起動・import込み）
+- in_process:  常駐した run.py --serve がジョブごとにforkする（モジュールの事前importなし）
+- fork_server: 常駐した run.py --serve --fork-server が事前importした親からジョブごとにforkする
+
+    python bench/forkserver.py --iterations 50 --json forkserver.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'runner', 'run.py')
+
+PROGRAMS = {
+    'trivial': 'print(1)',
+    'import_heavy': (
+        'import json, re, decimal, fractions, datetime, statistics, random, collections, '
+        'itertools, functools, heapq, bisect, dataclasses, typing\n'
+        'print(statistics.mean([decimal.Decimal(1), decimal.Decimal(2)]))'
+    ),
+}
+
+
+def read_result(stream):
+    # 結果フレームが来るまで読み捨てる
+    while True:
+        line = stream.readline()
+        if not line:
+            raise RuntimeError('runner exited without result')
+        frame = json.loads(line)
+        if frame.get('type') == 'result':
+            return frame
+
+
+def run_cold(code):
+    proc = subprocess.Popen([sys.executable, RUNNER], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    proc.stdin.write(json.dumps({'code': code}) + '\n')
+    proc.stdin.close()
+    result = read_result(proc.stdout)
+    proc.wait()
+    return result
+
+
+class ServingRunner:
+    def __init__(self, *args):
+        self.proc = subprocess.Popen([sys.executable, RUNNER, '--serve', *args], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    def run(self, code):
+        self.proc.stdin.write(json.dumps({'code': code, 'limits': {'cpu': 10, 'nofile': 64}}) + '\n')
+        self.proc.stdin.flush()
+        return read_result(self.proc.stdout)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def measure(fn, code, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn(code)
+        samples.append(time.perf_counter() - start)
+        if result['exit_code'] != 0:
+            raise RuntimeError(f'job failed: {result}')
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'mean_ms': statistics.fmean(samples) * 1e3,
+        'p50_ms': samples[len(samples) // 2] * 1e3,
+        'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    in_process = ServingRunner()
+    fork_server = ServingRunner('--fork-server')
+    results = {}
+    try:
+        for name, code in PROGRAMS.items():
+            # 初回のimportを計測から外す
+            in_process.run(code)
+            fork_server.run(code)
+            results[name] = {
+                'cold': measure(run_cold, code, args.iterations),
+                'in_process': measure(in_process.run, code, args.iterations),
+                'fork_server': measure(fork_server.run, code, args.iterations),
+            }
+    finally:
+        in_process.close()
+        fork_server.close()
+
+    for name, modes in results.items():
+        print(name)
+        for mode, r in modes.items():
+            print(f"  {mode:>11}: mean {r['mean_ms']:8.2f} ms  p50 {r['p50_ms']:8.2f} ms  p99 {r['p99_ms']:8.2f} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
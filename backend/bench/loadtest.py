@@ -0,0 +1,277 @@
+"""
+/run のエンドツーエンド負荷試験。フェーズ（プログラムの種類）ごとに指定した並列度でリクエストを投げ、
+レイテンシ（p50/p95/p99）・スループット・exit_codeの内訳をJSONで書き出す。
+
+- 組み込みモード（既定）: FastAPIアプリをプロセス内で動かし、DockerはFakeDockerClient、DBはSQLiteを使う
+  （Dockerデーモン・Postgres不要。CIや実行ごとの比較用）
+    --runner simulated   疑似runner（コード中の "# fake:" 指定で実行時間・出力量を決める）
+    --runner subprocess  実際の runner/run.py / run.js をサブプロセスで動かす
+- 実環境モード: --url で起動済みのバックエンド（docker compose等）に投げる
+
+    python bench/loadtest.py --json loadtest.json
+    python bench/loadtest.py --runner subprocess --scale 0.5 --baseline loadtest.json
+    python bench/loadtest.py --url http://localhost:8000 --phases trivial,cpu_bound
+
+組み込みモードでは、burst以外のフェーズはレート制限・同時実行数制限にかからないよう制限を緩めて投げる。
+burstフェーズは設定どおりの制限で1つのクライアントから一斉に投げ、レート制限（2001）・同時実行数制限（2007）の挙動を見る。
+実環境モードではすべてのフェーズが1つのクライアント（接続元IP、--api-keyを指定すればそのキー）として数えられるので、
+burst以外のフェーズを測る場合は制限を緩めたバックエンドに投げる。
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STDIN_HEAVY_INPUT = '\n'.join(' '.join(str(i * 10 + j) for j in range(10)) for i in range(20000)) + '\n'
+
+# name, language, requests, concurrency, code, stdin, shared_client
+PHASES = [
+    {
+        'name': 'trivial',
+        'language': 'python',
+        'requests': 400,
+        'concurrency': 16,
+        'code': '# fake: sleep=0.001 stdout_bytes=2\nprint(1)\n',
+    },
+    {
+        'name': 'node_trivial',
+        'language': 'node',
+        'requests': 200,
+        'concurrency': 8,
+        'code': '// fake: sleep=0.001 stdout_bytes=2\nconsole.log(1);\n',
+    },
+    {
+        'name': 'cpu_bound',
+        'language': 'python',
+        'requests': 80,
+        'concurrency': 8,
+        'code': (
+            '# fake: sleep=0.2 stdout_bytes=16\n'
+            'total = 0\n'
+            'for i in range(3000000):\n'
+            '    total += i * i\n'
+            'print(total)\n'
+        ),
+    },
+    {
+        'name': 'large_output',
+        'language': 'python',
+        'requests': 80,
+        'concurrency': 8,
+        'code': "# fake: stdout_bytes=500000\nimport sys\nsys.stdout.write('x' * 500000)\n",
+    },
+    {
+        'name': 'stdin_heavy',
+        'language': 'python',
+        'requests': 80,
+        'concurrency': 8,
+        'code': '# fake: stdout_bytes=7\nimport sys\nprint(sum(map(int, sys.stdin.read().split())))\n',
+        'stdin': STDIN_HEAVY_INPUT,
+    },
+    {
+        'name': 'burst',
+        'language': 'python',
+        'requests': 100,
+        'concurrency': 16,
+        'code': '# fake: sleep=0.05 stdout_bytes=2\nprint(1)\n',
+        'shared_client': True,
+    },
+]
+
+
+def percentile(sorted_samples, q):
+    # 最近傍順位法
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, max(0, int(round(q / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def summarize(phase, concurrency, latencies, exit_codes, http_status, errors, elapsed):
+    samples = sorted(latencies)
+    return {
+        'language': phase['language'],
+        'requests': phase['requests'],
+        'concurrency': concurrency,
+        'duration_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'mean': statistics.fmean(samples) * 1e3 if samples else None,
+            'p50': percentile(samples, 50) * 1e3 if samples else None,
+            'p95': percentile(samples, 95) * 1e3 if samples else None,
+            'p99': percentile(samples, 99) * 1e3 if samples else None,
+            'max': samples[-1] * 1e3 if samples else None,
+        },
+        'exit_codes': {str(code): count for code, count in sorted(exit_codes.items())},
+        'http_status': {str(status): count for status, count in sorted(http_status.items())},
+        'errors': dict(errors),
+    }
+
+
+async def run_phase(client, phase, concurrency, headers):
+    payload = {'language': phase['language'], 'code': phase['code'], 'stdin': phase.get('stdin', '')}
+    latencies = []
+    exit_codes = collections.Counter()
+    http_status = collections.Counter()
+    errors = collections.Counter()
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < phase['requests']:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                response = await client.post('/run', json=payload, headers=headers)
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            http_status[response.status_code] += 1
+            if response.status_code == 200:
+                exit_codes[response.json().get('exit_code')] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(phase, concurrency, latencies, exit_codes, http_status, errors, time.perf_counter() - started)
+
+
+async def run_phases(client, phases, args, prepare=None):
+    headers = {'X-API-Key': args.api_key} if args.api_key else {}
+    results = {}
+    for phase in phases:
+        concurrency = args.concurrency or phase['concurrency']
+        if prepare is not None:
+            prepare(phase)
+        results[phase['name']] = await run_phase(client, phase, concurrency, headers)
+        print_phase(phase['name'], results[phase['name']])
+    return results
+
+
+def load_inprocess_app(runner, rtt, hosts):
+    # main.pyのimport前にDB接続先を差し替える（db.pyがDATABASE_URLを見る）
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    sys.path.insert(0, BACKEND_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    from fake_docker import FakeDockerClient
+    main.runtime.client_factory = lambda: FakeDockerClient(runner=runner, rtt=rtt)
+    if hosts > 1:
+        # 2台目以降は疑似的な別のDockerエンドポイントとして登録する
+        main.host_registry.client_factory = lambda name: FakeDockerClient(runner=runner, rtt=rtt)
+        main.host_registry.configure({**main.config, 'runner_hosts': [{'name': 'local'}] + [
+            {'name': f'fake{i}', 'base_url': f'tcp://fake{i}:2375'} for i in range(1, hosts)]})
+    return main
+
+
+def phase_limits(main):
+    # burstフェーズは設定どおりの制限、それ以外は制限にかからないよう緩める（接続元はすべて同じ）
+    def prepare(phase):
+        if phase.get('shared_client'):
+            main.rate_limiter.configure(**main.rate_limit_settings())
+        else:
+            main.rate_limiter.configure(rate_per_minute=10 ** 9, burst=10 ** 9, max_concurrent=10 ** 6)
+    return prepare
+
+
+async def run_inprocess(phases, args):
+    main = load_inprocess_app(args.runner, args.rtt, args.hosts)
+    app = main.app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=args.timeout) as client:
+            return await run_phases(client, phases, args, prepare=phase_limits(main))
+
+
+async def run_remote(phases, args):
+    limits = httpx.Limits(max_connections=max(args.concurrency or 0, *(p['concurrency'] for p in phases)))
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        return await run_phases(client, phases, args)
+
+
+def print_phase(name, result):
+    latency = result['latency_ms']
+    if latency['p50'] is None:
+        print(f'{name:>13}: no responses {result["errors"]}')
+        return
+    print(f"{name:>13}: {result['throughput_rps']:8.1f} req/s  p50 {latency['p50']:8.2f} ms  "
+          f"p95 {latency['p95']:8.2f} ms  p99 {latency['p99']:8.2f} ms  exit_codes {result['exit_codes']}")
+
+
+def print_comparison(results, baseline):
+    # 前回の結果と比べた変化率（レイテンシは増加、スループットは減少が悪化）
+    print('vs baseline')
+    for name, result in results.items():
+        old = baseline.get('phases', {}).get(name)
+        if not old or result['latency_ms']['p50'] is None or old['latency_ms']['p50'] is None:
+            continue
+        changes = []
+        for key in ('p50', 'p95', 'p99'):
+            changes.append(f"{key} {(result['latency_ms'][key] / old['latency_ms'][key] - 1) * 100:+6.1f}%")
+        if old['throughput_rps']:
+            changes.append(f"rps {(result['throughput_rps'] / old['throughput_rps'] - 1) * 100:+6.1f}%")
+        print(f'{name:>13}: ' + '  '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='実環境モード: 起動済みバックエンドのURL（未指定なら組み込みモード）')
+    parser.add_argument('--runner', choices=['simulated', 'subprocess'], default='simulated',
+                        help='組み込みモードの疑似Dockerが動かすrunner')
+    parser.add_argument('--rtt', type=float, default=0.0, help='疑似Docker APIの往復遅延（秒）')
+    parser.add_argument('--hosts', type=int, default=1, help='組み込みモードで振り分ける疑似Dockerエンドポイントの数')
+    parser.add_argument('--phases', help='実行するフェーズ（カンマ区切り、既定はすべて）')
+    parser.add_argument('--scale', type=float, default=1.0, help='各フェーズのリクエスト数に掛ける倍率')
+    parser.add_argument('--concurrency', type=int, help='全フェーズの並列度を上書きする')
+    parser.add_argument('--api-key', help='X-API-Keyヘッダで送るキー（バックエンドのrate_limit.api_keysに登録したもの）')
+    parser.add_argument('--timeout', type=float, default=60.0, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--baseline', help='比較する前回の結果JSON')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    selected = set(args.phases.split(',')) if args.phases else None
+    phases = []
+    for phase in PHASES:
+        if selected is None or phase['name'] in selected:
+            phases.append({**phase, 'requests': max(1, int(phase['requests'] * args.scale))})
+    if not phases:
+        parser.error(f'unknown phases: {args.phases}')
+
+    if args.url:
+        results = asyncio.run(run_remote(phases, args))
+    else:
+        results = asyncio.run(run_inprocess(phases, args))
+
+    report = {
+        'meta': {
+            'mode': 'remote' if args.url else 'inprocess',
+            'url': args.url,
+            'runner': None if args.url else args.runner,
+            'rtt': args.rtt,
+            'hosts': None if args.url else args.hosts,
+            'scale': args.scale,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+        },
+        'phases': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(results, json.load(f))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Nodeランナー（run.js）の1コンテナあたりのスループットを計測するベンチマーク（Docker不要、nodeコマンドが必要）。
+
+- cold:       ジョブごとに node run.js を起動する（常駐前の方式に相当）
+- repeated:   常駐したrun.jsに同じコードを繰り返し投入する（コンパイル済みスクリプトのキャッシュが効く）
+- unique:     常駐したrun.jsに毎回異なるコードを投入する（毎回コンパイル）
+- stdin:      標準入力を読んで集計するプログラム
+- batch:      1つのバッチジョブで複数ケースを並列に実行する（1ケースを1ジョブとして数える）
+
+    python bench/node_runner.py --iterations 200 --json node_runner.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import time
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'runner', 'run.js')
+
+LIMITS = {'wall': 10, 'stdout': 1048576, 'stderr': 1048576, 'heap_mb': 256}
+
+TRIVIAL = 'console.log(1)'
+STDIN_PROGRAM = (
+    "const lines = require('fs').readFileSync(0, 'utf8').trim().split('\\n');\n"
+    "console.log(lines.map(Number).reduce((a, b) => a + b, 0));"
+)
+STDIN_DATA = '\n'.join(str(i) for i in range(1000)) + '\n'
+
+
+def read_result(stream, frames=None):
+    # 結果フレームが来るまで読む（case_resultはframesに集める）
+    while True:
+        line = stream.readline()
+        if not line:
+            raise RuntimeError('runner exited without result')
+        frame = json.loads(line)
+        if frame.get('type') == 'case_result' and frames is not None:
+            frames.append(frame)
+        if frame.get('type') == 'result':
+            return frame
+
+
+def run_cold(job):
+    proc = subprocess.Popen(['node', RUNNER], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    proc.stdin.write(json.dumps(job) + '\n')
+    proc.stdin.close()
+    result = read_result(proc.stdout)
+    proc.wait()
+    return result
+
+
+class ServingRunner:
+    def __init__(self):
+        self.proc = subprocess.Popen(['node', RUNNER, '--serve'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    def run(self, job, frames=None):
+        self.proc.stdin.write(json.dumps(job) + '\n')
+        self.proc.stdin.flush()
+        return read_result(self.proc.stdout, frames)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def measure(fn, make_job, iterations):
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        job = make_job(i)
+        start = time.perf_counter()
+        result = fn(job)
+        samples.append(time.perf_counter() - start)
+        if result['exit_code'] != 0:
+            raise RuntimeError(f'job failed: {result}')
+    elapsed = time.perf_counter() - started
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'jobs_per_sec': iterations / elapsed,
+        'mean_ms': statistics.fmean(samples) * 1e3,
+        'p50_ms': samples[len(samples) // 2] * 1e3,
+        'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e3,
+    }
+
+
+def measure_batch(runner, cases, parallel, rounds):
+    job = {
+        'code': STDIN_PROGRAM,
+        'cases': [{'stdin': STDIN_DATA} for _ in range(cases)],
+        'parallel': parallel,
+        'limits': LIMITS,
+    }
+    started = time.perf_counter()
+    for _ in range(rounds):
+        frames = []
+        runner.run(job, frames)
+        failed = [f for f in frames if f['exit_code'] != 0]
+        if failed or len(frames) != cases:
+            raise RuntimeError(f'batch failed: {failed[:1]}')
+    elapsed = time.perf_counter() - started
+    return {'cases': cases, 'parallel': parallel, 'rounds': rounds, 'jobs_per_sec': cases * rounds / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--cold-iterations', type=int, default=20)
+    parser.add_argument('--batch-cases', type=int, default=50)
+    parser.add_argument('--parallel', type=int, default=2)
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    runner = ServingRunner()
+    results = {}
+    try:
+        # エンジン（worker_thread）の起動を計測から外す
+        runner.run({'code': TRIVIAL, 'limits': LIMITS})
+        results['cold'] = measure(run_cold, lambda i: {'code': TRIVIAL, 'limits': LIMITS}, args.cold_iterations)
+        results['repeated'] = measure(runner.run, lambda i: {'code': TRIVIAL, 'limits': LIMITS}, args.iterations)
+        results['unique'] = measure(runner.run, lambda i: {'code': f'console.log({i})', 'limits': LIMITS},
+                                    args.iterations)
+        results['stdin'] = measure(runner.run, lambda i: {'code': STDIN_PROGRAM, 'stdin': STDIN_DATA, 'limits': LIMITS},
+                                   args.iterations)
+        results['batch'] = measure_batch(runner, args.batch_cases, args.parallel, 5)
+    finally:
+        runner.close()
+
+    for mode, r in results.items():
+        line = f"{mode:>8}: {r['jobs_per_sec']:8.1f} jobs/s"
+        if 'p50_ms' in r:
+            line += f"  mean {r['mean_ms']:7.2f} ms  p50 {r['p50_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms"
+        print(line)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+大きな出力を返すジョブを同時に多数実行したときの、バックエンドのメモリ使用量と応答サイズを計測するベンチマーク。
+
+FastAPIアプリをプロセス内で動かし（DockerはFakeDockerClient、DBはSQLite）、疑似runnerが
+--stdout-bytes バイトの出力（数値を並べた行。'x'の繰り返しのように極端には圧縮できないもの）を返す /run を
+--concurrency 並列で --requests 回投げる。シナリオごとに、実行中のPythonのメモリ確保のピーク（tracemalloc）、
+終了後もジョブ一覧（JobRegistry）などに残るメモリ、応答の転送バイト数、レイテンシを出す。
+
+- held_plain:   出力全体を平文のまま持つ（output_capture.head_bytesを出力上限にした場合。従来の持ち方に相当）
+- full:         既定の持ち方（先頭・末尾＋圧縮した全体）で、応答は出力全体
+- full_gzip:    fullと同じで、Accept-Encoding: gzip
+- preview_gzip: 応答は先頭・末尾のプレビュー（preview=true）で、Accept-Encoding: gzip
+
+    python bench/output_memory.py --requests 64 --concurrency 32 --stdout-bytes 1000000 --json output_memory.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'held_plain': {'preview': False, 'encoding': 'identity', 'plain': True},
+    'full': {'preview': False, 'encoding': 'identity', 'plain': False},
+    'full_gzip': {'preview': False, 'encoding': 'gzip', 'plain': False},
+    'preview_gzip': {'preview': True, 'encoding': 'gzip', 'plain': False},
+}
+CHUNK_CHARS = 4096
+
+
+def output_text(size, seed):
+    # テストケースの出力のような、数値を並べた行
+    rng = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(str(rng.randrange(1_000_000)) for _ in range(8)) + '\n'
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)[:size]
+
+
+def output_frames(stdout, sleep):
+    def handler(job):
+        # 並列に実行中のジョブが重なるよう、出力の途中で少し待つ
+        half = len(stdout) // 2
+        for start, end in ((0, half), (half, len(stdout))):
+            for i in range(start, end, CHUNK_CHARS):
+                yield {'type': 'stdout', 'data': stdout[i:min(i + CHUNK_CHARS, end)]}
+            time.sleep(sleep)
+        yield {'type': 'result', 'exit_code': 0, 'time': sleep * 2}
+    return handler
+
+
+def load_app(stdout, sleep):
+    # main.pyのimport前にDB接続先を差し替える（db.pyがDATABASE_URLを見る）
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    sys.path.insert(0, BACKEND_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    from fake_docker import FakeDockerClient
+    main.runtime.client_factory = lambda: FakeDockerClient(handler=output_frames(stdout, sleep))
+    # レート制限・結果キャッシュで計測が変わらないようにする
+    main.rate_limiter.configure(rate_per_minute=10 ** 9, burst=10 ** 9, max_concurrent=10 ** 6)
+    main.result_cache.configure(enabled=False)
+    main.job_scheduler.configure(max_concurrency=10 ** 4, per_language={}, max_queue_depth=10 ** 6,
+                                 max_queue_wait=300)
+    return main
+
+
+async def run_scenario(main, client, scenario, args):
+    settings = SCENARIOS[scenario]
+    defaults = {'head_bytes': 65536, 'tail_bytes': 16384}
+    if settings['plain']:
+        # 出力上限まで先頭に入るので、圧縮せず平文のまま持つ
+        main.output_capture.update(head_bytes=main.output_limits['stdout'], tail_bytes=0)
+    else:
+        main.output_capture.update(defaults)
+    main.job_registry._jobs.clear()
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    transferred = []
+    truncated = 0
+
+    async def one(index):
+        nonlocal truncated
+        async with semaphore:
+            started = time.perf_counter()
+            async with client.stream('POST', '/run', headers={'Accept-Encoding': settings['encoding']},
+                                     json={'language': 'python', 'code': f'# job {index}', 'stdin': '',
+                                           'preview': settings['preview']}) as response:
+                body = await response.aread()
+                transferred.append(response.num_bytes_downloaded)
+            latencies.append(time.perf_counter() - started)
+            result = json.loads(body)
+            if result.get('exit_code') != 0:
+                raise RuntimeError(f"job {index}: exit_code={result.get('exit_code')} {result.get('stderr')[:200]}")
+            truncated += result.get('truncated', False)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    # 書き込み待ちの行が書き出されてから、ジョブ一覧などに残っている分を測る
+    while not main.job_writer._queue.empty():
+        await asyncio.sleep(main.job_writer.flush_interval)
+    await asyncio.sleep(main.job_writer.flush_interval * 2)
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    main.output_capture.update(defaults)
+    latencies.sort()
+    return {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'stdout_bytes': args.stdout_bytes,
+        'peak_mb': (peak - before) / 2 ** 20,
+        'retained_mb': (retained - before) / 2 ** 20,
+        'response_bytes_mean': statistics.fmean(transferred),
+        'truncated_responses': truncated,
+        'latency_ms': {
+            'p50': latencies[len(latencies) // 2] * 1000,
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        },
+        'seconds': elapsed,
+    }
+
+
+async def run(args, scenarios):
+    stdout = output_text(args.stdout_bytes, args.seed)
+    main = load_app(stdout, args.sleep)
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=300) as client:
+            for scenario in scenarios:
+                results[scenario] = await run_scenario(main, client, scenario, args)
+                result = results[scenario]
+                print(f"{scenario:>13}: peak {result['peak_mb']:8.1f} MB  retained {result['retained_mb']:7.1f} MB  "
+                      f"response {result['response_bytes_mean'] / 1024:8.1f} KiB  "
+                      f"p50 {result['latency_ms']['p50']:8.1f} ms  p99 {result['latency_ms']['p99']:8.1f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--stdout-bytes', type=int, default=1_000_000, help='1ジョブの標準出力のバイト数')
+    parser.add_argument('--sleep', type=float, default=0.05, help='疑似runnerが出力の途中で待つ秒数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenarios', help='実行するシナリオ（カンマ区切り、既定はすべて）')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {unknown}')
+    results = asyncio.run(run(args, scenarios))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': vars(args), 'scenarios': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+/run 1回あたりのバックエンド側の準備コスト（コンテナ作成前まで）を計測するマイクロベンチマーク。
+
+- before: 旧実装と同じく、リクエストごとにDockerクライアント生成・イメージ取得・リソース制限の解析・
+          seccompプロファイル読み込み・DB設定/config読み込みを行う
+- after:  RuntimeContextで起動時に用意したクライアント・イメージ情報・host_configを使う
+
+Dockerデーモンは不要（bench/fake_docker.pyの疑似クライアントを使う）。
+    python bench/overhead.py --iterations 2000 --rtt 0.0005 --json overhead.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import yaml
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import runtime as runtime_module  # noqa: E402
+from runtime import RuntimeContext, get_resource_limits, runner_image  # noqa: E402
+from fake_docker import FakeDockerClient  # noqa: E402
+
+CONFIG_PATH = os.path.join(BACKEND_DIR, 'config.yaml')
+
+
+def legacy_prepare(language, rtt, seccomp_path):
+    # 旧run_codeがコンテナ作成前に毎回行っていた処理
+    client = FakeDockerClient(rtt=rtt)
+    mem_limit, cpu_limit = get_resource_limits(client.images.get(runner_image(language)))
+    security_opt = None
+    if os.path.exists(seccomp_path):
+        with open(seccomp_path, 'r') as f:
+            security_opt = [f"seccomp={f.read()}"]
+    host_config = client.api.create_host_config(
+        network_mode='none', mem_limit=mem_limit, nano_cpus=int(cpu_limit * 1e9), security_opt=security_opt)
+    # get_db_config()（開発モード）とサイズ制限チェックでのconfig.yaml読み込み
+    with open(CONFIG_PATH, 'r') as f:
+        config = yaml.safe_load(f)
+    config.get('max_request_body_size', 1048576)
+    config.get('max_code_length', 10000)
+    return host_config
+
+
+def runtime_prepare(runtime, language):
+    host_config = runtime.image_info(language).host_config
+    runtime.max_request_body_size
+    runtime.max_code_length
+    return host_config
+
+
+def measure(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'mean_us': statistics.fmean(samples) * 1e6,
+        'p50_us': samples[len(samples) // 2] * 1e6,
+        'p99_us': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--language', default='python')
+    parser.add_argument('--rtt', type=float, default=0.0005, help='疑似Docker APIの往復遅延（秒）')
+    parser.add_argument('--seccomp', default=os.path.join(BACKEND_DIR, 'seccomp-allow.json'))
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    runtime_module.SECCOMP_PROFILE_PATH = args.seccomp
+    with open(CONFIG_PATH, 'r') as f:
+        config = yaml.safe_load(f)
+    runtime = RuntimeContext(config, client_factory=lambda: FakeDockerClient(rtt=args.rtt))
+    runtime.warm([args.language])
+
+    results = {
+        'rtt': args.rtt,
+        'before': measure(lambda: legacy_prepare(args.language, args.rtt, args.seccomp), args.iterations),
+        'after': measure(lambda: runtime_prepare(runtime, args.language), args.iterations),
+    }
+    results['speedup'] = results['before']['mean_us'] / results['after']['mean_us']
+    for name in ('before', 'after'):
+        r = results[name]
+        print(f"{name:>6}: mean {r['mean_us']:9.1f} us  p50 {r['p50_us']:9.1f} us  p99 {r['p99_us']:9.1f} us")
+    print(f"speedup: x{results['speedup']:.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import collections
+import hashlib
+import json
+import threading
+import time as pytime
+
+from jobstore import stored_output
+from models import CodeJob
+
+
+def result_cache_key(language, image_id, code, stdin, limits):
+    """言語・イメージID（ダイジェスト）・コード・標準入力・リソース制限から結果キャッシュのキーを作る"""
+    payload = json.dumps({
+        'language': language,
+        'image': image_id,
+        'code': code,
+        'stdin': stdin,
+        'limits': limits,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    決定的な実行結果のキャッシュ。
+    - メモリ上のLRU（件数・合計バイト数・TTLで追い出し）
+    - persistent=Trueならcode_jobs.cache_keyを引いて、再起動後・他レプリカの結果も使う
+    成功（exit_code=0）した結果だけを保存する。
+    """
+
+    def __init__(self, session_factory=None, enabled=False, max_entries=1000,
+                 max_bytes=64 * 1024 * 1024, ttl_seconds=3600, persistent=False):
+        self.session_factory = session_factory
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'persistent_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self.configure(enabled, max_entries, max_bytes, ttl_seconds, persistent)
+
+    def configure(self, enabled=False, max_entries=1000, max_bytes=64 * 1024 * 1024,
+                  ttl_seconds=3600, persistent=False):
+        with self._lock:
+            self.enabled = enabled
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.ttl_seconds = ttl_seconds
+            self.persistent = persistent and self.session_factory is not None
+            self._evict_locked()
+
+    @staticmethod
+    def cacheable(result):
+        return result.get('exit_code') == 0
+
+    @staticmethod
+    def _size(result):
+        return len(result.get('stdout', '').encode('utf-8')) + len(result.get('stderr', '').encode('utf-8'))
+
+    def _evict_locked(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, result) = self._entries.popitem(last=False)
+            self._bytes -= self._size(result)
+            self._counters['evictions'] += 1
+
+    def put(self, key, result):
+        if not self.cacheable(result):
+            return
+        size = self._size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= self._size(previous[1])
+            self._entries[key] = (pytime.monotonic(), result)
+            self._bytes += size
+            self._counters['stores'] += 1
+            self._evict_locked()
+
+    def get(self, key):
+        """メモリ上のキャッシュを引く（ヒットしなければNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, result = entry
+                if pytime.monotonic() - stored_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return result
+                del self._entries[key]
+                self._bytes -= self._size(result)
+            if not self.persistent:
+                self._counters['misses'] += 1
+        return None
+
+    def load(self, key):
+        """code_jobsから同じキーで成功した直近の結果を引く（ブロッキング）"""
+        db = self.session_factory()
+        try:
+            row = (db.query(CodeJob)
+                   .filter(CodeJob.cache_key == key, CodeJob.result_exit_code == 0)
+                   .order_by(CodeJob.id.desc())
+                   .first())
+        finally:
+            db.close()
+        if row is None:
+            with self._lock:
+                self._counters['misses'] += 1
+            return None
+        result = {
+            'stdout': stored_output(row, 'stdout'),
+            'stderr': stored_output(row, 'stderr'),
+            'exit_code': row.result_exit_code,
+            'time': row.result_time if row.result_time is not None else -1,
+        }
+        with self._lock:
+            self._counters['persistent_hits'] += 1
+        self.put(key, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['enabled'] = self.enabled
+        stats['persistent'] = self.persistent
+        return stats
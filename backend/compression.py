@@ -0,0 +1,141 @@
+import asyncio
+import gzip
+import threading
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    # brotliパッケージがなければgzipだけを使う
+    brotli = None
+
+# これより大きい本文はイベントループを止めないようスレッドで圧縮する（バイト）
+THREAD_COMPRESS_MIN_BYTES = 65536
+
+
+def accepted_encodings(header):
+    # Accept-Encodingのうちq=0でないもの
+    encodings = set()
+    for item in (header or '').split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip() and quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+class ResponseCompressor:
+    """
+    大きな応答本文の圧縮の設定と統計。Accept-Encodingにbrがありbrotliパッケージがあればbr、なければgzipを使う。
+    実際の圧縮はCompressionMiddlewareが行う。
+    """
+
+    def __init__(self, enabled=True, minimum_size=4096, gzip_level=6, brotli_quality=4, use_brotli=True):
+        self._lock = threading.Lock()
+        self._counters = {'compressed': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0, 'gzip': 0, 'br': 0}
+        self.configure(enabled, minimum_size, gzip_level, brotli_quality, use_brotli)
+
+    def configure(self, enabled=True, minimum_size=4096, gzip_level=6, brotli_quality=4, use_brotli=True):
+        self.enabled = enabled
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.use_brotli = use_brotli and brotli is not None
+
+    def choose(self, accept_encoding):
+        if not self.enabled:
+            return None
+        encodings = accepted_encodings(accept_encoding)
+        if self.use_brotli and 'br' in encodings:
+            return 'br'
+        if 'gzip' in encodings:
+            return 'gzip'
+        return None
+
+    def compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    def record(self, encoding, size, compressed_size):
+        with self._lock:
+            if encoding is None:
+                self._counters['skipped'] += 1
+                return
+            self._counters['compressed'] += 1
+            self._counters[encoding] += 1
+            self._counters['bytes_in'] += size
+            self._counters['bytes_out'] += compressed_size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['enabled'] = self.enabled
+        stats['minimum_size'] = self.minimum_size
+        stats['brotli'] = self.use_brotli
+        return stats
+
+
+class CompressionMiddleware:
+    """
+    minimum_sizeバイト以上の応答本文を圧縮するASGIミドルウェア。
+    本文を1回で送る応答だけが対象で、逐次送る応答（SSEなど）・部分応答（Content-Range）・
+    すでにContent-Encodingのある応答はそのまま通す。
+    """
+
+    def __init__(self, app, compressor):
+        self.app = app
+        self.compressor = compressor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = self.compressor.choose(Headers(scope=scope).get('accept-encoding'))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                headers = Headers(raw=message.get('headers', []))
+                if 'text/event-stream' in headers.get('content-type', ''):
+                    await send(message)
+                    return
+                # 本文の大きさが分かるまで送らない
+                start = message
+                return
+            if message['type'] != 'http.response.body' or start is None:
+                await send(message)
+                return
+            held, start = start, None
+            body = message.get('body', b'')
+            headers = MutableHeaders(raw=held['headers'])
+            if (message.get('more_body', False) or len(body) < self.compressor.minimum_size
+                    or 'content-encoding' in headers or 'content-range' in headers):
+                self.compressor.record(None, len(body), len(body))
+                await send(held)
+                await send(message)
+                return
+            if len(body) >= THREAD_COMPRESS_MIN_BYTES:
+                compressed = await asyncio.to_thread(self.compressor.compress, body, encoding)
+            else:
+                compressed = self.compressor.compress(body, encoding)
+            self.compressor.record(encoding, len(body), len(compressed))
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(compressed))
+            headers.add_vary_header('Accept-Encoding')
+            await send(held)
+            await send({'type': 'http.response.body', 'body': compressed, 'more_body': False})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,5 +1,6 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from models import Base
 
 import os
@@ -53,10 +54,22 @@ else:
     config = {}
 
 
-# DB接続情報を共通関数で取得
+def engine_options(url):
+    """
+    create_engineの引数。SQLite（ベンチマーク・CI用）はスレッド間で接続を共有し、
+    メモリ上のDBは全セッションで同じ接続を使う
+    """
+    if url.startswith('sqlite'):
+        options = {'connect_args': {'check_same_thread': False}}
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            options['poolclass'] = StaticPool
+        return options
+    return {'pool_pre_ping': True}
+
+# DB接続情報を共通関数で取得（環境変数DATABASE_URLがあればそちらを優先）
 db_user, db_password, db_name, db_host, db_port = get_db_config()
-DATABASE_URL = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+DATABASE_URL = os.getenv('DATABASE_URL') or f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # DB初期化
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time as pytime
+
+import docker
+from docker.utils import parse_bytes
+
+from runtime import RuntimeContext
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def tls_config(settings):
+    # runner_hostsのtls設定（証明書のパス）からdocker SDKのTLSConfigを作る
+    if not settings:
+        return None
+    client_cert = None
+    if settings.get('client_cert') and settings.get('client_key'):
+        client_cert = (settings['client_cert'], settings['client_key'])
+    return docker.tls.TLSConfig(
+        client_cert=client_cert,
+        ca_cert=settings.get('ca_cert'),
+        verify=settings.get('verify', True),
+    )
+
+
+class RunnerHost:
+    """
+    runnerコンテナを起動するDockerエンドポイント1つ分。
+    - 実行中ジョブ数と、そのジョブのコンテナに割り当てたCPU・メモリ（get_resource_limitsの値）の合計
+    - 連続失敗がunhealthy_after回に達したら、retry_interval秒は振り分け対象から外す
+    負荷の更新・参照はDocker APIを呼ばないため、イベントループ上から直接呼んでよい。
+    """
+
+    def __init__(self, name, runtime, cpus=None, memory=None, max_jobs=None):
+        self.name = name
+        self.runtime = runtime
+        # 容量（未指定ならwarm時にDockerのinfoから取得）
+        self.cpus = cpus
+        self.memory = parse_bytes(memory) if isinstance(memory, str) else memory
+        self.max_jobs = max_jobs
+        self.running = 0
+        self.reserved_cpu = 0.0
+        self.reserved_memory = 0
+        self.failures = 0
+        self.unhealthy_until = None
+        self.retired = False
+        self._lock = threading.Lock()
+        self._counters = {'jobs': 0, 'spawns': 0, 'spawn_errors': 0, 'marked_unhealthy': 0}
+
+    def available(self, now=None):
+        if self.retired:
+            return False
+        if self.unhealthy_until is None:
+            return True
+        # 期限を過ぎたら再び試す（失敗すればすぐにまた外れる）
+        return (now or pytime.monotonic()) >= self.unhealthy_until
+
+    def load(self):
+        """
+        振り分けに使う負荷（小さいほど空いている）。容量に対する使用率の最大値・実行中ジョブ数、
+        同じなら累計ジョブ数の少ないホストを選ぶ
+        """
+        ratios = []
+        if self.max_jobs:
+            ratios.append(self.running / self.max_jobs)
+        if self.cpus:
+            ratios.append(self.reserved_cpu / self.cpus)
+        if self.memory:
+            ratios.append(self.reserved_memory / self.memory)
+        return (max(ratios) if ratios else 0.0, self.running, self._counters['jobs'])
+
+    def reserve(self, language):
+        # ジョブ開始時に呼ぶ。返り値をunreserveに渡して戻す
+        # 再確認の期限が切れていても最後に読み込んだ制限値で数える（再確認はバックグラウンド）
+        info = self.runtime.last_image_info(language)
+        cpu = info.cpu_limit if info else 0.0
+        memory = parse_bytes(info.mem_limit) if info else 0
+        with self._lock:
+            self.running += 1
+            self.reserved_cpu += cpu
+            self.reserved_memory += memory
+            self._counters['jobs'] += 1
+        return cpu, memory
+
+    def unreserve(self, reservation):
+        cpu, memory = reservation
+        with self._lock:
+            self.running -= 1
+            self.reserved_cpu -= cpu
+            self.reserved_memory -= memory
+
+    def record_success(self):
+        self._counters['spawns'] += 1
+        self.failures = 0
+        self.unhealthy_until = None
+
+    def record_failure(self, unhealthy_after, retry_interval):
+        self._counters['spawn_errors'] += 1
+        self.failures += 1
+        if self.failures >= unhealthy_after:
+            if self.unhealthy_until is None or pytime.monotonic() >= self.unhealthy_until:
+                self._counters['marked_unhealthy'] += 1
+                logger.warning(f'runner host {self.name} marked unhealthy after {self.failures} failures')
+            self.unhealthy_until = pytime.monotonic() + retry_interval
+
+    def detect_capacity(self):
+        # 容量が設定されていなければDockerデーモンのCPU数・メモリ量を使う（ブロッキング）
+        if self.cpus and self.memory:
+            return
+        try:
+            info = self.runtime.client.info()
+        except Exception as e:
+            logger.warning(f'runner host {self.name} info failed: {e}')
+            return
+        self.cpus = self.cpus or info.get('NCPU')
+        self.memory = self.memory or info.get('MemTotal')
+
+    def stats(self):
+        load = self.load()[0]
+        return {
+            **self._counters,
+            'running': self.running,
+            'reserved_cpu': self.reserved_cpu,
+            'reserved_memory': self.reserved_memory,
+            'cpus': self.cpus,
+            'memory': self.memory,
+            'max_jobs': self.max_jobs,
+            'load': load,
+            'failures': self.failures,
+            'healthy': self.available(),
+            'retired': self.retired,
+        }
+
+
+class HostRegistry:
+    """
+    config.yamlのrunner_hostsに書いたDockerエンドポイントの一覧。
+    未設定ならバックエンド自身のDocker（local_runtime）1台だけを使う。
+    base_urlを省略したホストもlocal_runtimeを共有する。
+    """
+
+    def __init__(self, config, local_runtime, client_factory=None):
+        self.local_runtime = local_runtime
+        # テスト・ベンチマーク用。client_factory(host_name)でホストごとのクライアントを作る
+        self.client_factory = client_factory
+        self.hosts = []
+        self._lock = threading.Lock()
+        self.configure(config)
+
+    def _build_runtime(self, config, settings):
+        name = settings['name']
+        if self.client_factory is not None and settings.get('base_url'):
+            return RuntimeContext(config, client_factory=lambda: self.client_factory(name))
+        if not settings.get('base_url'):
+            return self.local_runtime
+        return RuntimeContext(config, base_url=settings['base_url'], tls=tls_config(settings.get('tls')))
+
+    def configure(self, config):
+        """
+        ホスト一覧を反映する。同じ名前のホストは負荷・状態を引き継いで設定だけ更新し、
+        一覧から消えたホストは実行中のジョブが終わるまで残して振り分け対象から外す。
+        """
+        settings = config.get('runner_hosts') or [{'name': 'local'}]
+        health = config.get('runner_host_health', {}) or {}
+        self.unhealthy_after = health.get('unhealthy_after', 3)
+        self.retry_interval = health.get('retry_interval', 30)
+        with self._lock:
+            current = {host.name: host for host in self.hosts}
+            hosts = []
+            for entry in settings:
+                host = current.pop(entry['name'], None)
+                if host is None:
+                    host = RunnerHost(entry['name'], self._build_runtime(config, entry))
+                else:
+                    if host.runtime is not self.local_runtime:
+                        host.runtime.reload(config)
+                    host.retired = False
+                # 容量の指定がなければ自動取得した値を使い続ける
+                host.cpus = entry.get('cpus', host.cpus)
+                memory = entry.get('memory', host.memory)
+                host.memory = parse_bytes(memory) if isinstance(memory, str) else memory
+                host.max_jobs = entry.get('max_jobs')
+                hosts.append(host)
+            for host in current.values():
+                host.retired = True
+            self.hosts = hosts
+
+    def choose(self, exclude=()):
+        """振り分け可能なホストのうち最も空いているものを返す（なければNone）"""
+        now = pytime.monotonic()
+        candidates = [h for h in self.hosts if h not in exclude and h.available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=RunnerHost.load)
+
+    def primary(self):
+        # ジョブを振り分ける前にイメージ情報を参照する（結果キャッシュの検索）ときに使うホスト
+        return self.choose() or self.hosts[0]
+
+    def record_success(self, host):
+        host.record_success()
+
+    def record_failure(self, host):
+        host.record_failure(self.unhealthy_after, self.retry_interval)
+
+    def warm(self, languages):
+        # 起動時に各ホストの容量とイメージ情報を読み込んでおく（失敗しても起動は続ける）
+        for host in self.hosts:
+            host.detect_capacity()
+            host.runtime.warm(languages)
+
+    def stats(self):
+        return {host.name: host.stats() for host in self.hosts}
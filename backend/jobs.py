@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import time as pytime
+import uuid
+
+from metrics import Timing
+from output import OutputCapture
+
+# ジョブの状態。pending（受付済み・キュー待ち）→ running（runnerで実行中）→ 終了状態のいずれか
+JOB_STATUS_PENDING = 'pending'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_DONE = 'done'
+JOB_STATUS_ERROR = 'error'
+# 時間制限を超えた（runnerが打ち切った・応答しないコンテナを強制削除した）
+JOB_STATUS_TIMEOUT = 'timeout'
+# 実行中にバックエンドが停止するなどして結果が失われた
+JOB_STATUS_LOST = 'lost'
+
+ACTIVE_STATUSES = (JOB_STATUS_PENDING, JOB_STATUS_RUNNING)
+# 状態ごとの遷移先（終了状態からは遷移しない）。キャッシュヒット・受付時のエラーはpendingから直接終了する
+JOB_TRANSITIONS = {
+    JOB_STATUS_PENDING: {JOB_STATUS_RUNNING, JOB_STATUS_DONE, JOB_STATUS_ERROR, JOB_STATUS_TIMEOUT, JOB_STATUS_LOST},
+    JOB_STATUS_RUNNING: {JOB_STATUS_DONE, JOB_STATUS_ERROR, JOB_STATUS_TIMEOUT, JOB_STATUS_LOST},
+}
+# 時間制限超過の終了コード
+TIMEOUT_EXIT_CODES = {1001}
+
+
+def result_status(exit_code):
+    # 終了コードに対応する終了状態
+    if exit_code == 0:
+        return JOB_STATUS_DONE
+    if exit_code in TIMEOUT_EXIT_CODES:
+        return JOB_STATUS_TIMEOUT
+    return JOB_STATUS_ERROR
+
+
+class InvalidTransition(Exception):
+    """JOB_TRANSITIONSにない状態遷移（終了済みのジョブを再び終了させた等）"""
+
+
+class OutputLimitExceeded(Exception):
+    """出力がmax_stdout_bytes / max_stderr_bytesを超えた"""
+
+
+class Job:
+    """
+    投入されたジョブの状態と出力イベント列。
+    出力は(seq, stream, data)のイベントとして追記し、購読者はseqの続きから読み出す。
+    イベントは直近のstream_buffer_bytes分だけを残し、出力全体はストリームごとのOutputCaptureに
+    （先頭・末尾と、大きければ圧縮した全体として）持つ。
+    """
+
+    def __init__(self, language, code, stdin, output_limits, timing=None, capture=None):
+        self.id = uuid.uuid4().hex
+        self.language = language
+        self.code = code
+        self.stdin = stdin
+        self.status = JOB_STATUS_PENDING
+        self.created_at = pytime.time()
+        self.finished_at = None
+        self.output_limits = output_limits
+        capture = capture or {}
+        self.outputs = {stream: OutputCapture(capture.get('head_bytes', 65536), capture.get('tail_bytes', 16384),
+                                              capture.get('compress_level', 1))
+                        for stream in ('stdout', 'stderr')}
+        self.stream_buffer_bytes = capture.get('stream_buffer_bytes', 262144)
+        self.events = []
+        # 古い順に捨てたイベントの数（events[0]のseq）と、残っているイベントのバイト数
+        self.dropped_events = 0
+        self._event_sizes = []
+        self._event_bytes = 0
+        self.result = None
+        self.task = None
+        # 実行したランナーのホスト（ランナーを取得するまではNone）
+        self.host = None
+        # 受付からの処理段階ごとの所要時間（debug['timing']で返す）
+        self.timing = timing or Timing()
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.result is not None
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def transition(self, status):
+        if status not in JOB_TRANSITIONS.get(self.status, ()):
+            raise InvalidTransition(f'job {self.id}: {self.status} -> {status}')
+        self.status = status
+
+    def mark_running(self):
+        self.transition(JOB_STATUS_RUNNING)
+        self._notify()
+
+    @property
+    def output_bytes(self):
+        return {stream: capture.total_bytes for stream, capture in self.outputs.items()}
+
+    @property
+    def truncated(self):
+        # どちらかの出力がプレビューに収まらない
+        return any(capture.truncated for capture in self.outputs.values())
+
+    def _append_event(self, stream, data, encoded):
+        self.outputs[stream].write(encoded)
+        self.events.append((self.dropped_events + len(self.events), stream, data))
+        self._event_sizes.append(len(encoded))
+        self._event_bytes += len(encoded)
+        # 直近のstream_buffer_bytes分だけを残す（最後の1件は残す）
+        drop = 0
+        while len(self.events) - drop > 1 and self._event_bytes > self.stream_buffer_bytes:
+            self._event_bytes -= self._event_sizes[drop]
+            drop += 1
+        if drop:
+            del self.events[:drop]
+            del self._event_sizes[:drop]
+            self.dropped_events += drop
+        self._notify()
+
+    def append_output(self, stream, data):
+        # 上限を超えた分は切り捨て、OutputLimitExceededで実行側に打ち切りを知らせる
+        encoded = data.encode('utf-8')
+        limit = self.output_limits.get(stream)
+        used = self.outputs[stream].total_bytes
+        exceeded = limit is not None and used + len(encoded) > limit
+        if exceeded:
+            encoded = encoded[:max(limit - used, 0)]
+            data = encoded.decode('utf-8', errors='ignore')
+            encoded = data.encode('utf-8')
+        if data:
+            self._append_event(stream, data, encoded)
+        if exceeded:
+            raise OutputLimitExceeded(stream)
+
+    def append_message(self, stream, data):
+        # 時間・出力制限のメッセージなど、出力上限に数えずに追記する
+        if data:
+            self._append_event(stream, data, data.encode('utf-8'))
+
+    def output(self, stream):
+        """出力全体（大きい出力は圧縮したものから復元する）"""
+        return self.outputs[stream].text()
+
+    def preview(self, stream):
+        """先頭・末尾だけのプレビュー（プレビューに収まる出力は全体）"""
+        return self.outputs[stream].preview()
+
+    def finish(self, result):
+        self.transition(result_status(result.exit_code))
+        for capture in self.outputs.values():
+            capture.close()
+        self.result = result
+        self.finished_at = pytime.time()
+        self._notify()
+
+    async def stream_events(self, start=0):
+        """
+        seq=startから出力イベントを順に返し、ジョブ終了で止まる。
+        読み出す前に捨てられたイベントがあれば、代わりに(seq, 'truncated', 捨てられたイベント数)を返す
+        """
+        index = start
+        while True:
+            changed = self._changed
+            while index < self.dropped_events + len(self.events):
+                # yieldの間にも捨てられることがあるため、毎回確認する
+                if index < self.dropped_events:
+                    yield (self.dropped_events - 1, 'truncated', self.dropped_events - index)
+                    index = self.dropped_events
+                    continue
+                yield self.events[index - self.dropped_events]
+                index += 1
+            if self.finished:
+                return
+            await changed.wait()
+
+
+class JobRegistry:
+    """
+    実行中・直近に終了したジョブを保持する。
+    終了後ttl秒を過ぎたジョブ、または件数上限を超えた古い終了済みジョブから捨てる。
+    """
+
+    def __init__(self, ttl_seconds=600, max_jobs=1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._jobs = collections.OrderedDict()
+
+    def add(self, job):
+        self._evict()
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _evict(self):
+        now = pytime.time()
+        for job_id, job in list(self._jobs.items()):
+            if not job.finished:
+                continue
+            if now - job.finished_at > self.ttl_seconds or len(self._jobs) >= self.max_jobs:
+                del self._jobs[job_id]
+
+    def active_ids(self):
+        # 終了していないジョブのID（終了していないジョブは破棄しない）。リコンサイラのスレッドからも呼ぶ
+        return {job_id for job_id, job in list(self._jobs.items()) if not job.finished}
+
+    def __len__(self):
+        return len(self._jobs)
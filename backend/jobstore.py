@@ -0,0 +1,504 @@
+import base64
+import collections
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time as pytime
+import zlib
+
+from sqlalchemy import exists, insert, select, tuple_
+
+from metrics import Histogram
+from models import CodeBlob, CodeJob
+
+logger = logging.getLogger("uvicorn.error")
+
+# 1回のまとめてINSERT（コミットまで）の所要時間（秒）のヒストグラム境界
+INSERT_TIME_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+# これより小さいコード・標準入力は圧縮しない（バイト）
+BLOB_COMPRESS_MIN_BYTES = 512
+# 同じブロブのlast_used_atはこの間隔（秒）より頻繁には更新しない
+BLOB_TOUCH_INTERVAL = 3600
+# ライターが書き込み済みとして覚えておくブロブの数。覚えている間（BLOB_TOUCH_INTERVALの半分）は
+# 圧縮・UPSERTを省く（保持期間の削除はlast_used_atが2*BLOB_TOUCH_INTERVALより古いものだけが対象）
+KNOWN_BLOBS_MAX = 100000
+
+
+def utc_datetime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc) if timestamp is not None else None
+
+
+def encode_blob(text, level=1):
+    # コード・標準入力をcode_blobsの行にする（圧縮して小さくなる場合のみzlib）
+    data = text.encode('utf-8')
+    blob = {'hash': hashlib.sha256(data).hexdigest(), 'compression': 'none', 'data': data, 'size': len(data)}
+    if len(data) >= BLOB_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data, level)
+        if len(compressed) < len(data):
+            blob['compression'] = 'zlib'
+            blob['data'] = compressed
+    return blob
+
+
+def decode_blob(blob):
+    data = zlib.decompress(blob.data) if blob.compression == 'zlib' else blob.data
+    return data.decode('utf-8')
+
+
+def encode_output(text, inline_bytes, level=1):
+    # 出力を(インライン部分, 圧縮した全体)にする。inline_bytesを超えていれば先頭だけをプレビューとして残す
+    if text is None:
+        return None, None
+    data = text.encode('utf-8')
+    if inline_bytes is None or len(data) <= inline_bytes:
+        return text, None
+    return data[:inline_bytes].decode('utf-8', errors='ignore'), zlib.compress(data, level)
+
+
+def stored_output(row, stream):
+    # code_jobsの行から出力全体を復元する（圧縮していない行はインライン部分が全体）
+    compressed = getattr(row, f'result_{stream}_compressed')
+    if compressed is not None:
+        return zlib.decompress(compressed).decode('utf-8')
+    return getattr(row, f'result_{stream}') or ''
+
+
+def load_blobs(db, hashes):
+    # ハッシュ -> 本文
+    hashes = {h for h in hashes if h}
+    if not hashes:
+        return {}
+    return {blob.hash: decode_blob(blob) for blob in db.query(CodeBlob).filter(CodeBlob.hash.in_(hashes))}
+
+
+def job_code(row, blobs):
+    # (コード, 標準入力)。旧形式の行はcode / stdin列、新しい行はcode_blobsから読む
+    code = row.code if row.code_hash is None else blobs.get(row.code_hash)
+    stdin = row.stdin if row.stdin_hash is None else blobs.get(row.stdin_hash)
+    return code, stdin or ''
+
+
+# ジョブ一覧で返す列（コード・出力の本文は含めない）
+JOB_SUMMARY_COLUMNS = (
+    CodeJob.id, CodeJob.uid, CodeJob.language, CodeJob.status, CodeJob.result_exit_code, CodeJob.result_time,
+    CodeJob.stdout_bytes, CodeJob.stderr_bytes, CodeJob.created_at, CodeJob.finished_at,
+)
+
+
+def encode_cursor(created_at, job_id):
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{job_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    # 不正なカーソルはValueError
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, job_id = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(created_at), int(job_id)
+    except Exception as e:
+        raise ValueError(f'invalid cursor: {cursor}') from e
+
+
+def list_jobs(db, limit=50, cursor=None, order='desc', language=None, status=None, exit_code=None):
+    """
+    code_jobsを(created_at, id)の順にlimit件ずつ返す（キーセット方式。OFFSETを使わないため、
+    どれだけ古いページでもcreated_atのインデックスから読み始められる）。
+    返り値は(行のリスト, 次のページのカーソル（最後のページならNone）)
+    """
+    # uidのない行（APIを通さずに入った行・uid追加前の行）はジョブIDがないため一覧に含めない
+    query = db.query(*JOB_SUMMARY_COLUMNS).filter(CodeJob.uid.isnot(None), CodeJob.created_at.isnot(None))
+    if language is not None:
+        query = query.filter(CodeJob.language == language)
+    if status is not None:
+        query = query.filter(CodeJob.status == status)
+    if exit_code is not None:
+        query = query.filter(CodeJob.result_exit_code == exit_code)
+    descending = order == 'desc'
+    if cursor is not None:
+        created_at, job_id = decode_cursor(cursor)
+        key = tuple_(CodeJob.created_at, CodeJob.id)
+        # 行値の比較だけではインデックスを使わないDBがあるため、created_atの範囲条件も付ける
+        if descending:
+            query = query.filter(CodeJob.created_at <= created_at, key < tuple_(created_at, job_id))
+        else:
+            query = query.filter(CodeJob.created_at >= created_at, key > tuple_(created_at, job_id))
+    if descending:
+        query = query.order_by(CodeJob.created_at.desc(), CodeJob.id.desc())
+    else:
+        query = query.order_by(CodeJob.created_at, CodeJob.id)
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return rows, next_cursor
+
+
+def upsert_blobs(db, blobs, now):
+    """
+    ブロブを挿入する。既にあれば本体は書き換えず、last_used_atが古い場合だけ更新する。
+    複数レプリカのライターが同時に書いてもデッドロックしないよう、ハッシュ順に書く
+    """
+    if not blobs:
+        return
+    blobs = sorted(blobs, key=lambda blob: blob['hash'])
+    for blob in blobs:
+        blob['last_used_at'] = now
+    dialect = db.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(CodeBlob)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CodeBlob.hash],
+            set_={'last_used_at': stmt.excluded.last_used_at},
+            where=CodeBlob.last_used_at < now - datetime.timedelta(seconds=BLOB_TOUCH_INTERVAL),
+        )
+        db.execute(stmt, blobs)
+        return
+    existing = set(db.scalars(select(CodeBlob.hash).where(CodeBlob.hash.in_([b['hash'] for b in blobs]))))
+    missing = [blob for blob in blobs if blob['hash'] not in existing]
+    if missing:
+        db.execute(insert(CodeBlob), missing)
+
+
+def upsert_jobs(db, rows):
+    """
+    code_jobsの行をuidで挿入・更新する（投入時・実行開始時・終了時に同じuidの行を書き直す）。
+    同じuidの行が1回分に複数あれば最後のものだけを書く（PostgreSQLは1文で同じ行を2回更新できない）
+    """
+    rows = list({row['uid']: row for row in rows}.values())
+    dialect = db.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        # Core のINSERTにする（ORMの一括INSERTはNULLの列の組み合わせごとに文を分けてしまう）
+        stmt = dialect_insert(CodeJob.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CodeJob.uid],
+            set_={column: stmt.excluded[column] for column in rows[0] if column != 'uid'},
+        )
+        db.execute(stmt, rows)
+        return
+    db.query(CodeJob).filter(CodeJob.uid.in_([row['uid'] for row in rows])).delete(synchronize_session=False)
+    db.execute(insert(CodeJob.__table__), rows)
+
+
+class JobWriter:
+    """
+    code_jobsへの書き込みをリクエスト処理から切り離すバッチライター。
+    submitされた行をキューに溜め、バックグラウンドスレッドでまとめてuidごとにINSERT（既にあれば更新）する。
+    行のcode / stdinはcode_blobsへ移してハッシュで参照し、大きな出力は圧縮する（このスレッドで行う）。
+    """
+
+    def __init__(self, session_factory, batch_size=100, flush_interval=0.5, max_queue=10000,
+                 inline_output_bytes=1024, compress_level=1):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.inline_output_bytes = inline_output_bytes
+        self.compress_level = compress_level
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {'written': 0, 'dropped': 0, 'failed': 0, 'batches': 0, 'compressed_outputs': 0,
+                          'blobs_written': 0}
+        # ブロブのハッシュ -> 書き込んだ時刻（ライタースレッドだけが使う）
+        self._known_blobs = collections.OrderedDict()
+        self.insert_time = Histogram(INSERT_TIME_BUCKETS)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def submit(self, row):
+        # キューが溢れた場合は書き込みを諦める（リクエスト処理は止めない）
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            logger.warning('job writer queue full, dropping row')
+            self._count('dropped')
+            return False
+
+    def _drain(self, block):
+        rows = []
+        try:
+            rows.append(self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait())
+            while len(rows) < self.batch_size:
+                rows.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return rows
+
+    def _blob(self, text, blobs, now):
+        # 書き込むブロブをblobsに加えてハッシュを返す（最近書いたものは加えない）
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        written_at = self._known_blobs.get(digest)
+        if written_at is not None and now - written_at < BLOB_TOUCH_INTERVAL / 2:
+            self._known_blobs.move_to_end(digest)
+        elif digest not in blobs:
+            blobs[digest] = encode_blob(text, self.compress_level)
+        return digest
+
+    def _remember_blobs(self, hashes, now):
+        for digest in hashes:
+            self._known_blobs[digest] = now
+            self._known_blobs.move_to_end(digest)
+        while len(self._known_blobs) > KNOWN_BLOBS_MAX:
+            self._known_blobs.popitem(last=False)
+
+    def _encode(self, rows):
+        # submitされた行（created_at / finished_atはUNIX時刻）を保存形式の行と、書き込むブロブにする
+        now = pytime.monotonic()
+        blobs = {}
+        encoded = []
+        compressed = 0
+        for row in rows:
+            row = dict(row)
+            code = row.pop('code')
+            stdin = row.pop('stdin', None) or ''
+            row['code_hash'] = self._blob(code, blobs, now)
+            row['stdin_hash'] = self._blob(stdin, blobs, now) if stdin else None
+            for stream in ('stdout', 'stderr'):
+                full = row.get(f'result_{stream}_compressed')
+                if full is not None:
+                    # 実行中に圧縮済みの出力（OutputCapture）。インライン部分は先頭inline_output_bytesまでで渡される
+                    inline = row.get(f'result_{stream}')
+                else:
+                    inline, full = encode_output(row.get(f'result_{stream}'), self.inline_output_bytes,
+                                                 self.compress_level)
+                row[f'result_{stream}'] = inline
+                row[f'result_{stream}_compressed'] = full
+                compressed += full is not None
+            row['created_at'] = utc_datetime(row.get('created_at'))
+            row['finished_at'] = utc_datetime(row.get('finished_at'))
+            encoded.append(row)
+        return encoded, list(blobs.values()), compressed
+
+    def _write(self, rows):
+        started = pytime.perf_counter()
+        db = self.session_factory()
+        try:
+            encoded, blobs, compressed = self._encode(rows)
+            upsert_blobs(db, blobs, datetime.datetime.now(datetime.timezone.utc))
+            upsert_jobs(db, encoded)
+            db.commit()
+            self._remember_blobs([blob['hash'] for blob in blobs], pytime.monotonic())
+            self.insert_time.observe(pytime.perf_counter() - started)
+            self._count('written', len(rows))
+            self._count('batches')
+            self._count('compressed_outputs', compressed)
+            self._count('blobs_written', len(blobs))
+        except Exception as e:
+            logger.error(f'job writer insert error: {e}', exc_info=True)
+            db.rollback()
+            self._count('failed', len(rows))
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            rows = self._drain(block=True)
+            if rows:
+                self._write(rows)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='job-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # 停止時はキューに残っている行をすべて書き出す
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 10)
+            self._thread = None
+        while True:
+            rows = self._drain(block=False)
+            if not rows:
+                break
+            self._write(rows)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queued'] = self._queue.qsize()
+        stats['insert_time_seconds'] = self.insert_time.snapshot()
+        return stats
+
+
+def archive_record(row, blobs):
+    # アーカイブに書き出す1行（コード・標準入力・出力を復元したもの）
+    code, stdin = job_code(row, blobs)
+    return {
+        'uid': row.uid,
+        'language': row.language,
+        'code': code,
+        'stdin': stdin,
+        'status': row.status,
+        'stdout': stored_output(row, 'stdout'),
+        'stderr': stored_output(row, 'stderr'),
+        'exit_code': row.result_exit_code,
+        'time': row.result_time,
+        'wall_time': row.wall_time,
+        'cpu_user_time': row.cpu_user_time,
+        'cpu_sys_time': row.cpu_sys_time,
+        'max_rss_kb': row.max_rss_kb,
+        'stdout_bytes': row.stdout_bytes,
+        'stderr_bytes': row.stderr_bytes,
+        'timing': json.loads(row.timing) if row.timing else None,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'finished_at': row.finished_at.isoformat() if row.finished_at else None,
+    }
+
+
+class JobRetention:
+    """
+    保持期間（ttl_seconds）を過ぎたcode_jobsの行をinterval秒ごとにbatch_size件ずつ削除するバックグラウンドスレッド。
+    archive_dirを指定すると、削除する行を archive_dir/code_jobs-YYYYMMDD.jsonl.gz に追記してから削除する。
+    どのジョブからも参照されなくなり、last_used_atが保持期間を過ぎたcode_blobsも削除する。
+    """
+
+    def __init__(self, session_factory, enabled=False, ttl_seconds=30 * 86400, interval=3600, batch_size=1000,
+                 archive_dir=None):
+        self.session_factory = session_factory
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {'runs': 0, 'deleted_jobs': 0, 'archived_jobs': 0, 'deleted_blobs': 0, 'failed_runs': 0}
+        self.last_run_at = None
+        self.configure(enabled, ttl_seconds, interval, batch_size, archive_dir)
+
+    def configure(self, enabled=False, ttl_seconds=30 * 86400, interval=3600, batch_size=1000, archive_dir=None):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.archive_dir = archive_dir
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _archive(self, db, rows):
+        blobs = load_blobs(db, [h for row in rows for h in (row.code_hash, row.stdin_hash)])
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f'code_jobs-{datetime.date.today():%Y%m%d}.jsonl.gz')
+        # gzipは追記するとメンバーが連結され、そのまま続けて読める
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(archive_record(row, blobs), ensure_ascii=False) + '\n')
+
+    def _delete_jobs(self, cutoff):
+        # 1バッチ分を（アーカイブしてから）削除し、件数を返す
+        db = self.session_factory()
+        try:
+            rows = (db.query(CodeJob)
+                    .filter(CodeJob.created_at < cutoff)
+                    .order_by(CodeJob.created_at)
+                    .limit(self.batch_size)
+                    .all())
+            if not rows:
+                return 0
+            if self.archive_dir:
+                self._archive(db, rows)
+                self._count('archived_jobs', len(rows))
+            db.query(CodeJob).filter(CodeJob.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            db.commit()
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _delete_blobs(self, cutoff):
+        db = self.session_factory()
+        try:
+            hashes = db.scalars(
+                select(CodeBlob.hash)
+                .where(CodeBlob.last_used_at < cutoff,
+                       ~exists().where(CodeJob.code_hash == CodeBlob.hash),
+                       ~exists().where(CodeJob.stdin_hash == CodeBlob.hash))
+                .limit(self.batch_size)).all()
+            if not hashes:
+                return 0
+            # 選んだ後に新しいジョブから参照された（last_used_atが更新された）ブロブは残す
+            deleted = (db.query(CodeBlob)
+                       .filter(CodeBlob.hash.in_(hashes), CodeBlob.last_used_at < cutoff)
+                       .delete(synchronize_session=False))
+            db.commit()
+            return deleted
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def run_once(self):
+        """保持期間切れの行・ブロブをすべて削除し、削除件数を返す（ブロッキング）"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(seconds=self.ttl_seconds)
+        # 使用中のブロブはlast_used_atをBLOB_TOUCH_INTERVALごとにしか更新しないため、それより古いものだけを対象にする
+        blob_cutoff = min(cutoff, now - datetime.timedelta(seconds=2 * BLOB_TOUCH_INTERVAL))
+        deleted = {'jobs': 0, 'blobs': 0}
+        while not self._stop.is_set():
+            count = self._delete_jobs(cutoff)
+            deleted['jobs'] += count
+            if count < self.batch_size:
+                break
+        while not self._stop.is_set():
+            count = self._delete_blobs(blob_cutoff)
+            deleted['blobs'] += count
+            if count < self.batch_size:
+                break
+        self._count('runs')
+        self._count('deleted_jobs', deleted['jobs'])
+        self._count('deleted_blobs', deleted['blobs'])
+        self.last_run_at = pytime.time()
+        return deleted
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.enabled:
+                continue
+            try:
+                deleted = self.run_once()
+                if deleted['jobs'] or deleted['blobs']:
+                    logger.info(f"job retention deleted {deleted['jobs']} jobs, {deleted['blobs']} blobs")
+            except Exception as e:
+                logger.error(f'job retention error: {e}', exc_info=True)
+                self._count('failed_runs')
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='job-retention', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['enabled'] = self.enabled
+        stats['ttl_seconds'] = self.ttl_seconds
+        stats['last_run_at'] = self.last_run_at
+        return stats
@@ -0,0 +1,99 @@
+import copy
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+
+# コンパイル型言語のrunnerのエントリポイント（runner/run_native.py）
+NATIVE_ENTRYPOINT = 'python3 /home/runner/run_native.py'
+# コンパイルの制限（wall・cpuは秒、fsizeは書き込めるファイルサイズ）
+DEFAULT_COMPILE_LIMITS = {'wall': 30, 'cpu': 30, 'fsize': 64 * 1024 * 1024}
+
+
+class Language:
+    """
+    言語プラグイン。runnerイメージとエントリポイント、コンパイル型ならコンパイル手順（ソースのファイル名・
+    コンパイラ・フラグ・成果物）と実行コマンド、言語ごとに上書きする実行時の制限値（runner_limitsのキー）を持つ。
+    """
+
+    def __init__(self, name, image, entrypoint, compiler=None, flags=(), libs=(), source=None, artifact='main',
+                 run=None, compile_limits=None, limits=None):
+        self.name = name
+        self.image = image
+        self.entrypoint = entrypoint
+        self.compiler = compiler
+        self.flags = list(flags)
+        # リンクするライブラリ（ソースより後ろに置く必要があるためflagsと分ける）
+        self.libs = list(libs)
+        self.source = source
+        self.artifact = artifact
+        self.run = list(run) if run else [f'./{artifact}']
+        self.compile_limits = {**DEFAULT_COMPILE_LIMITS, **(compile_limits or {})}
+        self.limits = dict(limits or {})
+
+    @property
+    def compiled(self):
+        return self.compiler is not None
+
+    def compile_command(self):
+        return [self.compiler, *self.flags, '-o', self.artifact, self.source, *self.libs]
+
+    def build_spec(self):
+        # ランナーへ渡すコンパイル手順（run_native.pyの "build"）
+        return {'source': self.source, 'command': self.compile_command(), 'artifact': self.artifact,
+                'limits': dict(self.compile_limits)}
+
+    def configured(self, settings):
+        # config.yamlのlanguages.<name>で上書きしたコピー
+        language = copy.deepcopy(self)
+        for key in ('image', 'entrypoint', 'compiler', 'flags', 'libs', 'run'):
+            if settings.get(key) is not None:
+                setattr(language, key, settings[key])
+        language.compile_limits.update(settings.get('compile_limits') or {})
+        language.limits.update(settings.get('limits') or {})
+        return language
+
+
+BUILTIN_LANGUAGES = [
+    Language('python', 'runner-python:latest', './run.py'),
+    Language('node', 'runner-node:latest', 'node /home/runner/run.js'),
+    Language('c', 'runner-gcc:latest', NATIVE_ENTRYPOINT, compiler='gcc', flags=['-O2', '-std=gnu17', '-pipe'],
+             libs=['-lm'], source='main.c'),
+    Language('cpp', 'runner-gcc:latest', NATIVE_ENTRYPOINT, compiler='g++', flags=['-O2', '-std=gnu++17', '-pipe'],
+             source='main.cpp'),
+]
+
+
+class LanguageRegistry:
+    """
+    実行できる言語の一覧。組み込みの言語（BUILTIN_LANGUAGES）とregisterで追加した言語に、
+    config.yamlのlanguagesの設定（enabled: falseで無効、image・flagsなどの上書き）を反映する。
+    """
+
+    def __init__(self, languages=BUILTIN_LANGUAGES):
+        self._plugins = {language.name: language for language in languages}
+        self._languages = dict(self._plugins)
+
+    def register(self, language):
+        self._plugins[language.name] = language
+        self._languages[language.name] = language
+
+    def configure(self, config):
+        settings = config.get('languages', {}) or {}
+        languages = {}
+        for name, plugin in self._plugins.items():
+            entry = settings.get(name) or {}
+            if entry.get('enabled', True):
+                languages[name] = plugin.configured(entry)
+        for name in settings:
+            if name not in self._plugins:
+                logger.warning(f'languages.{name}: unknown language (no plugin registered)')
+        self._languages = languages
+
+    def get(self, name):
+        return self._languages.get(name)
+
+    def names(self):
+        return list(self._languages)
+
+
+LANGUAGES = LanguageRegistry()
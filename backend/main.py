@@ -1,23 +1,71 @@
 import os
 import json
+import asyncio
 import yaml
 import threading
+import uuid
 import time as pytime
-from fastapi import FastAPI, HTTPException
+from datetime import datetime
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from models import CodeJob
 from db import SessionLocal
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Literal
-import docker
+from typing import List, Literal, Optional
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+from pool import ContainerPool
+from jobstore import JobRetention, JobWriter, job_code, list_jobs, load_blobs, stored_output
+from scheduler import JobScheduler, QueueFullError, QueueTimeoutError
+from jobs import Job, JobRegistry, OutputLimitExceeded
+from cache import ResultCache, result_cache_key
+from runtime import RuntimeContext, runner_image
+from languages import LANGUAGES
+from artifacts import ArtifactCache, artifact_cache_key
+from output import preview_text
+from compression import CompressionMiddleware, ResponseCompressor
+from hosts import HostRegistry
+from preflight import NodeSyntaxChecker, Preflight, python_syntax_check
+from reconciler import Reconciler, container_labels
+from ratelimit import LocalBackend, RateLimiter, RedisBackend, client_identity
+from metrics import CallbackMetric, LabeledCounter, LabeledHistogram, Timing, render_prometheus
+import base64
+import math
+import signal
+import socket
 import logging
 import sys
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.INFO)
 
 load_dotenv()
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    # 起動時にイメージ情報を読み込み、ウォームプールの補充スレッドとジョブ書き込みスレッドを開始する
+    await asyncio.to_thread(host_registry.warm, list(container_pool.sizes))
+    # 前回のプロセスが残したrunnerコンテナと実行中だったジョブを片付けてからプールを補充する
+    if reconciler.enabled:
+        await asyncio.to_thread(reconciler.recover)
+    job_writer.start()
+    job_retention.start()
+    container_pool.start()
+    reconciler.start()
+    await node_syntax_check.warm()
+    try:
+        # SIGHUPで設定・実行環境を再読込する
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_runtime)
+    except (NotImplementedError, RuntimeError, ValueError):
+        pass
+    yield
+    reconciler.stop()
+    container_pool.stop()
+    job_retention.stop()
+    job_writer.stop()
+    await node_syntax_check.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,65 +75,174 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-with open(os.path.join(os.path.dirname(__file__), 'config.yaml'), 'r') as f:
-    config = yaml.safe_load(f)
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.yaml')
+
+def load_config():
+    with open(CONFIG_PATH, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+config = load_config()
 debug_log_keep = config.get('debug_log_keep', False)
 rate_limit_per_minute = config.get('rate_limit_per_minute', 30)
-rate_limit_lock = threading.Lock()
-rate_limit_times = []
+rate_limit_config = config.get('rate_limit', {}) or {}
+pool_config = config.get('pool', {}) or {}
+job_writer_config = config.get('job_writer', {}) or {}
+job_retention_config = config.get('job_retention', {}) or {}
+scheduler_config = config.get('scheduler', {}) or {}
+jobs_config = config.get('jobs', {}) or {}
+result_cache_config = config.get('result_cache', {}) or {}
+fork_server_config = config.get('python_fork_server', {}) or {}
+node_runner_config = config.get('node_runner', {}) or {}
+preflight_config = config.get('preflight', {}) or {}
+artifact_cache_config = config.get('artifact_cache', {}) or {}
+compression_config = config.get('response_compression', {}) or {}
+reconciler_config = config.get('reconciler', {}) or {}
+# このバックエンドのインスタンスID（runnerコンテナのラベルとcode_jobs.instance_idに使う。再起動後も同じ値にすること）
+instance_id = config.get('instance_id') or os.getenv('RUNNER_INSTANCE_ID') or socket.gethostname()
+# 1回の実行の最大CPU時間（秒）
+max_exec_time = config.get('max_exec_time', 10)
+# 出力サイズの上限（実行中に超過した時点で打ち切り、exit_code=1002）
+output_limits = {
+    'stdout': config.get('max_stdout_bytes', 1048576),
+    'stderr': config.get('max_stderr_bytes', 1048576),
+}
+# ジョブの出力の持ち方（応答のプレビューに残す先頭・末尾のバイト数、全体の圧縮レベル、SSEで再送できる直近のバイト数）
+output_capture = {
+    'head_bytes': 65536,
+    'tail_bytes': 16384,
+    'compress_level': 1,
+    'stream_buffer_bytes': 262144,
+    **(config.get('output_capture', {}) or {}),
+}
+# /run/batch の1リクエストあたりの最大テストケース数
+max_batch_cases = config.get('max_batch_cases', 100)
+# ランナーが実行時間の上限を過ぎても応答しない場合に待つ猶予（秒、超過時はコンテナごと破棄）
+runner_wait_grace = 5
+# ランナーが打ち切った場合の終了コードとメッセージ
+LIMIT_MESSAGES = {
+    1001: 'Time limit exceeded',
+    1002: 'Output limit exceeded',
+}
 
 class CodeRequest(BaseModel):
-    language: Literal['python', 'node']
+    # languages.pyに登録された言語（config.yamlのlanguagesで無効にしたものは除く）
+    language: str
     code: str
     stdin: str = ''
+    # Trueなら大きな出力は先頭・末尾だけのプレビューで返す（全体は /jobs/{job_id}/output/{stream} から）
+    preview: bool = False
 
 class CodeResponse(BaseModel):
     stdout: str
     stderr: str
     exit_code: int
+    # 実行時間（コンパイル型言語ではコンパイルを含まない）
     time: float
+    # コンパイル時間（コンパイル型言語のみ。キャッシュ済みの実行ファイルを使った場合は0）
+    compile_time: Optional[float] = None
+    # 出力の合計バイト数（プレビューで省略した部分を含む）
+    stdout_bytes: Optional[int] = None
+    stderr_bytes: Optional[int] = None
+    # stdout / stderrが先頭・末尾だけのプレビュー（省略した部分にはマーカーが入る）
+    truncated: bool = False
+    # 出力全体の取得に使うジョブID（GET /jobs/{job_id}/output/{stream}、Rangeで分割取得できる）
+    job_id: Optional[str] = None
     debug: dict = {}
 
-def check_rate_limit():
-    # 1分間のAPIリクエスト回数制限
-    now = pytime.time()
-    with rate_limit_lock:
-        global rate_limit_times
-        rate_limit_times[:] = [t for t in rate_limit_times if now-t < 60]
-        if len(rate_limit_times) >= rate_limit_per_minute:
-            return False
-        rate_limit_times.append(now)
-    return True
+class BatchCase(BaseModel):
+    stdin: str = ''
+    # 指定した場合は標準出力と比較してpassedを返す（行末の空白・末尾の空行は無視）
+    expected_stdout: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    language: str
+    code: str
+    cases: List[BatchCase]
+    # 最初の失敗（exit_code!=0 または期待出力との不一致）で残りのケースを打ち切る
+    stop_on_failure: bool = False
+
+class BatchCaseResult(BaseModel):
+    stdout: str
+    stderr: str
+    exit_code: int
+    time: float
+    passed: Optional[bool] = None
+    debug: dict = {}
+
+class BatchResponse(BaseModel):
+    # ケースと同じ順序。打ち切りで実行しなかったケースはnull
+    results: List[Optional[BatchCaseResult]]
+    skipped: int
+    stderr: str = ''
+    exit_code: int
+    time: float
+    compile_time: Optional[float] = None
+    debug: dict = {}
+
+class JobStatus(BaseModel):
+    job_id: str
+    language: str
+    status: str
+    result: Optional[CodeResponse] = None
+    # include_code=true のときだけ返す
+    code: Optional[str] = None
+    stdin: Optional[str] = None
+
+class JobSummary(BaseModel):
+    # ジョブ一覧の1件（コード・出力の本文は含めない）
+    job_id: str
+    language: str
+    status: str
+    exit_code: Optional[int] = None
+    time: Optional[float] = None
+    stdout_bytes: Optional[int] = None
+    stderr_bytes: Optional[int] = None
+    created_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+class JobList(BaseModel):
+    jobs: List[JobSummary]
+    # 次のページを取得するときに cursor に渡す（最後のページならnull）
+    next_cursor: Optional[str] = None
+
+def create_rate_limit_backend(settings):
+    # 共有バックエンド（Redis）が使えなければプロセス内のバケットで続行する
+    if settings.get('backend') == 'redis':
+        try:
+            return RedisBackend(
+                settings.get('redis_url', 'redis://redis:6379/0'),
+                idle_seconds=settings.get('idle_seconds', 600),
+                running_ttl=settings.get('running_ttl', 600),
+            )
+        except Exception as e:
+            logger.warning(f'rate limit backend (redis) unavailable, using local buckets: {e}')
+    return LocalBackend(
+        idle_seconds=settings.get('idle_seconds', 600),
+        max_clients=settings.get('max_clients', 100000),
+    )
+
+def rate_limit_settings():
+    # RateLimiter.configureに渡す設定（rate_limit_per_minuteが0以下ならValueError）
+    return {
+        'rate_per_minute': rate_limit_per_minute,
+        'burst': rate_limit_config.get('burst'),
+        'max_concurrent': rate_limit_config.get('max_concurrent_jobs', 4),
+        'api_keys': rate_limit_config.get('api_keys'),
+    }
+
+rate_limiter = RateLimiter(create_rate_limit_backend(rate_limit_config), **rate_limit_settings())
 
 def check_request_size(code: str) -> bool:
     # リクエストボディ（コード）のサイズ制限
-    max_request_body_size = config.get('max_request_body_size', 1048576)
-    return len(code.encode('utf-8')) <= max_request_body_size
+    return len(code.encode('utf-8')) <= runtime.max_request_body_size
 
 def check_code_length(code: str) -> bool:
     # コード文字数の制限
-    max_code_length = config.get('max_code_length', 10000)
-    return len(code) <= max_code_length
-
-
-def get_resource_limits(image):
-    # Dockerイメージの環境変数からメモリ・CPU制限値を取得
-    image_env = image.attrs.get('Config', {}).get('Env', [])
-    mem_limit = None
-    cpu_limit = None
-    for env_var in image_env:
-        if env_var.startswith('CONTAINER_MAX_MEM='):
-            mem_limit = env_var.split('=')[1]
-        elif env_var.startswith('CONTAINER_MAX_CPU='):
-            try:
-                cpu_limit = float(env_var.split('=')[1])
-            except Exception:
-                cpu_limit = None
-    if not mem_limit:
-        mem_limit = '512m'
-    if not cpu_limit:
-        cpu_limit = 1.0
-    return mem_limit, cpu_limit
+    return len(code) <= runtime.max_code_length
+
+runtime = RuntimeContext(config)
+# runnerコンテナを起動するDockerエンドポイント（runner_hosts未設定ならバックエンド自身のDockerのみ）
+host_registry = HostRegistry(config, runtime)
 
 def safe_read(path):
     # ファイル読み込み（失敗時は空文字列返却）
@@ -94,112 +251,1134 @@ def safe_read(path):
             return f.read()
     except Exception:
         return ''
-@app.get("/")
-def root():
-    return {"status": "OK"}
- 
 
-@app.post("/run", response_model=CodeResponse)
-def run_code(req: CodeRequest):
-    if not check_rate_limit():
-        return CodeResponse(stdout='', stderr='Rate limit exceeded', exit_code=2001, time=-1, debug={})
+# 言語ごとのイメージ・エントリポイント・コンパイル手順（config.yamlのlanguagesで上書き・無効化）
+LANGUAGES.configure(config)
+
+def runner_command(language):
+    # fork-serverモードのPythonランナーには事前importするモジュールも渡す
+    command = ['--serve']
+    if language == 'python' and fork_server_config.get('enabled', False):
+        command.append('--fork-server')
+        command += ['--preload', ','.join(fork_server_config.get('preload') or [])]
+    return command
+
+def runner_limits(language=None):
+    # ランナーが実行中に適用する制限（wall・stdout・stderr）と、子プロセスに設定するrlimit（言語ごとの上書きを含む）
+    plugin = LANGUAGES.get(language)
+    return {
+        'wall': max_exec_time,
+        'stdout': output_limits['stdout'],
+        'stderr': output_limits['stderr'],
+        'cpu': max_exec_time,
+        'as': fork_server_config.get('address_space_bytes', 536870912),
+        'nofile': fork_server_config.get('open_files', 64),
+        'fsize': output_limits['stdout'],
+        'heap_mb': node_runner_config.get('heap_mb', 256),
+        **(plugin.limits if plugin is not None else {}),
+    }
+
+def runner_deadline(rounds=1, compile_seconds=0):
+    # ランナー自身がmax_exec_time（コンパイルはcompile_limitsのwall）で打ち切るため、応答待ちはそれに猶予を足した時間まで
+    return pytime.monotonic() + max_exec_time * rounds + compile_seconds + runner_wait_grace
+
+def with_limit_message(stderr, exit_code):
+    message = LIMIT_MESSAGES.get(exit_code)
+    return stderr + '\n' + message if message else stderr
+
+def job_response(job, exit_code, time, debug=None, compile_time=None):
+    """
+    ジョブの出力から結果を作る。stdout / stderrはプレビュー（先頭・末尾。収まる出力は全体）で、
+    全体はfull_resultで戻すか /jobs/{job_id}/output/{stream} から取得する。制限超過のメッセージは標準エラー出力に追記する
+    """
+    message = LIMIT_MESSAGES.get(exit_code)
+    if message:
+        job.append_message('stderr', '\n' + message)
+    output_bytes = job.output_bytes
+    return CodeResponse(
+        stdout=job.preview('stdout'),
+        stderr=job.preview('stderr'),
+        exit_code=exit_code,
+        time=time,
+        compile_time=compile_time,
+        stdout_bytes=output_bytes['stdout'],
+        stderr_bytes=output_bytes['stderr'],
+        truncated=job.truncated,
+        job_id=job.id,
+        debug=debug or {},
+    )
+
+def full_result(job, res):
+    # プレビューで返した結果の出力を全体に戻す（preview=falseの応答用）
+    if res is None or not res.truncated:
+        return res
+    return res.model_copy(update={'stdout': job.output('stdout'), 'stderr': job.output('stderr'), 'truncated': False})
+
+def create_runner_container(host, language):
+    # 標準入力からジョブを待ち受けるrunnerコンテナを指定したホストに作成
+    # host_configはホスト・イメージごとに組み立て済みのものを使う（runnerはネットワークなし）
+    container = host.runtime.client.api.create_container(
+        image=runner_image(language),
+        entrypoint=LANGUAGES.get(language).entrypoint,
+        command=runner_command(language),
+        host_config=host.runtime.image_info(language).host_config,
+        stdin_open=True,
+        detach=True,
+        labels=container_labels(instance_id, language),
+    )
+    return container.get('Id')
+
+container_pool = ContainerPool(
+    host_registry,
+    create_runner_container,
+    pool_config.get('sizes', {}),
+    max_idle_seconds=pool_config.get('max_idle_seconds', 300),
+    max_jobs_per_container=pool_config.get('max_jobs_per_container', 50),
+    refill_interval=pool_config.get('refill_interval', 5.0),
+)
+
+job_writer = JobWriter(
+    SessionLocal,
+    batch_size=job_writer_config.get('batch_size', 100),
+    flush_interval=job_writer_config.get('flush_interval', 0.5),
+    max_queue=job_writer_config.get('max_queue', 10000),
+    inline_output_bytes=job_writer_config.get('inline_output_bytes', 1024),
+    compress_level=job_writer_config.get('compress_level', 1),
+)
+
+job_retention = JobRetention(
+    SessionLocal,
+    enabled=job_retention_config.get('enabled', False),
+    ttl_seconds=job_retention_config.get('ttl_seconds', 30 * 86400),
+    interval=job_retention_config.get('interval', 3600),
+    batch_size=job_retention_config.get('batch_size', 1000),
+    archive_dir=job_retention_config.get('archive_dir'),
+)
+
+job_scheduler = JobScheduler(
+    max_concurrency=scheduler_config.get('max_concurrency', 8),
+    per_language=scheduler_config.get('per_language', {}),
+    max_queue_depth=scheduler_config.get('max_queue_depth', 100),
+    max_queue_wait=scheduler_config.get('max_queue_wait', 30),
+)
+
+job_registry = JobRegistry(
+    ttl_seconds=jobs_config.get('ttl_seconds', 600),
+    max_jobs=jobs_config.get('max_jobs', 1000),
+)
+
+# 孤立・期限超過のrunnerコンテナと、結果が失われたジョブの行を片付ける
+reconciler = Reconciler(
+    host_registry,
+    container_pool,
+    SessionLocal,
+    instance_id,
+    job_registry.active_ids,
+    enabled=reconciler_config.get('enabled', True),
+    interval=reconciler_config.get('interval', 5),
+    orphan_grace=reconciler_config.get('orphan_grace', 60),
+    deadline_grace=reconciler_config.get('deadline_grace', 10),
+    stale_after=reconciler_config.get('stale_after', 3600),
+)
+
+# 処理段階ごとの所要時間（秒）のヒストグラム境界
+PHASE_TIME_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# kind: run（/run・/jobs）/ batch（/run/batch）
+job_phase_time = LabeledHistogram(['kind', 'language', 'phase'], PHASE_TIME_BUCKETS)
+jobs_total = LabeledCounter(['kind', 'language', 'exit_code'])
+
+# コンテナを使う前の事前検査（構文チェック）。言語ごとに検査を追加できる
+preflight = Preflight(
+    enabled=preflight_config.get('enabled', True),
+    max_entries=preflight_config.get('max_entries', 10000),
+    disabled=[lang for lang, on in (preflight_config.get('languages', {}) or {}).items() if not on],
+)
+node_syntax_check = NodeSyntaxChecker(
+    size=preflight_config.get('node_helpers', 2),
+    timeout=preflight_config.get('node_timeout', 2.0),
+)
+preflight.register('python', 'syntax', python_syntax_check)
+preflight.register('node', 'syntax', node_syntax_check)
+
+async def run_preflight(language, code, timing):
+    # 不合格なら(検査名, エラーメッセージ)、通過ならNoneを返す
+    with timing.span('preflight'):
+        return await preflight.check(language, code)
+
+def observe_job(kind, language, res, timing):
+    # 処理段階ごとの所要時間をdebug['timing']に入れ、ヒストグラムと終了コードのカウンタへ集計する
+    # （登録されていない言語名はラベルの値が増え続けないようまとめる）
+    if LANGUAGES.get(language) is None:
+        language = 'unsupported'
+    timing.finish()
+    res.debug['timing'] = timing.as_dict()
+    for phase, seconds in timing.spans.items():
+        job_phase_time.labels(kind, language, phase).observe(seconds)
+    jobs_total.inc(kind, language, str(res.exit_code))
+
+async def execute_in_runner(job):
+    # 実行スロットを確保してからrunnerへジョブを渡す（キュー満杯・待ち時間超過は即座に返す）
+    queued_at = pytime.perf_counter()
+    try:
+        async with job_scheduler.slot(job.language):
+            job.timing.add('queue_wait', pytime.perf_counter() - queued_at)
+            job.mark_running()
+            persist_job(job)
+            return await run_on_runner(job)
+    except QueueFullError:
+        return CodeResponse(stdout='', stderr='Queue full', exit_code=2004, time=-1, debug={})
+    except QueueTimeoutError:
+        job.timing.add('queue_wait', pytime.perf_counter() - queued_at)
+        return CodeResponse(stdout='', stderr='Queue wait timeout', exit_code=2005, time=-1, debug={})
+
+async def acquire_runner(language, timing):
+    # プールにウォームなrunnerがあればそれを、なければ新規に起動する（起動時のDocker API呼び出しも計測に含める）
+    with timing.span('acquire'):
+        runner = container_pool.acquire_idle(language)
+        if runner is None:
+            runner = await asyncio.to_thread(container_pool.spawn_for, language)
+            for call, seconds in runner.spawn_timing.items():
+                timing.add(call, seconds)
+    return runner
+
+async def prepare_build(language, code, timing, host):
+    """
+    コンパイル型言語なら、ランナーへ渡すジョブに加えるフィールドと、実行ファイルのキャッシュキーを返す。
+    キャッシュキーには実行するホスト（host）のイメージIDを使う。
+    キャッシュ済みの実行ファイルがあれば "binary"（ランナーはコンパイルしない）、なければ "build"（コンパイル手順）
+    """
+    plugin = LANGUAGES.get(language)
+    if plugin is None or not plugin.compiled:
+        return {}, None
+    fields = {'run': plugin.run}
+    key = None
+    if artifact_cache.enabled:
+        with timing.span('artifact_lookup'):
+            try:
+                info = await image_info(language, host)
+                key = artifact_cache_key(language, info.image_id, code, plugin.compile_command())
+                binary = await asyncio.to_thread(artifact_cache.get, key)
+            except Exception as e:
+                logger.warning(f'artifact cache lookup failed: {e}')
+                binary = None
+        if binary is not None:
+            fields['binary'] = base64.b64encode(binary).decode('ascii')
+            return fields, key
+    fields['build'] = plugin.build_spec()
+    return fields, key
+
+def build_deadline(fields, rounds=1):
+    return runner_deadline(rounds, fields['build']['limits'].get('wall', 0) if 'build' in fields else 0)
+
+async def on_compile_frame(frame, key, timing):
+    # コンパイル結果を応答用にまとめ、実行ファイルはキャッシュに入れる。コンパイル時間は処理段階 'compile' にも入れる
+    timing.add('compile', frame.get('time') or 0.0)
+    if key is not None and frame.get('exit_code') == 0 and frame.get('artifact'):
+        try:
+            await asyncio.to_thread(artifact_cache.put, key, base64.b64decode(frame['artifact']))
+        except Exception as e:
+            logger.warning(f'artifact cache store failed: {e}')
+    return {'cached': False, 'time': frame.get('time') or 0.0, 'exit_code': frame.get('exit_code')}
+
+def cached_compile(fields):
+    # キャッシュ済みの実行ファイルを使う場合のコンパイル結果（コンパイル型言語でなければNone）
+    return {'cached': True, 'time': 0.0} if 'binary' in fields else None
+
+async def run_on_runner(job):
+    # runnerコンテナへコードと標準入力を渡し、出力チャンクをジョブへ逐次追記しながら結果フレームを待つ
+    try:
+        runner = await acquire_runner(job.language, job.timing)
+    except Exception as e:
+        return CodeResponse(stdout='', stderr=f'create_container error: {str(e)}', exit_code=9001, time=-1, debug={})
+    job.host = runner.host
+    fields, artifact_key = await prepare_build(job.language, job.code, job.timing, runner.host)
+    compile_info = cached_compile(fields)
+    ok = False
+    deadline = build_deadline(fields)
+    runner.job_id, runner.deadline = job.id, deadline
+    try:
+        with job.timing.span('send'):
+            await runner.channel.send_job({
+                'code': job.code, 'stdin': job.stdin, 'limits': runner_limits(job.language), **fields})
+        with job.timing.span('execute'):
+            while True:
+                frame = await runner.channel.read_frame(timeout=deadline - pytime.monotonic())
+                if frame.get('type') == 'result':
+                    break
+                if frame.get('type') == 'compile':
+                    compile_info = await on_compile_frame(frame, artifact_key, job.timing)
+                    if frame.get('exit_code') != 0:
+                        # コンパイルエラーはコンパイラの出力を標準エラー出力として返す
+                        job.append_output('stderr', frame.get('output') or '')
+                    continue
+                job.append_output(frame.get('type'), frame.get('data') or '')
+        ok = True
+    except OutputLimitExceeded:
+        # 出力上限に達したジョブは実行途中のコンテナごと破棄する
+        return job_response(job, 1002, -1)
+    except asyncio.TimeoutError:
+        # ランナーが制限時間内に打ち切れなかった（応答しない）
+        return job_response(job, 1001, -1)
+    except Exception as e:
+        if runner.reaped:
+            # 期限を過ぎてもランナーが応答せず、リコンサイラがコンテナを削除した
+            return job_response(job, 1001, -1)
+        logger.error(f'runner error: {e!r}')
+        return CodeResponse(stdout='', stderr='wait_container error', exit_code=9003, time=-1, debug={})
+    finally:
+        container_pool.release(runner, ok)
+    debug = {'host': runner.host.name}
+    if frame.get('usage'):
+        debug['usage'] = frame['usage']
+    if compile_info is not None:
+        debug['compile'] = compile_info
+    try:
+        exit_code, elapsed = frame['exit_code'], frame['time']
+    except Exception:
+        return CodeResponse(stdout='', stderr='No result from runner', exit_code=9999, time=-1, debug={})
+    return job_response(job, exit_code, elapsed, debug,
+                        compile_time=compile_info['time'] if compile_info is not None else None)
+
+async def image_info(language, host=None):
+    # hostのイメージ情報（省略時は振り分け先として最も空いているホスト。確認期限内ならDocker APIを呼ばずに返す）
+    host_runtime = (host or host_registry.primary()).runtime
+    info = host_runtime.cached_image_info(language)
+    if info is not None:
+        return info
+    return await asyncio.to_thread(host_runtime.image_info, language)
+
+# コンパイル済み実行ファイルのキャッシュ（ソース・コンパイルコマンド・イメージIDごと、ローカルのボリュームに置く）
+artifact_cache = ArtifactCache(
+    directory=artifact_cache_config.get('dir'),
+    enabled=artifact_cache_config.get('enabled', True),
+    max_bytes=artifact_cache_config.get('max_bytes', 512 * 1024 * 1024),
+)
+
+# 大きな応答本文の圧縮（Accept-Encodingに応じてbr / gzip。SSEなど逐次送る応答は圧縮しない）
+response_compressor = ResponseCompressor(
+    enabled=compression_config.get('enabled', True),
+    minimum_size=compression_config.get('minimum_size', 4096),
+    gzip_level=compression_config.get('gzip_level', 6),
+    brotli_quality=compression_config.get('brotli_quality', 4),
+    use_brotli=compression_config.get('brotli', True),
+)
+app.add_middleware(CompressionMiddleware, compressor=response_compressor)
+
+result_cache = ResultCache(
+    SessionLocal,
+    enabled=result_cache_config.get('enabled', False),
+    max_entries=result_cache_config.get('max_entries', 1000),
+    max_bytes=result_cache_config.get('max_bytes', 64 * 1024 * 1024),
+    ttl_seconds=result_cache_config.get('ttl_seconds', 3600),
+    persistent=result_cache_config.get('persistent', False),
+)
+
+async def cache_key_for(job, host=None):
+    # イメージを再ビルドするとIDが変わり、古いキャッシュは自然に使われなくなる
+    # 検索は振り分け先になりそうなホスト、保存は実際に実行したホスト（host）のイメージで行う
+    try:
+        info = await image_info(job.language, host)
+    except Exception as e:
+        logger.warning(f'image lookup for result cache failed: {e}')
+        return None
+    limits = {
+        'mem_limit': info.mem_limit,
+        'cpu_limit': info.cpu_limit,
+        'output': output_limits,
+        'timeout': max_exec_time,
+        'rlimits': runner_limits(job.language),
+    }
+    plugin = LANGUAGES.get(job.language)
+    if plugin is not None and plugin.compiled:
+        limits['compile'] = plugin.compile_command()
+    return result_cache_key(job.language, info.image_id, job.code, job.stdin, limits)
+
+async def lookup_cached_result(job, cache_key):
+    cached = result_cache.get(cache_key)
+    if cached is None and result_cache.persistent:
+        try:
+            cached = await asyncio.to_thread(result_cache.load, cache_key)
+        except Exception as e:
+            logger.warning(f'result cache lookup failed: {e}')
+    if cached is None:
+        return None
+    # ストリーム購読者にもキャッシュ済みの出力を流す
+    try:
+        for stream in ('stdout', 'stderr'):
+            if cached[stream]:
+                job.append_output(stream, cached[stream])
+    except OutputLimitExceeded:
+        return None
+    return job_response(job, cached['exit_code'], cached['time'], {'cache': 'hit'})
+
+def usage_columns(usage):
+    # ランナーが返したリソース使用量をcode_jobsの列へ対応づける
+    usage = usage or {}
+    return {
+        'wall_time': usage.get('wall_time'),
+        'cpu_user_time': usage.get('cpu_user'),
+        'cpu_sys_time': usage.get('cpu_sys'),
+        'max_rss_kb': usage.get('max_rss_kb'),
+        'stdout_bytes': usage.get('stdout_bytes'),
+        'stderr_bytes': usage.get('stderr_bytes'),
+    }
+
+def output_columns(job, res):
+    # 結果の出力の列。プレビューにした出力は、実行中に圧縮した全体（OutputCapture）をそのまま保存する
+    columns = {}
+    for stream in ('stdout', 'stderr'):
+        capture = job.outputs[stream]
+        if res is not None and res.truncated and capture.truncated:
+            columns[f'result_{stream}'] = capture.head(job_writer.inline_output_bytes)
+            columns[f'result_{stream}_compressed'] = capture.compressed()
+        else:
+            columns[f'result_{stream}'] = getattr(res, stream) if res is not None else None
+    return columns
+
+def job_row(job, res=None, cache_key=None):
+    # code_jobsの1行（未終了のジョブは結果の列が空）。どの状態でも同じ列を持たせる
+    debug = res.debug if res is not None else {}
+    return {
+        'uid': job.id,
+        'cache_key': cache_key,
+        'language': job.language,
+        'code': job.code,
+        'stdin': job.stdin,
+        'status': job.status,
+        'instance_id': instance_id,
+        **output_columns(job, res),
+        'result_exit_code': res.exit_code if res is not None else None,
+        'result_time': res.time if res is not None else None,
+        **usage_columns(debug.get('usage')),
+        'timing': json.dumps(debug['timing']) if debug.get('timing') else None,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+    }
+
+def persist_job(job):
+    # 受付時・実行開始時の状態をcode_jobsへ書く（再起動後に実行中だったジョブをlostにできるように）
+    job_writer.submit(job_row(job))
+
+def record_job(job, res, cache_key=None):
+    # 実行結果をcode_jobsへ非同期に保存（バッチライター経由。受付時に書いた行を更新する）
+    job_writer.submit(job_row(job, res, cache_key))
+
+async def run_job(job):
+    failure = await run_preflight(job.language, job.code, job.timing)
+    if failure is not None:
+        # 構文エラーはランナーで実行した場合と同じく exit_code=1 で返す
+        name, error = failure
+        res = CodeResponse(stdout='', stderr=error, exit_code=1, time=-1, debug={'preflight': name})
+        observe_job('run', job.language, res, job.timing)
+        job.finish(res)
+        record_job(job, res)
+        return res
+    cache_key = None
+    if result_cache.enabled:
+        with job.timing.span('cache_lookup'):
+            cache_key = await cache_key_for(job)
+            cached = await lookup_cached_result(job, cache_key) if cache_key else None
+        if cached is not None:
+            observe_job('run', job.language, cached, job.timing)
+            job.finish(cached)
+            record_job(job, cached)
+            return cached
+    res = await execute_in_runner(job)
+    if cache_key is not None:
+        # 実行したホストのイメージのキーで保存する（検索に使ったホストとイメージが違うこともある）
+        store_key = await cache_key_for(job, job.host) if job.host is not None else None
+        result = {'stdout': res.stdout, 'stderr': res.stderr, 'exit_code': res.exit_code, 'time': res.time}
+        # プレビューにした大きな出力はキャッシュしない
+        if store_key is None or not ResultCache.cacheable(result) or res.truncated:
+            cache_key = None
+        else:
+            cache_key = store_key
+            result_cache.put(cache_key, result)
+        res.debug['cache'] = 'miss'
+    observe_job('run', job.language, res, job.timing)
+    job.finish(res)
+    record_job(job, res, cache_key)
+    return res
+
+def validate_request(req: CodeRequest):
+    # 登録されていない言語・サイズ制限に引っかかった場合はエラーレスポンスを返す
+    if LANGUAGES.get(req.language) is None:
+        return CodeResponse(stdout='', stderr=f'Unsupported language: {req.language}', exit_code=2008, time=-1,
+                            debug={})
     if not check_request_size(req.code):
         return CodeResponse(stdout='', stderr='Request body too large', exit_code=2002, time=-1, debug={})
     if not check_code_length(req.code):
         return CodeResponse(stdout='', stderr='Code too long', exit_code=2003, time=-1, debug={})
-    # DBにジョブ保存
-    db = SessionLocal()
-    job = CodeJob(language=req.language, code=req.code, stdin=req.stdin, status='pending')
-    db.add(job)
+    return None
+
+def truncate_output(data, limit):
+    # 上限バイト数で切り詰める。超過していればTrueも返す
+    encoded = data.encode('utf-8')
+    if limit is None or len(encoded) <= limit:
+        return data, False
+    return encoded[:limit].decode('utf-8', errors='ignore'), True
+
+def batch_case_result(frame):
+    # ケースごとに出力上限を適用する（超過したケースはexit_code=1002）
+    stdout, stdout_exceeded = truncate_output(frame.get('stdout') or '', output_limits['stdout'])
+    stderr, stderr_exceeded = truncate_output(frame.get('stderr') or '', output_limits['stderr'])
+    exit_code = frame.get('exit_code', -1)
+    if stdout_exceeded or stderr_exceeded:
+        exit_code = 1002
+    return BatchCaseResult(stdout=stdout, stderr=with_limit_message(stderr, exit_code), exit_code=exit_code,
+                           time=frame.get('time', -1), passed=frame.get('passed'),
+                           debug={'usage': frame['usage']} if frame.get('usage') else {})
+
+def batch_error(stderr, exit_code, debug=None):
+    return BatchResponse(results=[], skipped=0, stderr=stderr, exit_code=exit_code, time=-1, debug=debug or {})
+
+async def batch_parallelism(language, host):
+    # ケースの並列数は実行するホストでのコンテナのCPU制限（コア数）まで
     try:
-        db.commit()
+        info = await image_info(language, host)
     except Exception as e:
-        logger.error(f'db commit error: {e}', exc_info=True)
-        db.close()
-        return CodeResponse(stdout='', stderr='db commit error', exit_code=9005, time=-1, debug={})
+        logger.warning(f'image lookup for batch parallelism failed: {e}')
+        return 1
+    return max(1, int(info.cpu_limit))
+
+async def run_batch_on_runner(req: BatchRequest, timing):
+    # 1つのrunnerコンテナで全ケースを実行する。ケースごとのグローバル状態の分離はrunner側で行う
+    # コンパイル型言語では最初に1回だけコンパイルする（キャッシュ済みならコンパイルしない）
     try:
-        db.refresh(job)
+        runner = await acquire_runner(req.language, timing)
     except Exception as e:
-        logger.error(f'db refresh error: {e}', exc_info=True)
+        return batch_error(f'create_container error: {str(e)}', 9001)
+    parallel = await batch_parallelism(req.language, runner.host)
+    fields, artifact_key = await prepare_build(req.language, req.code, timing, runner.host)
+    compile_info = cached_compile(fields)
+    compile_output = ''
+    ok = False
+    results = [None] * len(req.cases)
+    # 各ケースがmax_exec_timeで打ち切られるため、並列数で割った回数分だけ待つ
+    deadline = build_deadline(fields, rounds=-(-len(req.cases) // parallel))
+    runner.deadline = deadline
     try:
-        db.close()
+        with timing.span('send'):
+            await runner.channel.send_job({
+                'code': req.code,
+                'cases': [case.model_dump() for case in req.cases],
+                'parallel': parallel,
+                'stop_on_failure': req.stop_on_failure,
+                'limits': runner_limits(req.language),
+                **fields,
+            })
+        with timing.span('execute'):
+            while True:
+                frame = await runner.channel.read_frame(timeout=deadline - pytime.monotonic())
+                if frame.get('type') == 'result':
+                    break
+                if frame.get('type') == 'case_result':
+                    results[frame['index']] = batch_case_result(frame)
+                elif frame.get('type') == 'compile':
+                    compile_info = await on_compile_frame(frame, artifact_key, timing)
+                    compile_output = frame.get('output') or ''
+        ok = True
     except Exception as e:
-        logger.error(f'db close error: {e}', exc_info=True)
-
-
-    client = docker.from_env()
-    image = f"runner-{req.language}:latest"
-    mem_limit, cpu_limit = get_resource_limits(client.images.get(image))
-    if not cpu_limit or cpu_limit <= 0:
-        cpu_limit = 1.0
-    seccomp_path = os.path.join(os.path.dirname(__file__), '../runner/seccomp_profile.json')
-    security_opt = None
-    if os.path.exists(seccomp_path):
-        with open(seccomp_path, 'r') as f:
-            seccomp_json = f.read()
-        security_opt = [f"seccomp={seccomp_json}"]
-    dev_mode = os.getenv('DEV', '').lower() == 'true'
-    if dev_mode:
-        network_mode = 'host'
-    else:
-        stack_name = os.getenv('STACK_NAME')
-        network_mode = f'{stack_name}_backend-db-net'
-    host_config = client.api.create_host_config(
-        network_mode=network_mode,
-        mem_limit=mem_limit,
-        nano_cpus=int(cpu_limit * 1e9),
-        security_opt=security_opt
-    )
-    ext_map = {
-        'python': 'py',
-        'node': 'js',
-    }
-    ext = ext_map.get(req.language, req.language)
-    start = pytime.time()
+        if runner.reaped:
+            return batch_error(LIMIT_MESSAGES[1001], 1001)
+        logger.error(f'runner error: {e!r}')
+        return batch_error('wait_container error', 9003)
+    finally:
+        container_pool.release(runner, ok)
+    debug = {'parallel': parallel, 'host': runner.host.name}
+    compile_time = None
+    if compile_info is not None:
+        debug['compile'] = compile_info
+        compile_time = compile_info['time']
+        if compile_info.get('exit_code', 0) != 0:
+            # コンパイルエラー（ケースは実行していない）
+            return BatchResponse(results=results, skipped=len(req.cases), stderr=compile_output, exit_code=1,
+                                 time=-1, compile_time=compile_time, debug=debug)
+    return BatchResponse(results=results, skipped=frame.get('skipped', 0), exit_code=frame.get('exit_code', 0),
+                         time=frame.get('time', -1), compile_time=compile_time, debug=debug)
 
-    from db import get_db_config
-    db_user, db_password, db_name, db_host, db_port = get_db_config()
+def validate_batch_request(req: BatchRequest):
+    # 単発実行と同じ制限に加え、ケース数と標準入力の合計サイズを制限する
+    error = validate_request(req)
+    if error is not None:
+        return error
+    if len(req.cases) > max_batch_cases:
+        return CodeResponse(stdout='', stderr='Too many test cases', exit_code=2006, time=-1, debug={})
+    total_size = len(req.code.encode('utf-8')) + sum(len(case.stdin.encode('utf-8')) for case in req.cases)
+    if total_size > runtime.max_request_body_size:
+        return CodeResponse(stdout='', stderr='Request body too large', exit_code=2002, time=-1, debug={})
+    return None
+
+def rejected(response: Response, stderr, exit_code, retry_after):
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return CodeResponse(stdout='', stderr=stderr, exit_code=exit_code, time=-1,
+                        debug={'retry_after': retry_after})
+
+async def admit(req, request: Request, response: Response, validate=validate_request):
+    """
+    クライアントごとの投入レート・リクエストの制限・クライアントごとの同時実行数を順に確認する。
+    受け付けた場合は(クライアントキー, None)、拒否した場合は(None, エラーレスポンス)を返す。
+    受け付けたジョブが終わったらrelease_client()で同時実行数の枠を返すこと。
+    """
+    client = client_identity(
+        request.client.host if request.client else None,
+        request.headers,
+        api_key_header=rate_limit_config.get('api_key_header', 'X-API-Key'),
+        trust_forwarded_for=rate_limit_config.get('trust_forwarded_for', False),
+        known_keys=rate_limiter.api_keys,
+    )
     try:
-        cmd_str = " ".join([str(x) for x in [job.id, db_user, db_password, db_name, db_host, db_port]])
-        container = client.api.create_container(
-            image=image,
-            entrypoint=f"./run.{ext}",
-            command=cmd_str,
-            host_config=host_config,
-            detach=True
-        )
+        retry_after = await rate_limiter.hit(client)
+        if retry_after > 0:
+            return None, rejected(response, 'Rate limit exceeded', 2001, retry_after)
+        error = validate(req)
+        if error is not None:
+            return None, error
+        retry_after = await rate_limiter.acquire(client)
+        if retry_after > 0:
+            return None, rejected(response, 'Too many concurrent jobs', 2007, retry_after)
     except Exception as e:
-        return CodeResponse(stdout='', stderr=f'create_container error: {str(e)}', exit_code=9001, time=-1, debug={})
+        # 共有バックエンドの障害で全リクエストを止めないよう、制限なしで受け付ける
+        logger.error(f'rate limiter error: {e!r}')
+        return None, validate(req)
+    return client, None
 
+async def release_client(client):
+    if client is None:
+        return
     try:
-        container_id = container.get('Id')
-        client.api.start(container_id)
+        await rate_limiter.release(client)
     except Exception as e:
-        return CodeResponse(stdout='', stderr='start_container error', exit_code=9002, time=-1, debug={})
+        logger.error(f'rate limiter release error: {e!r}')
 
+async def run_admitted_job(job, client):
     try:
-        container_obj = client.containers.get(container_id)
-        container_obj.wait(timeout=60)
+        return await run_job(job)
     except Exception as e:
-        return CodeResponse(stdout='', stderr='wait_container error', exit_code=9003, time=-1, debug={})
-    
-    client.api.remove_container(container_id, force=True) 
+        # 想定外の例外でもジョブを終了状態にする（pending / runningのまま残さない）
+        logger.error(f'job {job.id} failed: {e!r}', exc_info=True)
+        if job.finished:
+            raise
+        res = CodeResponse(stdout='', stderr='Internal error', exit_code=9999, time=-1, debug={})
+        observe_job('run', job.language, res, job.timing)
+        job.finish(res)
+        record_job(job, res)
+        return res
+    finally:
+        await release_client(client)
+
+def job_status(job, preview=False):
+    result = job.result if preview else full_result(job, job.result)
+    return JobStatus(job_id=job.id, language=job.language, status=job.status, result=result)
+
+def row_usage(row):
+    return {
+        'wall_time': row.wall_time,
+        'cpu_user': row.cpu_user_time,
+        'cpu_sys': row.cpu_sys_time,
+        'max_rss_kb': row.max_rss_kb,
+        'stdout_bytes': row.stdout_bytes,
+        'stderr_bytes': row.stderr_bytes,
+    }
+
+def row_debug(row):
+    debug = {}
+    if row.wall_time is not None:
+        debug['usage'] = row_usage(row)
+    if row.timing:
+        debug['timing'] = json.loads(row.timing)
+    return debug
+
+def load_job_from_db(job_id, include_code=False, preview=False):
+    # メモリ上にないジョブ（期限切れ・他レプリカで実行）はcode_jobsから引く。previewなら出力は先頭・末尾だけにする
+    db = SessionLocal()
     try:
-        db = SessionLocal()
-        job_result = db.query(CodeJob).filter(CodeJob.id == job.id).first()
+        row = db.query(CodeJob).filter(CodeJob.uid == job_id).first()
+        code = stdin = None
+        if row is not None and include_code:
+            code, stdin = job_code(row, load_blobs(db, [row.code_hash, row.stdin_hash]))
+    finally:
         db.close()
-        if job_result:
-            return CodeResponse(
-                stdout=job_result.result_stdout or '',
-                stderr=job_result.result_stderr or '',
-                exit_code=job_result.result_exit_code if job_result.result_exit_code is not None else -1,
-                time=job_result.result_time if job_result.result_time is not None else -1,
-                debug={}
-            )
-        else:
-            return CodeResponse(stdout='', stderr='No result in DB', exit_code=9999, time=-1, debug={})
+    if row is None:
+        return None
+    debug = row_debug(row)
+    outputs, output_bytes, truncated = {}, {}, False
+    for stream in ('stdout', 'stderr'):
+        text = stored_output(row, stream)
+        output_bytes[stream] = len(text.encode('utf-8'))
+        if preview:
+            text, omitted = preview_text(text, output_capture['head_bytes'], output_capture['tail_bytes'])
+            truncated = truncated or omitted
+        outputs[stream] = text
+    result = CodeResponse(
+        stdout=outputs['stdout'],
+        stderr=outputs['stderr'],
+        exit_code=row.result_exit_code if row.result_exit_code is not None else -1,
+        time=row.result_time if row.result_time is not None else -1,
+        # コンパイル時間は処理段階ごとの所要時間（timing）に入っている
+        compile_time=debug.get('timing', {}).get('compile'),
+        stdout_bytes=output_bytes['stdout'],
+        stderr_bytes=output_bytes['stderr'],
+        truncated=truncated,
+        job_id=job_id,
+        debug=debug
+    )
+    return JobStatus(job_id=job_id, language=row.language, status=row.status, result=result, code=code, stdin=stdin)
+
+def load_job_output(job_id, stream):
+    # 出力1つ分だけを読む（もう一方の出力・コードは読まない）
+    db = SessionLocal()
+    try:
+        row = (db.query(getattr(CodeJob, f'result_{stream}'), getattr(CodeJob, f'result_{stream}_compressed'))
+               .filter(CodeJob.uid == job_id)
+               .first())
+    finally:
+        db.close()
+    return stored_output(row, stream) if row is not None else None
+
+def list_job_summaries(**filters):
+    db = SessionLocal()
+    try:
+        rows, next_cursor = list_jobs(db, **filters)
+    finally:
+        db.close()
+    jobs = [JobSummary(job_id=row.uid, language=row.language, status=row.status, exit_code=row.result_exit_code,
+                       time=row.result_time, stdout_bytes=row.stdout_bytes, stderr_bytes=row.stderr_bytes,
+                       created_at=row.created_at, finished_at=row.finished_at) for row in rows]
+    return JobList(jobs=jobs, next_cursor=next_cursor)
+
+def byte_range(header, total):
+    """
+    Rangeヘッダ（bytes=start-end / start- / -suffix の1範囲のみ）を(start, end)（endを含む）にする。
+    満たせない範囲はValueError
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError(header)
+    first, _, last = spec.strip().partition('-')
+    if first:
+        start = int(first)
+        end = min(int(last), total - 1) if last else total - 1
+    else:
+        start, end = max(total - int(last), 0), total - 1
+    if start >= total or start > end:
+        raise ValueError(header)
+    return start, end
+
+@app.get("/")
+def root():
+    return {"status": "OK"}
+ 
+
+@app.post("/run", response_model=CodeResponse)
+async def run_code(req: CodeRequest, request: Request, response: Response):
+    timing = Timing()
+    with timing.span('admit'):
+        client, error = await admit(req, request, response)
+    if error is not None:
+        observe_job('run', req.language, error, timing)
+        return error
+    job = job_registry.add(Job(req.language, req.code, req.stdin, output_limits, timing, output_capture))
+    persist_job(job)
+    res = await run_admitted_job(job, client)
+    return res if req.preview else full_result(job, res)
+
+@app.post("/run/batch", response_model=BatchResponse)
+async def run_batch(req: BatchRequest, request: Request, response: Response):
+    """
+    同じコードを複数の標準入力（テストケース）で実行する。
+    1つのコンテナ内でケースごとに独立したプロセス・スレッドを使い、CPU制限の範囲で並列に実行する
+    """
+    timing = Timing()
+    with timing.span('admit'):
+        client, error = await admit(req, request, response, validate=validate_batch_request)
+    if error is not None:
+        res = batch_error(error.stderr, error.exit_code, error.debug)
+        observe_job('batch', req.language, res, timing)
+        return res
+    try:
+        failure = await run_preflight(req.language, req.code, timing)
+        if failure is not None:
+            name, error = failure
+            res = batch_error(error, 1, {'preflight': name})
+            observe_job('batch', req.language, res, timing)
+            return res
+        queued_at = pytime.perf_counter()
+        async with job_scheduler.slot(req.language):
+            timing.add('queue_wait', pytime.perf_counter() - queued_at)
+            res = await run_batch_on_runner(req, timing)
+    except QueueFullError:
+        res = batch_error('Queue full', 2004)
+    except QueueTimeoutError:
+        res = batch_error('Queue wait timeout', 2005)
+    finally:
+        await release_client(client)
+    observe_job('batch', req.language, res, timing)
+    return res
+
+@app.post("/jobs", response_model=JobStatus)
+async def submit_job(req: CodeRequest, request: Request, response: Response):
+    """
+    ジョブを投入し、実行完了を待たずにジョブIDを返す
+    """
+    job = Job(req.language, req.code, req.stdin, output_limits, capture=output_capture)
+    with job.timing.span('admit'):
+        client, error = await admit(req, request, response)
+    if error is not None:
+        observe_job('run', req.language, error, job.timing)
+        job.finish(error)
+        return job_status(job)
+    job_registry.add(job)
+    persist_job(job)
+    job.task = asyncio.create_task(run_admitted_job(job, client))
+    return job_status(job)
+
+@app.get("/jobs", response_model=JobList)
+async def get_jobs(
+    language: Optional[str] = None,
+    status: Optional[str] = None,
+    exit_code: Optional[int] = None,
+    limit: int = Query(default=50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    order: Literal['desc', 'asc'] = 'desc',
+):
+    """
+    保存済みのジョブの一覧（投入時刻順）。コード・出力の本文は含めないので、本文は GET /jobs/{job_id} で取得する。
+    続きのページは next_cursor を cursor に渡して取得する
+    """
+    try:
+        return await asyncio.to_thread(list_job_summaries, limit=limit, cursor=cursor, order=order,
+                                       language=language, status=status, exit_code=exit_code)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str, include_code: bool = False, preview: bool = False):
+    """
+    ジョブの状態（終了していれば結果も）を返す。include_code=true ならコード・標準入力も返す。
+    preview=true なら大きな出力は先頭・末尾だけを返す（全体は /jobs/{job_id}/output/{stream} から）
+    """
+    job = job_registry.get(job_id)
+    if job is not None:
+        status = job_status(job, preview)
+        if include_code:
+            status.code, status.stdin = job.code, job.stdin
+        return status
+    status = await asyncio.to_thread(load_job_from_db, job_id, include_code, preview)
+    if status is None:
+        raise HTTPException(status_code=404, detail='job not found')
+    return status
+
+@app.get("/jobs/{job_id}/output/{stream}")
+async def get_job_output(job_id: str, stream: Literal['stdout', 'stderr'], range: Optional[str] = Header(default=None)):
+    """
+    ジョブの標準出力・標準エラー出力の本文（text/plain）。Rangeヘッダ（bytes=start-end）で一部だけを取得できる。
+    実行中のジョブはそれまでの出力を返す
+    """
+    job = job_registry.get(job_id)
+    if job is not None:
+        # プレビューにした結果・実行中のジョブは、ジョブが持つ出力全体から返す
+        data = job.output(stream) if job.result is None or job.result.truncated else getattr(job.result, stream)
+    else:
+        data = await asyncio.to_thread(load_job_output, job_id, stream)
+        if data is None:
+            raise HTTPException(status_code=404, detail='job not found')
+    body = data.encode('utf-8')
+    headers = {'Accept-Ranges': 'bytes'}
+    media_type = 'text/plain; charset=utf-8'
+    if range is None:
+        return Response(content=body, media_type=media_type, headers=headers)
+    try:
+        start, end = byte_range(range, len(body))
+    except ValueError:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{len(body)}'})
+    headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+    return Response(content=body[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+def sse_event(event, data, event_id=None):
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {event}\ndata: {data}\n\n'
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, last_event_id: Optional[str] = Header(default=None)):
+    """
+    ジョブの標準出力・標準エラー出力をServer-Sent Eventsで逐次配信する。
+    event: stdout / stderr（dataはJSON文字列）、最後に event: result（dataはCodeResponse。大きな出力はプレビュー）。
+    直近の出力だけを再送できるよう保持しているため、それより前から読もうとした場合は event: truncated
+    （dataは送れなかったイベント数）を送る。出力全体は /jobs/{job_id}/output/{stream} から取得する
+    """
+    job = job_registry.get(job_id)
+    if job is None:
+        status = await asyncio.to_thread(load_job_from_db, job_id, False, True)
+        if status is None:
+            raise HTTPException(status_code=404, detail='job not found')
+
+        async def finished_events():
+            for stream in ('stdout', 'stderr'):
+                data = getattr(status.result, stream)
+                if data:
+                    yield sse_event(stream, json.dumps(data))
+            yield sse_event('result', status.result.model_dump_json())
+        return StreamingResponse(finished_events(), media_type='text/event-stream')
+
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    async def live_events():
+        async for seq, stream, data in job.stream_events(start):
+            yield sse_event(stream, json.dumps(data), seq)
+        yield sse_event('result', job.result.model_dump_json())
+    return StreamingResponse(live_events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
+def apply_config(new_config):
+    # 再読込した設定を各コンポーネントへ反映する（実行中のジョブはそのまま）
+    global config, rate_limit_per_minute, max_batch_cases, max_exec_time, fork_server_config, node_runner_config
+    global preflight_config
+    config = new_config
+    rate_limit_per_minute = config.get('rate_limit_per_minute', 30)
+    # バックエンド（local / redis）の切り替えは再起動時のみ反映する
+    rate_limit_config.clear()
+    rate_limit_config.update(config.get('rate_limit', {}) or {})
+    rate_limiter.configure(**rate_limit_settings())
+    max_batch_cases = config.get('max_batch_cases', 100)
+    max_exec_time = config.get('max_exec_time', 10)
+    fork_server_config = config.get('python_fork_server', {}) or {}
+    node_runner_config = config.get('node_runner', {}) or {}
+    preflight_config = config.get('preflight', {}) or {}
+    preflight.configure(
+        enabled=preflight_config.get('enabled', True),
+        max_entries=preflight_config.get('max_entries', 10000),
+        disabled=[lang for lang, on in (preflight_config.get('languages', {}) or {}).items() if not on],
+    )
+    node_syntax_check.configure(
+        size=preflight_config.get('node_helpers', 2),
+        timeout=preflight_config.get('node_timeout', 2.0),
+    )
+    LANGUAGES.configure(config)
+    artifacts = config.get('artifact_cache', {}) or {}
+    artifact_cache.configure(
+        directory=artifacts.get('dir'),
+        enabled=artifacts.get('enabled', True),
+        max_bytes=artifacts.get('max_bytes', 512 * 1024 * 1024),
+    )
+    output_limits['stdout'] = config.get('max_stdout_bytes', 1048576)
+    output_limits['stderr'] = config.get('max_stderr_bytes', 1048576)
+    # 新しく受け付けるジョブから反映する
+    output_capture.update(config.get('output_capture', {}) or {})
+    compression = config.get('response_compression', {}) or {}
+    response_compressor.configure(
+        enabled=compression.get('enabled', True),
+        minimum_size=compression.get('minimum_size', 4096),
+        gzip_level=compression.get('gzip_level', 6),
+        brotli_quality=compression.get('brotli_quality', 4),
+        use_brotli=compression.get('brotli', True),
+    )
+    runtime.reload(config)
+    host_registry.configure(config)
+    pool = config.get('pool', {}) or {}
+    container_pool.configure(
+        pool.get('sizes', {}),
+        max_idle_seconds=pool.get('max_idle_seconds', 300),
+        max_jobs_per_container=pool.get('max_jobs_per_container', 50),
+    )
+    container_pool.drain_idle()
+    scheduler = config.get('scheduler', {}) or {}
+    job_scheduler.configure(
+        max_concurrency=scheduler.get('max_concurrency', 8),
+        per_language=scheduler.get('per_language', {}),
+        max_queue_depth=scheduler.get('max_queue_depth', 100),
+        max_queue_wait=scheduler.get('max_queue_wait', 30),
+    )
+    writer = config.get('job_writer', {}) or {}
+    job_writer.inline_output_bytes = writer.get('inline_output_bytes', 1024)
+    job_writer.compress_level = writer.get('compress_level', 1)
+    retention = config.get('job_retention', {}) or {}
+    job_retention.configure(
+        enabled=retention.get('enabled', False),
+        ttl_seconds=retention.get('ttl_seconds', 30 * 86400),
+        interval=retention.get('interval', 3600),
+        batch_size=retention.get('batch_size', 1000),
+        archive_dir=retention.get('archive_dir'),
+    )
+    reconcile = config.get('reconciler', {}) or {}
+    reconciler.configure(
+        enabled=reconcile.get('enabled', True),
+        interval=reconcile.get('interval', 5),
+        orphan_grace=reconcile.get('orphan_grace', 60),
+        deadline_grace=reconcile.get('deadline_grace', 10),
+        stale_after=reconcile.get('stale_after', 3600),
+    )
+    cache = config.get('result_cache', {}) or {}
+    result_cache.configure(
+        enabled=cache.get('enabled', False),
+        max_entries=cache.get('max_entries', 1000),
+        max_bytes=cache.get('max_bytes', 64 * 1024 * 1024),
+        ttl_seconds=cache.get('ttl_seconds', 3600),
+        persistent=cache.get('persistent', False),
+    )
+
+def reload_runtime():
+    try:
+        apply_config(load_config())
     except Exception as e:
-        return CodeResponse(stdout='', stderr='db_result error', exit_code=9004, time=-1, debug={})
+        logger.error(f'reload failed: {e}', exc_info=True)
+        return False
+    logger.info('config and runtime reloaded')
+    return True
+
+@app.post("/admin/reload")
+async def admin_reload():
+    """
+    config.yaml・seccompプロファイル・Dockerクライアント・イメージ情報を再読込する（SIGHUPでも同じ）
+    """
+    if not reload_runtime():
+        raise HTTPException(status_code=500, detail='reload failed')
+    return {"status": "OK"}
+
+@app.get("/pool/stats")
+def pool_stats():
+    """
+    ウォームプールのヒット/ミス・補充レイテンシなどのカウンタ
+    """
+    return container_pool.stats()
+
+@app.get("/hosts/stats")
+def host_stats():
+    """
+    runnerホストごとの実行中ジョブ数・割り当て済みCPU/メモリ・負荷・健全性
+    """
+    return host_registry.stats()
+
+@app.get("/languages")
+def list_languages():
+    """
+    実行できる言語（コンパイル型ならコンパイラとフラグ）
+    """
+    languages = []
+    for name in LANGUAGES.names():
+        plugin = LANGUAGES.get(name)
+        languages.append({'language': name, 'image': plugin.image, 'compiled': plugin.compiled,
+                          'compile_command': plugin.compile_command() if plugin.compiled else None})
+    return languages
+
+@app.get("/artifacts/stats")
+def artifact_cache_stats():
+    """
+    コンパイル済み実行ファイルのキャッシュのヒット/ミス・件数・バイト数・削除件数
+    """
+    return artifact_cache.stats()
+
+@app.get("/compression/stats")
+def compression_stats():
+    """
+    応答本文の圧縮件数（br / gzip別）・圧縮前後のバイト数・圧縮しなかった件数
+    """
+    return response_compressor.stats()
+
+@app.get("/preflight/stats")
+def preflight_stats():
+    """
+    事前検査の検査件数・不合格件数・キャッシュヒット・検査できなかった件数
+    """
+    return preflight.stats()
+
+@app.get("/ratelimit/stats")
+def rate_limit_stats():
+    """
+    レート制限の拒否件数・追跡中のクライアント数
+    """
+    return rate_limiter.stats()
+
+@app.get("/scheduler/stats")
+def scheduler_stats():
+    """
+    実行キューの長さ・同時実行数・キュー待ち時間とキュー長のヒストグラム
+    """
+    return job_scheduler.stats()
+
+@app.get("/cache/stats")
+def cache_stats():
+    """
+    結果キャッシュのヒット/ミス・件数・バイト数
+    """
+    return result_cache.stats()
+
+@app.get("/writer/stats")
+def job_writer_stats():
+    """
+    code_jobs非同期書き込みの件数（書き込み済み・失敗・破棄・キュー滞留）
+    """
+    return job_writer.stats()
+
+@app.get("/retention/stats")
+def job_retention_stats():
+    """
+    保持期間切れのcode_jobs・code_blobsの削除件数（アーカイブ件数）と最終実行時刻
+    """
+    return job_retention.stats()
+
+@app.get("/reconciler/stats")
+def reconciler_stats():
+    """
+    リコンサイラが削除したコンテナ数（孤立・終了済み・期限超過）とlostにしたジョブ数、最終実行時刻
+    """
+    return reconciler.stats()
+
+def metric_families():
+    pool = container_pool.stats()
+    scheduler = job_scheduler.stats()
+    checks = preflight.stats()
+    reconciled = reconciler.stats()
+    artifacts = artifact_cache.stats()
+    compression = response_compressor.stats()
+    return [
+        ('runner_jobs_total', 'counter', 'Finished requests by kind, language and exit code', jobs_total),
+        ('runner_job_phase_seconds', 'histogram', 'Time spent in each phase of a request', job_phase_time),
+        ('runner_queue_wait_seconds', 'histogram', 'Time spent waiting for an execution slot',
+         job_scheduler.wait_time),
+        ('runner_docker_api_seconds', 'histogram', 'Docker API call latency', container_pool.docker_api_time),
+        ('runner_job_insert_seconds', 'histogram', 'code_jobs batch insert latency', job_writer.insert_time),
+        ('runner_containers', 'gauge', 'Runner containers held by the warm pool',
+         CallbackMetric(['language', 'state'], lambda: {
+             (lang, state): n for state in ('idle', 'busy') for lang, n in pool[state].items()})),
+        ('runner_pool_acquire_total', 'counter', 'Warm pool acquisitions',
+         CallbackMetric(['result'], lambda: {('hit',): pool['hits'], ('miss',): pool['misses']})),
+        ('runner_queue_depth', 'gauge', 'Jobs waiting for an execution slot',
+         CallbackMetric([], lambda: {(): scheduler['queue_depth']})),
+        ('runner_running_jobs', 'gauge', 'Jobs holding an execution slot',
+         CallbackMetric(['language'], lambda: {(lang,): n for lang, n in scheduler['running_by_language'].items()})),
+        ('runner_job_writer_queue', 'gauge', 'Rows waiting to be written to code_jobs',
+         CallbackMetric([], lambda: {(): job_writer.stats()['queued']})),
+        ('runner_host_running_jobs', 'gauge', 'Jobs running on each runner host',
+         CallbackMetric(['host'], lambda: {(h.name,): h.running for h in host_registry.hosts})),
+        ('runner_host_load', 'gauge', 'Share of runner host capacity reserved by running jobs',
+         CallbackMetric(['host'], lambda: {(h.name,): h.load()[0] for h in host_registry.hosts})),
+        ('runner_preflight_total', 'counter', 'Pre-flight checks by result',
+         CallbackMetric(['result'], lambda: {(key,): checks[key] for key in (
+             'checked', 'rejected', 'hits', 'unavailable')})),
+        ('runner_reconciler_actions_total', 'counter', 'Containers removed and jobs marked lost by the reconciler',
+         CallbackMetric(['action'], lambda: {(key,): reconciled[key] for key in (
+             'recovered_containers', 'recovered_jobs', 'orphans_removed', 'exited_removed', 'stale_removed',
+             'reaped', 'lost_jobs')})),
+        ('runner_artifact_cache_total', 'counter', 'Compile artifact cache lookups and stores',
+         CallbackMetric(['result'], lambda: {(key,): artifacts[key] for key in (
+             'hits', 'misses', 'stores', 'evictions')})),
+        ('runner_artifact_cache_bytes', 'gauge', 'Bytes held by the compile artifact cache',
+         CallbackMetric([], lambda: {(): artifacts['bytes']})),
+        ('runner_response_compressed_total', 'counter', 'Response bodies compressed by encoding',
+         CallbackMetric(['encoding'], lambda: {(key,): compression[key] for key in ('gzip', 'br')})),
+        ('runner_response_compression_bytes_total', 'counter', 'Response body bytes before and after compression',
+         CallbackMetric(['stage'], lambda: {('in',): compression['bytes_in'], ('out',): compression['bytes_out']})),
+        ('runner_host_healthy', 'gauge', 'Whether the runner host receives new containers',
+         CallbackMetric(['host'], lambda: {(h.name,): int(h.available()) for h in host_registry.hosts})),
+    ]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """
+    Prometheus形式のメトリクス（処理段階ごとの所要時間・終了コードごとの件数・コンテナ数・キュー長）
+    """
+    return PlainTextResponse(render_prometheus(metric_families()), media_type='text/plain; version=0.0.4')
 
 @app.get("/dbtest", response_model=CodeResponse)
 def dbtest():
@@ -239,7 +1418,7 @@ def testB():
     try:
         db = SessionLocal()
         from models import CodeJob
-        job = CodeJob(language='python', code='print(1)', stdin='', status='pending')
+        job = CodeJob(uid=uuid.uuid4().hex, language='python', code='print(1)', stdin='', status='pending')
         db.add(job)
         db.commit()
         db.refresh(job)
@@ -0,0 +1,162 @@
+import bisect
+import collections
+import threading
+import time as pytime
+from contextlib import contextmanager
+
+
+class Histogram:
+    """
+    バケット境界（上限値）ごとに件数を数える軽量ヒストグラム。
+    snapshotは累積件数（le=上限以下の件数）で返す。
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = {}
+        running = 0
+        for bound, n in zip(self.buckets, counts):
+            running += n
+            cumulative[str(bound)] = running
+        cumulative['+Inf'] = count
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+
+class LabeledHistogram:
+    """ラベルの値の組ごとに同じバケット境界のHistogramを持つ"""
+
+    def __init__(self, label_names, buckets):
+        self.label_names = tuple(label_names)
+        self.buckets = sorted(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.buckets))
+        return child
+
+    def items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class LabeledCounter:
+    """ラベルの値の組ごとの単調増加カウンタ"""
+
+    def __init__(self, label_names):
+        self.label_names = tuple(label_names)
+        self._values = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] += amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class CallbackMetric:
+    """
+    読み出し時に値を計算するメトリクス（キュー長・コンテナ数など、他のコンポーネントが持つ値）。
+    fnは {ラベルの値の組: 値} を返す（ラベルなしなら {(): 値}）。
+    """
+
+    def __init__(self, label_names, fn):
+        self.label_names = tuple(label_names)
+        self.fn = fn
+
+    def items(self):
+        return list(self.fn().items())
+
+
+class Timing:
+    """
+    1件のジョブの処理段階ごとの所要時間（秒）。
+    同じ段階を複数回計測した場合は合計する。計測はperf_counterの差分のみで、ロックは取らない。
+    """
+
+    __slots__ = ('started', 'spans')
+
+    def __init__(self):
+        self.started = pytime.perf_counter()
+        self.spans = {}
+
+    @contextmanager
+    def span(self, name):
+        start = pytime.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, pytime.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.spans['total'] = pytime.perf_counter() - self.started
+
+    def as_dict(self):
+        return {name: round(seconds, 6) for name, seconds in self.spans.items()}
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _histogram_lines(name, label_names, values, histogram):
+    snapshot = histogram.snapshot()
+    lines = []
+    for bound, count in snapshot['buckets'].items():
+        lines.append(f'{name}_bucket{_format_labels(label_names, values, ("le", bound))} {count}')
+    labels = _format_labels(label_names, values)
+    lines.append(f'{name}_sum{labels} {snapshot["sum"]}')
+    lines.append(f'{name}_count{labels} {snapshot["count"]}')
+    return lines
+
+
+def render_prometheus(families):
+    """
+    Prometheusのテキスト形式（version 0.0.4）で書き出す。
+    familiesは (名前, 種類(counter/gauge/histogram), 説明, メトリクス) のリスト。
+    メトリクスはHistogram・LabeledHistogram・LabeledCounter・CallbackMetricのいずれか。
+    """
+    lines = []
+    for name, kind, help_text, metric in families:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if isinstance(metric, Histogram):
+            lines.extend(_histogram_lines(name, (), (), metric))
+        elif isinstance(metric, LabeledHistogram):
+            for values, histogram in sorted(metric.items()):
+                lines.extend(_histogram_lines(name, metric.label_names, values, histogram))
+        else:
+            for values, value in sorted(metric.items()):
+                lines.append(f'{name}{_format_labels(metric.label_names, values)} {value}')
+    return '\n'.join(lines) + '\n'
@@ -1,11 +1,98 @@
 CREATE TABLE IF NOT EXISTS code_jobs (
     id SERIAL PRIMARY KEY,
+    uid VARCHAR(32) UNIQUE,
+    cache_key VARCHAR(64),
     language VARCHAR(16) NOT NULL,
-    code TEXT NOT NULL,
+    code_hash VARCHAR(64),
+    stdin_hash VARCHAR(64),
+    code TEXT,
     stdin TEXT,
     status VARCHAR(16) DEFAULT 'pending',
+    instance_id VARCHAR(64),
     result_stdout TEXT,
     result_stderr TEXT,
+    result_stdout_compressed BYTEA,
+    result_stderr_compressed BYTEA,
     result_exit_code INTEGER,
-    result_time INTEGER
+    result_time DOUBLE PRECISION,
+    wall_time DOUBLE PRECISION,
+    cpu_user_time DOUBLE PRECISION,
+    cpu_sys_time DOUBLE PRECISION,
+    max_rss_kb INTEGER,
+    stdout_bytes BIGINT,
+    stderr_bytes BIGINT,
+    timing TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    finished_at TIMESTAMP WITH TIME ZONE
 );
+
+CREATE TABLE IF NOT EXISTS code_blobs (
+    hash VARCHAR(64) PRIMARY KEY,
+    compression VARCHAR(8) NOT NULL DEFAULT 'none',
+    data BYTEA NOT NULL,
+    size BIGINT NOT NULL,
+    last_used_at TIMESTAMP WITH TIME ZONE
+);
+
+-- 実行時間を秒（小数）で保存する
+ALTER TABLE code_jobs ALTER COLUMN result_time TYPE DOUBLE PRECISION;
+
+-- APIで公開するジョブID（POST /jobs で払い出し、GET /jobs/{uid} で参照）
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS uid VARCHAR(32);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_code_jobs_uid ON code_jobs (uid);
+
+-- 結果キャッシュのキー（result_cache.persistent: true のときに参照）
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS cache_key VARCHAR(64);
+CREATE INDEX IF NOT EXISTS ix_code_jobs_cache_key ON code_jobs (cache_key);
+
+-- ランナーが計測したリソース使用量（経過時間・CPU時間・最大RSS・出力バイト数）
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS wall_time DOUBLE PRECISION;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS cpu_user_time DOUBLE PRECISION;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS cpu_sys_time DOUBLE PRECISION;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS max_rss_kb INTEGER;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS stdout_bytes BIGINT;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS stderr_bytes BIGINT;
+
+-- バックエンドでの処理段階ごとの所要時間（秒、JSON。受付・キュー待ち・コンテナ取得・実行など）
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS timing TEXT;
+
+-- 保存形式の変更: コード・標準入力はcode_blobs（内容のsha256で重複排除）から参照し、
+-- inline_output_bytesを超える出力は全体を *_compressed にzlib圧縮して、インライン列には先頭だけを残す
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS code_hash VARCHAR(64);
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS stdin_hash VARCHAR(64);
+ALTER TABLE code_jobs ALTER COLUMN code DROP NOT NULL;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS result_stdout_compressed BYTEA;
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS result_stderr_compressed BYTEA;
+CREATE INDEX IF NOT EXISTS ix_code_jobs_code_hash ON code_jobs (code_hash);
+CREATE INDEX IF NOT EXISTS ix_code_jobs_stdin_hash ON code_jobs (stdin_hash);
+CREATE INDEX IF NOT EXISTS ix_code_blobs_last_used_at ON code_blobs (last_used_at);
+
+-- 投入・終了時刻（既存の行はマイグレーション時刻になる）と、状態・投入時刻のインデックス
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT now();
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP WITH TIME ZONE;
+CREATE INDEX IF NOT EXISTS ix_code_jobs_created_at ON code_jobs (created_at);
+CREATE INDEX IF NOT EXISTS ix_code_jobs_status_created_at ON code_jobs (status, created_at);
+
+-- ジョブは投入時から行を持ち、状態（pending → running → done / error / timeout / lost）を更新する。
+-- instance_idは受け付けたバックエンドのインスタンスID（クラッシュ後の再起動で実行中だったジョブをlostにする）
+ALTER TABLE code_jobs ADD COLUMN IF NOT EXISTS instance_id VARCHAR(64);
+
+-- 既存の行のコード・標準入力をcode_blobsへ移す（PostgreSQL 11以降のsha256を使う。圧縮はしない）。
+-- 行数が多い場合は時間がかかるため、移行後に VACUUM (FULL) code_jobs で領域を回収する
+INSERT INTO code_blobs (hash, compression, data, size, last_used_at)
+SELECT DISTINCT ON (hash) hash, 'none', data, length(data), now()
+FROM (
+    SELECT encode(sha256(convert_to(code, 'UTF8')), 'hex') AS hash, convert_to(code, 'UTF8') AS data
+    FROM code_jobs WHERE code IS NOT NULL AND code_hash IS NULL
+    UNION ALL
+    SELECT encode(sha256(convert_to(stdin, 'UTF8')), 'hex'), convert_to(stdin, 'UTF8')
+    FROM code_jobs WHERE stdin IS NOT NULL AND stdin <> '' AND stdin_hash IS NULL
+) AS contents
+ON CONFLICT (hash) DO NOTHING;
+UPDATE code_jobs SET
+    code_hash = encode(sha256(convert_to(code, 'UTF8')), 'hex'),
+    stdin_hash = CASE WHEN stdin IS NULL OR stdin = '' THEN NULL
+                      ELSE encode(sha256(convert_to(stdin, 'UTF8')), 'hex') END,
+    code = NULL,
+    stdin = NULL
+WHERE code IS NOT NULL AND code_hash IS NULL;
@@ -1,16 +1,59 @@
-from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, LargeBinary, DateTime, Index, func
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
 class CodeJob(Base):
     __tablename__ = 'code_jobs'
+    __table_args__ = (
+        # 状態ごとの一覧・保持期間切れの削除に使う
+        Index('ix_code_jobs_status_created_at', 'status', 'created_at'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
+    # APIで公開するジョブID（投入時にバックエンドで採番）
+    uid = Column(String(32), unique=True, index=True)
+    # 結果キャッシュのキー（成功した実行のみ。言語・イメージID・コード・標準入力・制限値のハッシュ）
+    cache_key = Column(String(64), index=True)
     language = Column(String(16), nullable=False)
-    code = Column(Text, nullable=False)
+    # コード・標準入力はcode_blobsに保存し、内容のハッシュで参照する（標準入力が空ならNULL）
+    code_hash = Column(String(64), index=True)
+    stdin_hash = Column(String(64), index=True)
+    # 旧形式の行のみ（新しい行はcode_hash / stdin_hashを使う）
+    code = Column(Text, nullable=True)
     stdin = Column(Text, nullable=True)
+    # pending → running → done / error / timeout / lost（jobs.JOB_TRANSITIONS）
     status = Column(String(16), default='pending')
+    # ジョブを受け付けたバックエンドのインスタンスID（再起動時に自分が実行中だったジョブを見つける）
+    instance_id = Column(String(64))
+    # 出力。inline_output_bytesを超えた場合は先頭だけのプレビューで、全体は*_compressedにzlib圧縮して保存する
     result_stdout = Column(Text)
     result_stderr = Column(Text)
+    result_stdout_compressed = Column(LargeBinary)
+    result_stderr_compressed = Column(LargeBinary)
     result_exit_code = Column(Integer)
-    result_time = Column(Integer)
+    result_time = Column(Float)
+    # ランナーが計測したリソース使用量（秒・KB・バイト）
+    wall_time = Column(Float)
+    cpu_user_time = Column(Float)
+    cpu_sys_time = Column(Float)
+    max_rss_kb = Column(Integer)
+    stdout_bytes = Column(BigInteger)
+    stderr_bytes = Column(BigInteger)
+    # バックエンドでの処理段階ごとの所要時間（秒、JSON）
+    timing = Column(Text)
+    # 投入・終了時刻（保持期間の判定に使う）
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    finished_at = Column(DateTime(timezone=True))
+
+
+class CodeBlob(Base):
+    """コード・標準入力の本体（内容のsha256で重複排除）"""
+    __tablename__ = 'code_blobs'
+    hash = Column(String(64), primary_key=True)
+    # 'none' または 'zlib'
+    compression = Column(String(8), nullable=False, default='none')
+    data = Column(LargeBinary, nullable=False)
+    # 圧縮前のバイト数
+    size = Column(BigInteger, nullable=False)
+    # 最後にジョブから参照された時刻（保持期間を過ぎ、どのジョブからも参照されなければ削除する）
+    last_used_at = Column(DateTime(timezone=True), index=True)
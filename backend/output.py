@@ -0,0 +1,106 @@
+import zlib
+
+# プレビューで省略した部分に入れる目印（{omitted}は省略したバイト数）
+TRUNCATION_MARKER = '\n... [{omitted} bytes omitted] ...\n'
+
+
+def preview_text(text, head_bytes, tail_bytes):
+    """
+    出力全体から先頭head_bytes・末尾tail_bytesだけを残したプレビューを作る（収まっていればそのまま）。
+    (プレビュー, 省略したか) を返す
+    """
+    data = text.encode('utf-8')
+    omitted = len(data) - head_bytes - tail_bytes
+    if omitted <= 0:
+        return text, False
+    head = data[:head_bytes].decode('utf-8', errors='ignore')
+    tail = data[len(data) - tail_bytes:].decode('utf-8', errors='ignore') if tail_bytes else ''
+    return head + TRUNCATION_MARKER.format(omitted=omitted) + tail, True
+
+
+class OutputCapture:
+    """
+    1ストリーム分の出力。先頭head_bytes・末尾tail_bytes（リングバッファ）だけを平文で持ち、
+    合計がそれを超えたら全体をzlibで逐次圧縮して持つ（code_jobsのresult_*_compressedと同じ形式）。
+    合計バイト数は省略した部分も含めて正確に数える。
+    """
+
+    def __init__(self, head_bytes=65536, tail_bytes=16384, level=1):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.level = level
+        self.total_bytes = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+        # 先頭・末尾に収まらなくなるまでは圧縮しない（ほとんどの出力は小さい）
+        self._compressor = None
+        self._chunks = []
+        self._compressed = None
+        self.closed = False
+
+    @property
+    def truncated(self):
+        return self.total_bytes > len(self._head) + len(self._tail)
+
+    def write(self, data):
+        # dataはUTF-8のバイト列
+        if self.closed:
+            raise ValueError('output capture is closed')
+        if not data:
+            return
+        if self._compressor is None and self.total_bytes + len(data) > self.head_bytes + self.tail_bytes:
+            # ここまでの出力はすべて先頭・末尾に残っているので、それを圧縮してから続ける
+            self._compressor = zlib.compressobj(self.level)
+            self._chunks.append(self._compressor.compress(bytes(self._head) + bytes(self._tail)))
+        if self._compressor is not None:
+            self._chunks.append(self._compressor.compress(data))
+            self._compressed = None
+        self.total_bytes += len(data)
+        room = self.head_bytes - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if data:
+            self._tail += data
+            excess = len(self._tail) - self.tail_bytes
+            if excess > 0:
+                del self._tail[:excess]
+
+    def preview(self):
+        """先頭・末尾のプレビュー（省略していなければ出力全体）"""
+        if not self.truncated:
+            return (bytes(self._head) + bytes(self._tail)).decode('utf-8', errors='ignore')
+        omitted = self.total_bytes - len(self._head) - len(self._tail)
+        return (bytes(self._head).decode('utf-8', errors='ignore')
+                + TRUNCATION_MARKER.format(omitted=omitted)
+                + bytes(self._tail).decode('utf-8', errors='ignore'))
+
+    def head(self, limit):
+        """先頭limitバイトまで（head_bytesを超える分は持っていない）"""
+        return bytes(self._head[:limit]).decode('utf-8', errors='ignore')
+
+    def close(self):
+        # 書き込みの終わり。圧縮を終端して1つのバイト列にまとめる
+        if self._compressor is not None:
+            self._compressed = self.compressed()
+            self._chunks = []
+            self._compressor = None
+        self.closed = True
+
+    def compressed(self):
+        """出力全体をzlib圧縮したもの（書き込み途中でも、それまでの分を返す）"""
+        if self._compressor is None:
+            if self._compressed is not None:
+                return self._compressed
+            return zlib.compress(bytes(self._head) + bytes(self._tail), self.level)
+        if self._compressed is None:
+            # 書き込みを続けられるよう、圧縮器の複製で終端する
+            self._chunks = [b''.join(self._chunks)]
+            self._compressed = self._chunks[0] + self._compressor.copy().flush()
+        return self._compressed
+
+    def text(self):
+        """出力全体（省略していればzlibから復元する）"""
+        if not self.truncated:
+            return self.preview()
+        return zlib.decompress(self.compressed()).decode('utf-8', errors='ignore')
@@ -0,0 +1,461 @@
+import asyncio
+import collections
+import json
+import logging
+import secrets
+import socket
+import ssl
+import struct
+import threading
+import time as pytime
+
+from metrics import LabeledHistogram
+
+logger = logging.getLogger("uvicorn.error")
+
+# Dockerのattachストリーム（TTYなし）は8バイトのヘッダで多重化されている
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
+FRAME_HEADER = struct.Struct('>BxxxL')
+
+# Docker API呼び出し（create_container・attach・start・remove）の所要時間（秒）のヒストグラム境界
+DOCKER_API_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class RunnerChannel:
+    """
+    runnerコンテナにattachしたソケットのラッパー。
+    標準入力へ1行1ジョブのJSONを書き込み、標準出力から1行1応答のJSONを読む。
+    読み書きはイベントループ上のノンブロッキングI/Oで行い、待機中にスレッドを占有しない。
+    ジョブ行にはジョブごとの乱数（nonce）を入れ、runnerはそれと連番（seq）をすべてのフレームに付けて返す。
+    nonceや連番の合わないフレームはジョブに渡さない。そうしたフレームや結果フレームの後に届いたフレームが
+    あれば tainted にし、プールはそのコンテナを使い回さない。
+    """
+
+    def __init__(self, sock):
+        self._sock_io = sock
+        self.sock = getattr(sock, '_sock', sock)
+        # TLS接続のソケットはイベントループのsock_*が使えないため、スレッドで読み書きする
+        self._threaded = isinstance(self.sock, ssl.SSLSocket)
+        if not self._threaded:
+            self.sock.setblocking(False)
+        self._stdout = b''
+        self._nonce = None
+        self._seq = 0
+        self.tainted = False
+
+    async def _recv(self, n):
+        if self._threaded:
+            return await asyncio.to_thread(self.sock.recv, n)
+        return await asyncio.get_running_loop().sock_recv(self.sock, n)
+
+    async def send_line(self, obj):
+        data = json.dumps(obj).encode('utf-8') + b'\n'
+        if self._threaded:
+            await asyncio.to_thread(self.sock.sendall, data)
+        else:
+            await asyncio.get_running_loop().sock_sendall(self.sock, data)
+
+    async def _recv_exact(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = await self._recv(n - len(data))
+            if not chunk:
+                raise EOFError('runner stream closed')
+            data += chunk
+        return data
+
+    async def _read_line(self):
+        # 改行が届くまでフレームを読み進める（stderrフレームは読み捨て）
+        while b'\n' not in self._stdout:
+            stream, size = FRAME_HEADER.unpack(await self._recv_exact(FRAME_HEADER.size))
+            payload = await self._recv_exact(size)
+            if stream == STREAM_STDOUT:
+                self._stdout += payload
+        line, self._stdout = self._stdout.split(b'\n', 1)
+        return json.loads(line)
+
+    async def read_line(self, timeout):
+        # タイムアウト時は途中まで読んだ状態になるため、呼び出し側でコンテナを破棄すること
+        return await asyncio.wait_for(self._read_line(), timeout)
+
+    async def send_job(self, job):
+        # ジョブ行を新しいnonceを付けて送る。以降のフレームの連番は0から数え直す
+        self._nonce = secrets.token_hex(16)
+        self._seq = 0
+        await self.send_line({**job, 'nonce': self._nonce})
+
+    async def _read_frame(self):
+        while True:
+            try:
+                frame = await self._read_line()
+            except ValueError:
+                self.tainted = True
+                continue
+            if isinstance(frame, dict) and frame.get('nonce') == self._nonce and frame.get('seq') == self._seq:
+                self._seq += 1
+                return frame
+            # 前のジョブの残りや、このジョブのものでない・順番の合わないフレームはジョブに渡さない
+            logger.warning(f'dropped runner frame not matching the job (expected seq {self._seq})')
+            self.tainted = True
+
+    async def read_frame(self, timeout):
+        """送ったジョブのフレームを順に返す（read_lineと同じく、タイムアウト時はコンテナを破棄すること）"""
+        return await asyncio.wait_for(self._read_frame(), timeout)
+
+    def has_extra_output(self):
+        """
+        結果フレームの後に読み残しや届いたばかりの標準出力があるか（ブロックせずに確認する）。
+        stderrのフレームが先にある場合は確認できないが、次のジョブで連番が合わずに検出される。
+        """
+        if self._stdout:
+            return True
+        if self._threaded:
+            return False
+        try:
+            header = self.sock.recv(FRAME_HEADER.size, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+        # 空（EOF）はrunnerが終了している
+        return not header or header[0] == STREAM_STDOUT
+
+    def close(self):
+        try:
+            self._sock_io.close()
+        except Exception:
+            pass
+
+
+class PooledContainer:
+    """起動済みでジョブ待ち状態のrunnerコンテナ"""
+
+    def __init__(self, container_id, host, language, channel, spawn_timing=None):
+        self.id = container_id
+        # 起動先のRunnerHostと、実行中のジョブが確保している負荷（host.reserveの返り値）
+        self.host = host
+        self.reservation = None
+        self.language = language
+        self.channel = channel
+        # 起動時のDocker API呼び出しごとの所要時間（秒）
+        self.spawn_timing = spawn_timing or {}
+        self.created_at = pytime.monotonic()
+        self.last_used = self.created_at
+        self.jobs = 0
+        # 実行中のジョブ（プールのコンテナは複数のジョブで使い回すため、ラベルではなくここで持つ）と応答の期限
+        self.job_id = None
+        self.deadline = None
+        # 期限を過ぎてもジョブが終わらず、リコンサイラがコンテナを削除した
+        self.reaped = False
+
+
+class ContainerPool:
+    """
+    言語ごとのウォームコンテナプール。sizeは待機中＋使用中のコンテナ数の目標値（全ホスト合計）。
+    - acquire_idle: 待機中のコンテナのうち、最も空いているホストのものを払い出す
+      （なければNone＝ミス。呼び出し側でspawn_forする）
+    - spawn: 最も空いているホストで起動し、失敗したら他のホストで試す
+    - release: 使用後に返却。失敗時・フレームの順番が乱れた場合・ジョブ数上限到達時・ホストが使えなくなった場合は
+      破棄して作り直す
+    - バックグラウンドスレッドが破棄・アイドル超過分の削除・不足分の補充を行う
+    - 使用中のコンテナはIDで保持し、リコンサイラが期限超過の検出と孤立コンテナの判定に使う
+    acquire_idle/releaseはDocker APIを呼ばないため、イベントループ上から直接呼んでよい。
+    """
+
+    def __init__(self, hosts, factory, sizes, max_idle_seconds=300,
+                 max_jobs_per_container=50, refill_interval=5.0):
+        # 起動先のHostRegistry（Docker未起動でもimportできるよう、クライアントは各ホストで使用時に作る）
+        self.hosts = hosts
+        # factory(host, language) -> 作成済み（未起動）のコンテナID
+        self.factory = factory
+        self.refill_interval = refill_interval
+        self._idle = {}
+        self._busy = collections.Counter()
+        self._in_use = {}
+        self._to_discard = collections.deque()
+        self.docker_api_time = LabeledHistogram(['call'], DOCKER_API_BUCKETS)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'refills': 0,
+            'refill_errors': 0,
+            'recycled': 0,
+            'tainted': 0,
+            'evicted_idle': 0,
+            'failovers': 0,
+            'refill_latency_total': 0.0,
+            'refill_latency_max': 0.0,
+            'refill_latency_last': 0.0,
+        }
+        self.configure(sizes, max_idle_seconds, max_jobs_per_container)
+
+    def configure(self, sizes, max_idle_seconds=300, max_jobs_per_container=50):
+        # サイズを減らした場合、余剰分は返却時・アイドル超過時に破棄される
+        with self._lock:
+            self.sizes = {lang: int(n or 0) for lang, n in (sizes or {}).items()}
+            self.max_idle_seconds = max_idle_seconds
+            self.max_jobs_per_container = max_jobs_per_container
+            for lang in self.sizes:
+                self._idle.setdefault(lang, collections.deque())
+        self._wakeup.set()
+
+    def enabled(self, language):
+        return self.sizes.get(language, 0) > 0
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _observe_api(self, timing, call, started):
+        elapsed = pytime.perf_counter() - started
+        timing[call] = elapsed
+        self.docker_api_time.labels(call).observe(elapsed)
+
+    def _spawn_on(self, host, language):
+        # attachしてから起動する（起動直後の出力を取りこぼさないため）
+        client = host.runtime.client
+        timing = {}
+        started = pytime.perf_counter()
+        container_id = self.factory(host, language)
+        self._observe_api(timing, 'create_container', started)
+        try:
+            started = pytime.perf_counter()
+            sock = client.api.attach_socket(container_id, params={'stdin': 1, 'stdout': 1, 'stream': 1})
+            self._observe_api(timing, 'attach', started)
+            started = pytime.perf_counter()
+            client.api.start(container_id)
+            self._observe_api(timing, 'start', started)
+        except Exception:
+            self._remove(host, container_id)
+            raise
+        return PooledContainer(container_id, host, language, RunnerChannel(sock), timing)
+
+    def spawn(self, language):
+        # 最も空いているホストから順に試す。失敗が続いたホストはHostRegistryが一定時間外す
+        tried = []
+        error = None
+        while True:
+            host = self.hosts.choose(exclude=tried)
+            if host is None:
+                break
+            if tried:
+                self._count('failovers')
+            tried.append(host)
+            try:
+                runner = self._spawn_on(host, language)
+            except Exception as e:
+                logger.warning(f'spawn on runner host {host.name} failed: {e}')
+                self.hosts.record_failure(host)
+                error = e
+                continue
+            self.hosts.record_success(host)
+            return runner
+        raise error or RuntimeError('no available runner host')
+
+    def _pick_idle(self, idle):
+        # 使えるホストの待機コンテナのうち、ホストが最も空いているもの
+        best = None
+        for runner in idle:
+            if runner.host.available() and (best is None or runner.host.load() < best.host.load()):
+                best = runner
+        if best is not None:
+            idle.remove(best)
+        return best
+
+    def acquire_idle(self, language):
+        with self._lock:
+            idle = self._idle.get(language)
+            runner = self._pick_idle(idle) if idle else None
+            self._counters['hits' if runner else 'misses'] += 1
+            self._busy[language] += 1
+            if runner is not None:
+                self._in_use[runner.id] = runner
+        if runner is not None:
+            runner.reservation = runner.host.reserve(language)
+        return runner
+
+    def spawn_for(self, language):
+        # acquire_idleがミスした場合にその場でコンテナを起動する（ブロッキング）
+        try:
+            runner = self.spawn(language)
+        except Exception:
+            with self._lock:
+                self._busy[language] -= 1
+            raise
+        with self._lock:
+            self._in_use[runner.id] = runner
+        runner.reservation = runner.host.reserve(language)
+        return runner
+
+    def acquire(self, language):
+        return self.acquire_idle(language) or self.spawn_for(language)
+
+    def release(self, runner, ok=True):
+        runner.jobs += 1
+        runner.last_used = pytime.monotonic()
+        runner.job_id = runner.deadline = None
+        if runner.reservation is not None:
+            runner.host.unreserve(runner.reservation)
+            runner.reservation = None
+        with self._lock:
+            self._busy[runner.language] -= 1
+            self._in_use.pop(runner.id, None)
+            if runner.reaped:
+                # コンテナはリコンサイラが削除済み
+                runner.channel.close()
+                return
+            idle = self._idle.setdefault(runner.language, collections.deque())
+            tainted = runner.channel.tainted or runner.channel.has_extra_output()
+            if tainted:
+                # 前のジョブの出力が次のジョブに混ざらないよう、プロトコルが乱れたコンテナは捨てる
+                self._counters['tainted'] += 1
+            reusable = (ok and not tainted and runner.jobs < self.max_jobs_per_container
+                        and runner.host.available() and not self._stop.is_set())
+            if reusable and len(idle) + self._busy[runner.language] < self.sizes.get(runner.language, 0):
+                idle.append(runner)
+                return
+            # コンテナ削除は補充スレッドに任せる
+            self._to_discard.append(runner)
+            self._counters['recycled'] += 1
+        runner.channel.close()
+        self._wakeup.set()
+
+    def container_ids(self):
+        # プールが把握しているコンテナ（待機中・使用中・削除待ち）のID
+        with self._lock:
+            ids = {r.id for idle in self._idle.values() for r in idle}
+            ids.update(self._in_use)
+            ids.update(r.id for r in self._to_discard)
+        return ids
+
+    def overdue(self, now, grace):
+        # 応答の期限をgrace秒過ぎても返却されない使用中のコンテナ
+        with self._lock:
+            return [r for r in self._in_use.values()
+                    if r.deadline is not None and not r.reaped and now > r.deadline + grace]
+
+    def reap(self, runner):
+        """
+        期限を過ぎたコンテナを強制削除する（ブロッキング）。attachしたストリームが閉じるため、
+        実行中のジョブは読み込みエラーで終わり、runner.reapedを見て時間制限超過として返す
+        """
+        runner.reaped = True
+        self._remove(runner.host, runner.id)
+
+    def _discard_pending(self):
+        while True:
+            with self._lock:
+                if not self._to_discard:
+                    return
+                runner = self._to_discard.popleft()
+            self._remove(runner.host, runner.id)
+
+    def _remove(self, host, container_id):
+        started = pytime.perf_counter()
+        try:
+            host.runtime.client.api.remove_container(container_id, force=True)
+        except Exception as e:
+            logger.warning(f'pool remove_container error: {e}')
+        self.docker_api_time.labels('remove_container').observe(pytime.perf_counter() - started)
+
+    def drain_idle(self):
+        # 待機中のコンテナをすべて破棄し、新しい設定・イメージで補充し直す
+        with self._lock:
+            runners = [r for idle in self._idle.values() for r in idle]
+            for idle in self._idle.values():
+                idle.clear()
+            self._to_discard.extend(runners)
+            self._counters['recycled'] += len(runners)
+        for runner in runners:
+            runner.channel.close()
+        self._wakeup.set()
+
+    def _evict_idle(self):
+        now = pytime.monotonic()
+        expired = []
+        with self._lock:
+            for language, idle in self._idle.items():
+                # アイドル超過のものと、使えなくなったホスト（unhealthy・一覧から削除）のものを破棄する
+                keep = [r for r in idle if now - r.last_used < self.max_idle_seconds and r.host.available()]
+                expired.extend(r for r in idle if r not in keep)
+                # 縮小された場合は目標サイズを超えた分も破棄する
+                surplus = len(keep) + self._busy[language] - self.sizes.get(language, 0)
+                if surplus > 0:
+                    expired.extend(keep[:surplus])
+                    keep = keep[surplus:]
+                idle.clear()
+                idle.extend(keep)
+            self._counters['evicted_idle'] += len(expired)
+        for runner in expired:
+            runner.channel.close()
+            self._remove(runner.host, runner.id)
+
+    def _refill_once(self):
+        self._discard_pending()
+        self._evict_idle()
+        for language, size in list(self.sizes.items()):
+            while not self._stop.is_set():
+                with self._lock:
+                    if len(self._idle[language]) + self._busy[language] >= size:
+                        break
+                started = pytime.monotonic()
+                try:
+                    runner = self.spawn(language)
+                except Exception as e:
+                    logger.error(f'pool refill error ({language}): {e}')
+                    self._count('refill_errors')
+                    break
+                latency = pytime.monotonic() - started
+                with self._lock:
+                    self._idle[language].append(runner)
+                    self._counters['refills'] += 1
+                    self._counters['refill_latency_total'] += latency
+                    self._counters['refill_latency_last'] = latency
+                    self._counters['refill_latency_max'] = max(self._counters['refill_latency_max'], latency)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._refill_once()
+            except Exception as e:
+                logger.error(f'pool refill loop error: {e}', exc_info=True)
+            self._wakeup.wait(self.refill_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        # 破棄処理もこのスレッドで行うため、プールサイズが0でも起動する
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='container-pool', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        with self._lock:
+            runners = [r for idle in self._idle.values() for r in idle]
+            for idle in self._idle.values():
+                idle.clear()
+        for runner in runners:
+            runner.channel.close()
+            self._remove(runner.host, runner.id)
+        self._discard_pending()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['idle'] = {lang: len(idle) for lang, idle in self._idle.items()}
+            stats['busy'] = dict(self._busy)
+        stats['sizes'] = dict(self.sizes)
+        stats['docker_api_seconds'] = {
+            call: histogram.snapshot() for (call,), histogram in self.docker_api_time.items()}
+        stats['refill_latency_avg'] = (
+            stats['refill_latency_total'] / stats['refills'] if stats['refills'] else 0.0)
+        return stats
@@ -0,0 +1,39 @@
+const readline = require('readline');
+const vm = require('vm');
+
+// バックエンドの事前検査用ヘルパー。標準入力から1行1件のJSON（{"code": ...}）を読み、
+// 構文解析だけを行って（実行はしない）1行1件のJSONを返す。
+// - {"ok": true}
+// - {"ok": false, "error": "main.js:1\n...\nSyntaxError: ..."}  ランナーが返すエラーと同じ形式（内部のスタックは除く）
+
+function syntaxErrorText(e) {
+  const lines = String(e && e.stack ? e.stack : e).split('\n');
+  const end = lines.findIndex((line) => /^\s+at /.test(line));
+  return (end === -1 ? lines : lines.slice(0, end)).join('\n') + '\n';
+}
+
+function check(code) {
+  try {
+    // ランナーと同じファイル名でコンパイルし、エラー位置の表示を揃える
+    new vm.Script(code, { filename: 'main.js' });
+    return { ok: true };
+  } catch (e) {
+    if (e instanceof SyntaxError || (e && e.name === 'SyntaxError')) {
+      return { ok: false, error: syntaxErrorText(e) };
+    }
+    // 構文エラー以外（メモリ不足など）は判定せず実行に任せる
+    return { ok: true };
+  }
+}
+
+const rl = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+rl.on('line', (line) => {
+  if (!line.trim()) return;
+  let result;
+  try {
+    result = check(JSON.parse(line).code || '');
+  } catch (e) {
+    result = { ok: true };
+  }
+  process.stdout.write(JSON.stringify(result) + '\n');
+});
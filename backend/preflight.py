@@ -0,0 +1,190 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import traceback
+
+logger = logging.getLogger("uvicorn.error")
+
+NODE_HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preflight.js')
+
+
+class PreflightUnavailable(Exception):
+    """検査そのものができなかった（ヘルパーの異常・タイムアウト）。ジョブは通常どおり実行する"""
+
+
+def python_syntax_error(code):
+    # 実行はせずにコンパイルだけ行う。ランナーのexecと同じファイル名で、エラー箇所の表示を揃える
+    try:
+        compile(code, '<string>', 'exec', dont_inherit=True)
+    except SyntaxError as e:
+        return ''.join(traceback.format_exception_only(type(e), e))
+    except (ValueError, RecursionError, MemoryError) as e:
+        raise PreflightUnavailable(repr(e))
+    return None
+
+
+async def python_syntax_check(code):
+    return await asyncio.to_thread(python_syntax_error, code)
+
+
+class NodeSyntaxChecker:
+    """
+    node preflight.js を常駐させたヘルパープールで構文解析だけを行う。
+    nodeコマンドがない環境では検査しない（常に通過）。
+    """
+
+    def __init__(self, size=2, timeout=2.0, command=None):
+        self.size = size
+        self.timeout = timeout
+        node = shutil.which('node')
+        self.command = command or ([node, NODE_HELPER_PATH] if node else None)
+        self._idle = []
+        self._spawned = 0
+        self._available = None
+
+    def configure(self, size=2, timeout=2.0):
+        self.size = size
+        self.timeout = timeout
+
+    async def _acquire(self):
+        while True:
+            if self._idle:
+                return self._idle.pop()
+            if self._spawned < self.size:
+                self._spawned += 1
+                try:
+                    return await asyncio.create_subprocess_exec(
+                        *self.command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.DEVNULL)
+                except Exception:
+                    self._spawned -= 1
+                    raise
+            if self._available is None:
+                self._available = asyncio.Event()
+            self._available.clear()
+            await self._available.wait()
+
+    def _release(self, proc, reusable):
+        if reusable and len(self._idle) < self.size:
+            self._idle.append(proc)
+        else:
+            self._spawned -= 1
+            if proc.returncode is None:
+                proc.kill()
+        if self._available is not None:
+            self._available.set()
+
+    async def __call__(self, code):
+        if self.command is None:
+            return None
+        try:
+            proc = await self._acquire()
+        except Exception as e:
+            raise PreflightUnavailable(f'node helper start failed: {e}')
+        ok = False
+        try:
+            proc.stdin.write(json.dumps({'code': code}).encode('utf-8') + b'\n')
+            await proc.stdin.drain()
+            line = await asyncio.wait_for(proc.stdout.readline(), self.timeout)
+            if not line:
+                raise PreflightUnavailable('node helper exited')
+            result = json.loads(line)
+            ok = True
+        except (asyncio.TimeoutError, OSError, ValueError) as e:
+            raise PreflightUnavailable(f'node helper error: {e!r}')
+        finally:
+            self._release(proc, ok)
+        return None if result.get('ok') else result.get('error', 'SyntaxError\n')
+
+    async def warm(self):
+        # 起動時にヘルパーを1つ立ち上げておく（最初の検査でnodeの起動を待たない）
+        if self.command is None:
+            return
+        try:
+            proc = await self._acquire()
+        except Exception as e:
+            logger.warning(f'node preflight helper start failed: {e}')
+            return
+        self._release(proc, True)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for proc in idle:
+            self._spawned -= 1
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+
+class Preflight:
+    """
+    コンテナを使う前にバックエンドで行う事前検査。言語ごとに(名前, 検査)を登録し、登録順に実行する。
+    検査は async def check(code) -> エラーメッセージ（通過ならNone）。
+    結果（通過・エラー）は言語とコードのハッシュでLRUにキャッシュし、同じコードの再投稿では検査しない。
+    検査ができなかった場合（PreflightUnavailable）は通過として扱い、キャッシュしない。
+    """
+
+    def __init__(self, enabled=True, max_entries=10000, disabled=()):
+        self._checks = {}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'checked': 0, 'rejected': 0, 'hits': 0, 'unavailable': 0}
+        self.configure(enabled, max_entries, disabled)
+
+    def configure(self, enabled=True, max_entries=10000, disabled=()):
+        # disabled: 検査しない言語（バックエンドとランナーで処理系のバージョンが違う場合など）
+        with self._lock:
+            self.enabled = enabled
+            self.max_entries = max_entries
+            self.disabled = set(disabled)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def register(self, language, name, check):
+        self._checks.setdefault(language, []).append((name, check))
+
+    @staticmethod
+    def _key(language, code):
+        return hashlib.sha256(f'{language}\0{code}'.encode('utf-8')).hexdigest()
+
+    async def check(self, language, code):
+        """通過ならNone、不合格なら(検査名, エラーメッセージ)を返す"""
+        checks = self._checks.get(language)
+        if not self.enabled or not checks or language in self.disabled:
+            return None
+        key = self._key(language, code)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return self._entries[key]
+        failure = None
+        for name, check in checks:
+            try:
+                error = await check(code)
+            except PreflightUnavailable as e:
+                logger.warning(f'preflight {name} ({language}) unavailable: {e}')
+                with self._lock:
+                    self._counters['unavailable'] += 1
+                return None
+            if error is not None:
+                failure = (name, error)
+                break
+        with self._lock:
+            self._counters['checked'] += 1
+            if failure is not None:
+                self._counters['rejected'] += 1
+            self._entries[key] = failure
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return failure
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'entries': len(self._entries), 'enabled': self.enabled,
+                'disabled': sorted(self.disabled)}
@@ -0,0 +1,230 @@
+import collections
+import hashlib
+import threading
+import time as pytime
+
+# 共有バックエンド（Redis）で使うスクリプト。時刻はRedisのTIMEを使い、レプリカ間の時計のずれに影響されない
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], ttl)
+return tostring(retry_after)
+"""
+
+ACQUIRE_SCRIPT = """
+local running = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+if running > tonumber(ARGV[1]) then
+  redis.call('DECR', KEYS[1])
+  return 0
+end
+return 1
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('DECR', KEYS[1]) <= 0 then
+  redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+
+
+def client_identity(peer, headers, api_key_header='X-API-Key', trust_forwarded_for=False, known_keys=frozenset()):
+    """
+    レート制限の単位となるクライアントのキーを返す。
+    登録済み（known_keysにハッシュがある）APIキーならキーごと、それ以外は接続元IPごと。
+    未登録のキーは無視するので、ヘッダを変えても別のバケットにはならない。
+    trust_forwarded_forならリバースプロキシが付けたX-Forwarded-Forの先頭を接続元とみなす。
+    """
+    api_key = headers.get(api_key_header) if api_key_header and known_keys else None
+    if api_key:
+        digest = hash_api_key(api_key)
+        if digest in known_keys:
+            return 'key:' + digest
+    if trust_forwarded_for:
+        forwarded = headers.get('X-Forwarded-For')
+        if forwarded:
+            return 'ip:' + forwarded.split(',')[0].strip()
+    return 'ip:' + (peer or 'unknown')
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class LocalBackend:
+    """
+    プロセス内のバケット。テストや単一ワーカー構成ではこれを使う。
+    最後に使われた順に並べ、一定時間使われていない（満タンに戻っている）バケットと
+    上限件数を超えた分を古い順に捨てるため、メモリはクライアント数に対して有界。
+    """
+
+    def __init__(self, idle_seconds=600, max_clients=100000):
+        self.idle_seconds = idle_seconds
+        self.max_clients = max_clients
+        self._buckets = collections.OrderedDict()
+        self._running = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _evict_locked(self, now):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_clients and now - bucket.updated < self.idle_seconds:
+                break
+            del self._buckets[key]
+            self.evictions += 1
+
+    async def take(self, key, rate, burst):
+        # 経過時間分のトークンを足してから1つ消費する。足りなければ次の1トークンまでの秒数を返す
+        now = pytime.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = _Bucket(burst, now)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+            self._buckets[key] = bucket
+            self._evict_locked(now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0.0
+            return (1 - bucket.tokens) / rate
+
+    async def acquire(self, key, limit):
+        with self._lock:
+            running = self._running.get(key, 0)
+            if running >= limit:
+                return False
+            self._running[key] = running + 1
+            return True
+
+    async def release(self, key):
+        with self._lock:
+            running = self._running.get(key, 0) - 1
+            if running > 0:
+                self._running[key] = running
+            else:
+                self._running.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'local',
+                'clients': len(self._buckets),
+                'running_clients': len(self._running),
+                'evictions': self.evictions,
+            }
+
+
+class RedisBackend:
+    """
+    複数のuvicornワーカー・Swarmレプリカで制限を共有するためのRedisバケット。
+    redisパッケージは使う場合のみ必要（pip install redis）。
+    """
+
+    def __init__(self, url, idle_seconds=600, running_ttl=600, prefix='runner:ratelimit:'):
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+        self.idle_seconds = idle_seconds
+        # レプリカが落ちて解放されなかった同時実行数も、この秒数で消える
+        self.running_ttl = running_ttl
+        self.prefix = prefix
+        self._take = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._acquire = self.client.register_script(ACQUIRE_SCRIPT)
+        self._release = self.client.register_script(RELEASE_SCRIPT)
+
+    async def take(self, key, rate, burst):
+        retry_after = await self._take(keys=[self.prefix + 'bucket:' + key],
+                                       args=[rate, burst, int(self.idle_seconds)])
+        return float(retry_after)
+
+    async def acquire(self, key, limit):
+        return bool(await self._acquire(keys=[self.prefix + 'running:' + key],
+                                        args=[limit, int(self.running_ttl)]))
+
+    async def release(self, key):
+        await self._release(keys=[self.prefix + 'running:' + key])
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+class RateLimiter:
+    """
+    クライアントごとのトークンバケットによる投入レート制限と、同時実行ジョブ数の制限。
+    - 投入レート: rate_per_minuteで補充、最大burst個まで貯まる
+    - 同時実行数: max_concurrentまで（ジョブ終了時にrelease）
+    どちらも1回の判定はO(1)。拒否した場合はRetry-Afterに使う秒数を返す。
+    api_keysは個別のバケットを持てるAPIキー（それ以外のクライアントは接続元IPごと）。
+    """
+
+    def __init__(self, backend, rate_per_minute=30, burst=None, max_concurrent=4, concurrency_retry_after=1,
+                 api_keys=()):
+        self.backend = backend
+        self._counters = {'allowed': 0, 'rate_limited': 0, 'concurrency_limited': 0}
+        self.configure(rate_per_minute, burst, max_concurrent, concurrency_retry_after, api_keys)
+
+    def configure(self, rate_per_minute=30, burst=None, max_concurrent=4, concurrency_retry_after=1, api_keys=()):
+        # 補充レートで割るので0以下は受け付けない（制限をなくす場合も十分大きな値にする）
+        if not rate_per_minute or rate_per_minute <= 0:
+            raise ValueError(f'rate_per_minute must be positive: {rate_per_minute!r}')
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst if burst is not None else rate_per_minute
+        self.max_concurrent = max_concurrent
+        self.concurrency_retry_after = concurrency_retry_after
+        self.api_keys = frozenset(hash_api_key(key) for key in api_keys or ())
+
+    async def hit(self, client):
+        """投入を1回数える。許可なら0、拒否ならRetry-Afterの秒数を返す"""
+        retry_after = await self.backend.take(client, self.rate_per_minute / 60.0, self.burst)
+        if retry_after > 0:
+            self._counters['rate_limited'] += 1
+        else:
+            self._counters['allowed'] += 1
+        return retry_after
+
+    async def acquire(self, client):
+        """同時実行数の枠を取る。取れなければRetry-Afterの秒数を返す（取れたら0）"""
+        if not self.max_concurrent:
+            return 0
+        if await self.backend.acquire(client, self.max_concurrent):
+            return 0
+        self._counters['concurrency_limited'] += 1
+        return self.concurrency_retry_after
+
+    async def release(self, client):
+        if self.max_concurrent:
+            await self.backend.release(client)
+
+    def stats(self):
+        return {
+            **self._counters,
+            **self.backend.stats(),
+            'rate_per_minute': self.rate_per_minute,
+            'burst': self.burst,
+            'max_concurrent': self.max_concurrent,
+            'api_keys': len(self.api_keys),
+        }
@@ -0,0 +1,207 @@
+import datetime
+import logging
+import threading
+import time as pytime
+
+from jobs import ACTIVE_STATUSES, JOB_STATUS_LOST
+from models import CodeJob
+
+logger = logging.getLogger("uvicorn.error")
+
+# runnerコンテナに付けるラベル
+LABEL_MANAGED = 'io.runner.managed'
+LABEL_INSTANCE = 'io.runner.instance'
+LABEL_LANGUAGE = 'io.runner.language'
+
+
+def container_labels(instance_id, language):
+    return {LABEL_MANAGED: '1', LABEL_INSTANCE: instance_id, LABEL_LANGUAGE: language}
+
+
+class Reconciler:
+    """
+    runnerコンテナとcode_jobsの状態を実際の状態に合わせるバックグラウンドスレッド（interval秒ごと）。
+    - 自インスタンスのラベルが付いているのにプールが把握していないコンテナ（orphan_grace秒より古いもの）を削除する
+    - 終了済み（exited）のrunnerコンテナを、どのインスタンスのものでも削除する
+    - 応答の期限をdeadline_grace秒過ぎても返却されない使用中のコンテナを削除する（ジョブは時間制限超過になる）
+    - 自インスタンスのpending / runningの行のうち、メモリ上に実行中のジョブがないものをlostにする。
+      どのインスタンスの行でもstale_after秒より古いものはlostにする（停止したまま戻らないインスタンスの分）
+    コンテナの一覧はラベルで絞り込んだ1回のAPI呼び出しで取るため、数秒おきに実行してよい。
+    起動時にはrecover()で、前回のプロセスが残したコンテナと実行中だった行を片付ける。
+    """
+
+    def __init__(self, hosts, pool, session_factory, instance_id, active_jobs, enabled=True, interval=5,
+                 orphan_grace=60, deadline_grace=10, stale_after=3600):
+        self.hosts = hosts
+        self.pool = pool
+        self.session_factory = session_factory
+        self.instance_id = instance_id
+        # active_jobs() -> メモリ上で終了していないジョブのIDの集合
+        self.active_jobs = active_jobs
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'sweeps': 0,
+            'failed_sweeps': 0,
+            'recovered_containers': 0,
+            'recovered_jobs': 0,
+            'orphans_removed': 0,
+            'exited_removed': 0,
+            'stale_removed': 0,
+            'reaped': 0,
+            'lost_jobs': 0,
+        }
+        self.last_sweep_at = None
+        self.last_sweep_seconds = None
+        self.configure(enabled, interval, orphan_grace, deadline_grace, stale_after)
+
+    def configure(self, enabled=True, interval=5, orphan_grace=60, deadline_grace=10, stale_after=3600):
+        self.enabled = enabled
+        self.interval = interval
+        self.orphan_grace = orphan_grace
+        self.deadline_grace = deadline_grace
+        self.stale_after = stale_after
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _list(self, host, instance=None):
+        # 停止済みも含めたrunnerコンテナの一覧（instanceを指定すればそのインスタンスのもののみ）
+        labels = [f'{LABEL_MANAGED}=1']
+        if instance is not None:
+            labels.append(f'{LABEL_INSTANCE}={instance}')
+        return host.runtime.client.api.containers(all=True, filters={'label': labels})
+
+    def _remove(self, host, container_id):
+        try:
+            host.runtime.client.api.remove_container(container_id, force=True)
+            return True
+        except Exception as e:
+            logger.warning(f'reconciler remove_container error ({host.name}): {e}')
+            return False
+
+    def _mark_lost(self, db, conditions):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        count = (db.query(CodeJob)
+                 .filter(CodeJob.status.in_(ACTIVE_STATUSES), *conditions)
+                 .update({'status': JOB_STATUS_LOST, 'finished_at': now}, synchronize_session=False))
+        db.commit()
+        return count
+
+    def recover(self):
+        """
+        起動時（プールの補充を始める前）に呼ぶ。自インスタンスのラベルが付いたコンテナをすべて削除し、
+        自インスタンスのpending / runningの行をlostにする（ブロッキング）
+        """
+        for host in self.hosts.hosts:
+            try:
+                containers = self._list(host, instance=self.instance_id)
+            except Exception as e:
+                logger.warning(f'reconciler recover: list on runner host {host.name} failed: {e}')
+                continue
+            removed = sum(self._remove(host, c['Id']) for c in containers)
+            self._count('recovered_containers', removed)
+        db = self.session_factory()
+        try:
+            lost = self._mark_lost(db, [CodeJob.instance_id == self.instance_id])
+        except Exception as e:
+            db.rollback()
+            logger.warning(f'reconciler recover: marking jobs lost failed: {e}')
+            lost = 0
+        finally:
+            db.close()
+        self._count('recovered_jobs', lost)
+        if lost:
+            logger.warning(f'reconciler marked {lost} jobs left by the previous process as lost')
+
+    def _sweep_host(self, host, known, now):
+        # runnerコンテナの一覧はラベルで絞り込んだ1回の呼び出しで取り、ここで分類する
+        for c in self._list(host):
+            if c['Id'] in known:
+                # プールが把握しているもの（終了していれば返却時・アイドル超過時にプールが削除する）
+                continue
+            labels = c.get('Labels') or {}
+            age = now - c.get('Created', now)
+            if c.get('State') in ('exited', 'dead'):
+                self._count('exited_removed', self._remove(host, c['Id']))
+            elif labels.get(LABEL_INSTANCE) == self.instance_id:
+                # 作成直後でまだプールに入っていないものはorphan_graceで除く
+                if age > self.orphan_grace:
+                    self._count('orphans_removed', self._remove(host, c['Id']))
+            elif self.stale_after and age > self.stale_after:
+                # 他のインスタンスのもので古すぎるもの（停止したまま戻らないインスタンスの分）
+                self._count('stale_removed', self._remove(host, c['Id']))
+
+    def _sweep_jobs(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        db = self.session_factory()
+        try:
+            cutoff = now - datetime.timedelta(seconds=self.orphan_grace)
+            candidates = (db.query(CodeJob.uid)
+                          .filter(CodeJob.status.in_(ACTIVE_STATUSES), CodeJob.instance_id == self.instance_id,
+                                  CodeJob.created_at < cutoff)
+                          .all())
+            active = self.active_jobs()
+            lost = [row.uid for row in candidates if row.uid not in active]
+            count = self._mark_lost(db, [CodeJob.uid.in_(lost)]) if lost else 0
+            if self.stale_after:
+                count += self._mark_lost(db, [CodeJob.created_at < now - datetime.timedelta(seconds=self.stale_after)])
+            return count
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def sweep(self):
+        """1回分の照合（ブロッキング）"""
+        started = pytime.perf_counter()
+        for runner in self.pool.overdue(pytime.monotonic(), self.deadline_grace):
+            logger.warning(f'reaping runner {runner.id[:12]} on {runner.host.name} (job {runner.job_id})')
+            self.pool.reap(runner)
+            self._count('reaped')
+        known = self.pool.container_ids()
+        now = pytime.time()
+        for host in self.hosts.hosts:
+            try:
+                self._sweep_host(host, known, now)
+            except Exception as e:
+                logger.warning(f'reconciler sweep on runner host {host.name} failed: {e}')
+        lost = self._sweep_jobs()
+        self._count('lost_jobs', lost)
+        self._count('sweeps')
+        self.last_sweep_at = pytime.time()
+        self.last_sweep_seconds = pytime.perf_counter() - started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.enabled:
+                continue
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f'reconciler error: {e}', exc_info=True)
+                self._count('failed_sweeps')
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='reconciler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['enabled'] = self.enabled
+        stats['instance_id'] = self.instance_id
+        stats['last_sweep_at'] = self.last_sweep_at
+        stats['last_sweep_seconds'] = self.last_sweep_seconds
+        return stats
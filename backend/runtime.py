@@ -0,0 +1,180 @@
+import os
+import threading
+import time as pytime
+import logging
+
+import docker
+
+from languages import LANGUAGES
+
+logger = logging.getLogger("uvicorn.error")
+
+SECCOMP_PROFILE_PATH = os.path.join(os.path.dirname(__file__), '../runner/seccomp_profile.json')
+
+
+def runner_image(language):
+    # 言語プラグインのイメージ（登録されていない言語は runner-<言語>:latest）
+    plugin = LANGUAGES.get(language)
+    return plugin.image if plugin is not None else f"runner-{language}:latest"
+
+
+def get_resource_limits(image):
+    # Dockerイメージの環境変数からメモリ・CPU制限値を取得
+    image_env = image.attrs.get('Config', {}).get('Env', [])
+    mem_limit = None
+    cpu_limit = None
+    for env_var in image_env:
+        if env_var.startswith('CONTAINER_MAX_MEM='):
+            mem_limit = env_var.split('=')[1]
+        elif env_var.startswith('CONTAINER_MAX_CPU='):
+            try:
+                cpu_limit = float(env_var.split('=')[1])
+            except Exception:
+                cpu_limit = None
+    if not mem_limit:
+        mem_limit = '512m'
+    if not cpu_limit or cpu_limit <= 0:
+        cpu_limit = 1.0
+    return mem_limit, cpu_limit
+
+
+class ImageInfo:
+    """言語イメージのID・リソース制限と、それから組み立てたhost_config"""
+
+    __slots__ = ('image_id', 'mem_limit', 'cpu_limit', 'host_config', 'checked_at')
+
+    def __init__(self, image_id, mem_limit, cpu_limit, host_config):
+        self.image_id = image_id
+        self.mem_limit = mem_limit
+        self.cpu_limit = cpu_limit
+        self.host_config = host_config
+        self.checked_at = pytime.monotonic()
+
+
+class RuntimeContext:
+    """
+    起動時に1回だけ組み立て、リクエスト間で共有する実行環境。
+    - コネクションプール付きのDockerクライアント
+    - 言語ごとのイメージ情報とhost_config（image_refresh_interval秒ごとにIDを確認し、変わったら作り直す）
+    - seccompプロファイル（読み込みは1回）
+    - リクエストのサイズ制限値
+    reload()で設定ファイルの再読込とあわせてすべて作り直す。
+    """
+
+    def __init__(self, config, client_factory=None, base_url=None, tls=None):
+        self.client_factory = client_factory
+        # 接続先のDockerエンドポイント（未指定なら環境変数・ローカルのソケット）
+        self.base_url = base_url
+        self.tls = tls
+        self._lock = threading.Lock()
+        self._client = None
+        self._images = {}
+        # バックグラウンドで再確認中の言語
+        self._refreshing = set()
+        self.load(config)
+
+    def load(self, config):
+        self.config = config
+        self.image_refresh_interval = config.get('image_refresh_interval', 30)
+        self.docker_pool_size = config.get('docker_pool_size', 16)
+        self.max_request_body_size = config.get('max_request_body_size', 1048576)
+        self.max_code_length = config.get('max_code_length', 10000)
+        self.security_opt = self._load_seccomp()
+        with self._lock:
+            self._images = {}
+
+    def _load_seccomp(self):
+        if not os.path.exists(SECCOMP_PROFILE_PATH):
+            return None
+        with open(SECCOMP_PROFILE_PATH, 'r') as f:
+            return [f"seccomp={f.read()}"]
+
+    @property
+    def client(self):
+        # Docker未起動でもimportできるよう、クライアントは初回使用時に作る
+        with self._lock:
+            if self._client is None:
+                if self.client_factory is not None:
+                    self._client = self.client_factory()
+                elif self.base_url:
+                    self._client = docker.DockerClient(
+                        base_url=self.base_url, tls=self.tls or False, max_pool_size=self.docker_pool_size)
+                else:
+                    self._client = docker.from_env(max_pool_size=self.docker_pool_size)
+            return self._client
+
+    def reload(self, config):
+        with self._lock:
+            old_client, self._client = self._client, None
+        if old_client is not None:
+            try:
+                old_client.close()
+            except Exception as e:
+                logger.warning(f'docker client close error: {e}')
+        self.load(config)
+
+    def cached_image_info(self, language):
+        """再確認の期限内ならキャッシュ済みのイメージ情報を返す（Docker APIは呼ばない）"""
+        info = self._images.get(language)
+        if info is not None and pytime.monotonic() - info.checked_at < self.image_refresh_interval:
+            return info
+        return None
+
+    def last_image_info(self, language):
+        """
+        再確認の期限に関係なく最後に読み込んだイメージ情報を返す（未読込ならNone、Docker APIは呼ばない）。
+        期限切れ・未読込ならバックグラウンドのスレッドで再確認する。
+        """
+        info = self._images.get(language)
+        if info is None or pytime.monotonic() - info.checked_at >= self.image_refresh_interval:
+            self.refresh_image_info(language)
+        return info
+
+    def refresh_image_info(self, language):
+        # 同じ言語の再確認は同時に1つだけ
+        with self._lock:
+            if language in self._refreshing:
+                return
+            self._refreshing.add(language)
+
+        def run():
+            try:
+                self.image_info(language)
+            except Exception as e:
+                logger.warning(f'image refresh failed ({language}): {e}')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(language)
+
+        threading.Thread(target=run, name=f'image-refresh-{language}', daemon=True).start()
+
+    def image_info(self, language):
+        """イメージ情報を返す。期限切れならイメージIDを確認し、変わっていれば作り直す（ブロッキング）"""
+        info = self.cached_image_info(language)
+        if info is not None:
+            return info
+        client = self.client
+        image = client.images.get(runner_image(language))
+        info = self._images.get(language)
+        if info is not None and info.image_id == image.id:
+            info.checked_at = pytime.monotonic()
+            return info
+        mem_limit, cpu_limit = get_resource_limits(image)
+        host_config = client.api.create_host_config(
+            network_mode='none',
+            mem_limit=mem_limit,
+            nano_cpus=int(cpu_limit * 1e9),
+            security_opt=self.security_opt
+        )
+        info = ImageInfo(image.id, mem_limit, cpu_limit, host_config)
+        with self._lock:
+            self._images[language] = info
+        return info
+
+    def warm(self, languages):
+        # 起動時に各言語のイメージ情報を読み込んでおく（失敗しても起動は続ける）
+        for language in languages:
+            try:
+                self.image_info(language)
+            except Exception as e:
+                logger.warning(f'image warmup failed ({language}): {e}')
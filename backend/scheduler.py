@@ -0,0 +1,142 @@
+import asyncio
+import collections
+import time as pytime
+from contextlib import asynccontextmanager
+
+from metrics import Histogram
+
+# キュー待ち時間（秒）とキュー長のヒストグラム境界
+WAIT_TIME_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+QUEUE_DEPTH_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+
+class QueueFullError(Exception):
+    """キューが上限に達しているため受け付けられない"""
+
+
+class QueueTimeoutError(Exception):
+    """キューでの待ち時間が上限を超えた"""
+
+
+class _Waiter:
+    __slots__ = ('language', 'future', 'enqueued_at')
+
+    def __init__(self, language, future):
+        self.language = language
+        self.future = future
+        self.enqueued_at = pytime.monotonic()
+
+
+class JobScheduler:
+    """
+    イベントループ上で動くジョブの受付キュー。
+    - 全体の同時実行数と言語ごとの同時実行数を制限する
+    - 空きがなければFIFOで待たせる（上限言語のジョブは他言語のジョブを塞がない）
+    - キュー長が上限なら即座にQueueFullError、待ち時間が上限を超えたらQueueTimeoutError
+    スレッドは使わないため、スロット操作はすべて同じイベントループから行うこと。
+    """
+
+    def __init__(self, max_concurrency=8, per_language=None, max_queue_depth=100, max_queue_wait=30.0):
+        self._queue = collections.deque()
+        self._running = collections.Counter()
+        self._total_running = 0
+        self.wait_time = Histogram(WAIT_TIME_BUCKETS)
+        self.queue_depth = Histogram(QUEUE_DEPTH_BUCKETS)
+        self._counters = {'admitted': 0, 'rejected_full': 0, 'rejected_timeout': 0, 'completed': 0}
+        self.configure(max_concurrency, per_language, max_queue_depth, max_queue_wait)
+
+    def configure(self, max_concurrency=8, per_language=None, max_queue_depth=100, max_queue_wait=30.0):
+        # 上限を増やした場合は待機中のジョブをすぐに流す
+        self.max_concurrency = max_concurrency
+        self.per_language = dict(per_language or {})
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait
+        self._dispatch()
+
+    def _has_capacity(self, language):
+        if self._total_running >= self.max_concurrency:
+            return False
+        limit = self.per_language.get(language)
+        return limit is None or self._running[language] < limit
+
+    def _queued(self, language):
+        return any(waiter.language == language and not waiter.future.done() for waiter in self._queue)
+
+    def _take_slot(self, language):
+        self._running[language] += 1
+        self._total_running += 1
+
+    def _release_slot(self, language):
+        self._running[language] -= 1
+        self._total_running -= 1
+        self._counters['completed'] += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # 先頭から順に、空きのある言語のジョブへスロットを渡す
+        remaining = collections.deque()
+        while self._queue:
+            waiter = self._queue.popleft()
+            if waiter.future.done():
+                continue
+            if self._total_running >= self.max_concurrency:
+                remaining.append(waiter)
+                break
+            if self._has_capacity(waiter.language):
+                self._take_slot(waiter.language)
+                waiter.future.set_result(None)
+            else:
+                remaining.append(waiter)
+        remaining.extend(self._queue)
+        self._queue = remaining
+
+    async def _wait_for_slot(self, language):
+        if len(self._queue) >= self.max_queue_depth:
+            self._counters['rejected_full'] += 1
+            raise QueueFullError()
+        waiter = _Waiter(language, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        try:
+            done, _ = await asyncio.wait({waiter.future}, timeout=self.max_queue_wait)
+        except BaseException:
+            # 待機中にキャンセルされた場合、直前にスロットを受け取っていれば返す
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release_slot(language)
+            else:
+                waiter.future.cancel()
+            raise
+        if not done:
+            waiter.future.cancel()
+            self._counters['rejected_timeout'] += 1
+            raise QueueTimeoutError()
+        return pytime.monotonic() - waiter.enqueued_at
+
+    @asynccontextmanager
+    async def slot(self, language):
+        """実行スロットを確保してからブロック内を実行する"""
+        self.queue_depth.observe(len(self._queue))
+        # 空きがあれば、キューに残っているのが他言語の上限で待つジョブだけのときも待たずに実行する
+        # （同じ言語のジョブが先に待っていれば順番を守る）
+        if self._has_capacity(language) and not self._queued(language):
+            self._take_slot(language)
+            waited = 0.0
+        else:
+            waited = await self._wait_for_slot(language)
+        self.wait_time.observe(waited)
+        self._counters['admitted'] += 1
+        try:
+            yield waited
+        finally:
+            self._release_slot(language)
+
+    def stats(self):
+        return {
+            **self._counters,
+            'queue_depth': len(self._queue),
+            'running': self._total_running,
+            'running_by_language': dict(self._running),
+            'max_concurrency': self.max_concurrency,
+            'per_language': dict(self.per_language),
+            'wait_time_seconds': self.wait_time.snapshot(),
+            'queue_depth_histogram': self.queue_depth.snapshot(),
+        }
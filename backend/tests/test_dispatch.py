@@ -0,0 +1,114 @@
+"""
+複数のランナーホストでイメージが違う場合に、実行ファイルのキャッシュキー・結果キャッシュのキー・
+バッチの並列数を、振り分け後に実際にジョブを実行するホストのイメージ情報から決めることの確認。
+
+    cd backend && python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# DBはメモリ上のSQLiteを使う（db.engine_options）
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import main  # noqa: E402
+from artifacts import artifact_cache_key  # noqa: E402
+from hosts import RunnerHost  # noqa: E402
+from jobs import Job  # noqa: E402
+from languages import LANGUAGES  # noqa: E402
+from metrics import Timing  # noqa: E402
+from pool import PooledContainer  # noqa: E402
+from runtime import RuntimeContext  # noqa: E402
+
+CODE = 'int main(void) { return 0; }'
+
+
+class StubImage:
+    def __init__(self, image_id, cpu):
+        self.id = image_id
+        self.attrs = {'Config': {'Env': ['CONTAINER_MAX_MEM=256m', f'CONTAINER_MAX_CPU={cpu}']}}
+
+
+class StubClient:
+    def __init__(self, image):
+        self.image = image
+        self.images = self
+        self.api = self
+
+    def get(self, name):
+        return self.image
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+
+def stub_host(name, image_id, cpu):
+    client = StubClient(StubImage(image_id, cpu))
+    return RunnerHost(name, RuntimeContext({}, client_factory=lambda: client), cpus=8, memory='8g')
+
+
+class StubChannel:
+    """送られたジョブを記録し、すぐに結果フレームを返すRunnerChannel"""
+
+    def __init__(self):
+        self.job = None
+
+    async def send_job(self, job):
+        self.job = job
+
+    async def read_frame(self, timeout=None):
+        return {'type': 'result', 'exit_code': 0, 'time': 0.0, 'skipped': 0}
+
+
+class DispatchedHostImageTest(unittest.TestCase):
+    def setUp(self):
+        self.primary = stub_host('primary', 'sha256:primary', 1.0)
+        self.other = stub_host('other', 'sha256:other', 3.0)
+        self.channel = StubChannel()
+        self.runner = PooledContainer('c1', self.other, 'c', self.channel)
+        # 最も空いているホストはprimaryだが、ジョブはotherで実行される
+        for patch in (mock.patch.object(main.host_registry, 'hosts', [self.primary, self.other]),
+                      mock.patch.object(main, 'acquire_runner', self.acquire_runner),
+                      mock.patch.object(main.container_pool, 'release', lambda runner, ok: None),
+                      mock.patch.object(main.artifact_cache, 'enabled', True),
+                      mock.patch.object(main.artifact_cache, 'get', self.cached_binary)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.artifact_keys = []
+
+    async def acquire_runner(self, language, timing):
+        return self.runner
+
+    def cached_binary(self, key):
+        self.artifact_keys.append(key)
+        return b'binary'
+
+    def expected_artifact_key(self, image_id):
+        return artifact_cache_key('c', image_id, CODE, LANGUAGES.get('c').compile_command())
+
+    def test_batch_uses_the_dispatched_host(self):
+        request = main.BatchRequest(language='c', code=CODE, cases=[main.BatchCase()] * 4)
+        response = asyncio.run(main.run_batch_on_runner(request, Timing()))
+        self.assertEqual(response.debug['host'], 'other')
+        self.assertEqual(self.channel.job['parallel'], 3)
+        self.assertEqual(self.artifact_keys, [self.expected_artifact_key('sha256:other')])
+        self.assertIn('binary', self.channel.job)
+
+    def test_run_uses_the_dispatched_host(self):
+        job = Job('c', CODE, '', main.output_limits)
+        asyncio.run(main.run_on_runner(job))
+        self.assertIs(job.host, self.other)
+        self.assertEqual(self.artifact_keys, [self.expected_artifact_key('sha256:other')])
+
+    def test_result_cache_key_follows_the_host_image(self):
+        job = Job('c', CODE, '', main.output_limits)
+        lookup_key = asyncio.run(main.cache_key_for(job))
+        self.assertEqual(lookup_key, asyncio.run(main.cache_key_for(job, self.primary)))
+        self.assertNotEqual(lookup_key, asyncio.run(main.cache_key_for(job, self.other)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+RunnerHost.reserveが、イメージ情報の再確認期限（image_refresh_interval）を過ぎても
+CPU・メモリを確保し続けることの確認。
+
+    cd backend && python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import runtime  # noqa: E402
+from hosts import RunnerHost  # noqa: E402
+
+REFRESH_INTERVAL = 30
+
+
+class StubImage:
+    id = 'sha256:stub'
+    attrs = {'Config': {'Env': ['CONTAINER_MAX_MEM=256m', 'CONTAINER_MAX_CPU=0.5']}}
+
+
+class StubClient:
+    """イメージの取得回数だけを数えるDockerクライアント"""
+
+    def __init__(self):
+        self.image_gets = 0
+        self.images = self
+        self.api = self
+
+    def get(self, name):
+        self.image_gets += 1
+        return StubImage()
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class ReserveAfterRefreshIntervalTest(unittest.TestCase):
+    def setUp(self):
+        self.client = StubClient()
+        self.runtime = runtime.RuntimeContext({'image_refresh_interval': REFRESH_INTERVAL},
+                                              client_factory=lambda: self.client)
+        self.host = RunnerHost('local', self.runtime, cpus=4, memory='4g')
+
+    def advance_clock(self, seconds):
+        real = time.monotonic
+        return mock.patch.object(runtime.pytime, 'monotonic', lambda: real() + seconds)
+
+    def test_reservation_survives_refresh_interval(self):
+        self.runtime.image_info('python')
+        self.assertEqual(self.host.reserve('python'), (0.5, 256 * 1024 * 1024))
+
+        with self.advance_clock(REFRESH_INTERVAL + 1):
+            reservation = self.host.reserve('python')
+            # 期限切れでも最後に読み込んだ制限値で確保し、再確認はバックグラウンドで行う
+            self.assertEqual(reservation, (0.5, 256 * 1024 * 1024))
+            wait_for(lambda: self.client.image_gets == 2 and not self.runtime._refreshing)
+
+        self.assertEqual(self.host.running, 2)
+        self.assertEqual(self.host.reserved_cpu, 1.0)
+        self.assertEqual(self.host.reserved_memory, 2 * 256 * 1024 * 1024)
+        self.host.unreserve(reservation)
+        self.assertEqual(self.host.reserved_cpu, 0.5)
+
+    def test_unloaded_image_is_loaded_in_background(self):
+        # 未読込の言語は0で数え、次のジョブからは読み込んだ制限値を使う
+        self.assertEqual(self.host.reserve('node'), (0.0, 0))
+        wait_for(lambda: self.runtime.cached_image_info('node') is not None)
+        self.assertEqual(self.host.reserve('node'), (0.5, 256 * 1024 * 1024))
+
+
+if __name__ == '__main__':
+    unittest.main()
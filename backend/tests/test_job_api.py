@@ -0,0 +1,98 @@
+"""
+ジョブAPIの確認。
+- GET /jobs/{job_id}/output/{stream} のRange（bytes=start-end / start- / -suffix）での部分取得を、
+  実行中のジョブ（バックエンドのメモリ上）と保存済みのジョブ（圧縮した出力全体）の両方で行える
+- GET /jobs はuidのない行（/testBで入れた行など）があっても一覧を返す
+
+    cd backend && python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# DBはメモリ上のSQLiteを使う（db.engine_options）
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+from jobs import Job  # noqa: E402
+from models import CodeJob  # noqa: E402
+
+OUTPUT = 'héllo wörld\n'
+
+
+class ByteRangeTest(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(main.byte_range('bytes=0-4', 10), (0, 4))
+        self.assertEqual(main.byte_range('bytes=4-', 10), (4, 9))
+        self.assertEqual(main.byte_range('bytes=-3', 10), (7, 9))
+        # 終わりが長さを超える範囲・長さを超える末尾指定は、ある分だけにする
+        self.assertEqual(main.byte_range('bytes=8-100', 10), (8, 9))
+        self.assertEqual(main.byte_range('bytes=-100', 10), (0, 9))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=10-', 'bytes=5-3', 'bytes=-0', 'bytes=0-1,3-4', 'items=0-1', 'bytes=a-b'):
+            with self.subTest(header=header), self.assertRaises(ValueError):
+                main.byte_range(header, 10)
+        with self.assertRaises(ValueError):
+            main.byte_range('bytes=0-', 0)
+
+
+class JobApiTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(main.app)
+        self.db = main.SessionLocal()
+        self.addCleanup(self.db.close)
+        self.addCleanup(self.delete_rows)
+
+    def delete_rows(self):
+        self.db.query(CodeJob).delete()
+        self.db.commit()
+
+    def get_output(self, job_id, range_header=None):
+        headers = {'Range': range_header} if range_header else {}
+        return self.client.get(f'/jobs/{job_id}/output/stdout', headers=headers)
+
+    def assert_ranges(self, job_id):
+        body = OUTPUT.encode('utf-8')
+        response = self.get_output(job_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, body)
+        response = self.get_output(job_id, 'bytes=1-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, body[1:6])
+        self.assertEqual(response.headers['content-range'], f'bytes 1-5/{len(body)}')
+        response = self.get_output(job_id, 'bytes=-6')
+        self.assertEqual(response.content, body[-6:])
+        response = self.get_output(job_id, f'bytes={len(body)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['content-range'], f'bytes */{len(body)}')
+
+    def test_range_of_running_job(self):
+        job = Job('python', 'print(1)', '', main.output_limits)
+        job.append_output('stdout', OUTPUT)
+        main.job_registry.add(job)
+        self.assert_ranges(job.id)
+
+    def test_range_of_stored_job(self):
+        # インライン列は先頭だけのプレビューで、全体は圧縮して保存した行
+        self.db.add(CodeJob(uid='stored', language='python', status='done', result_stdout=OUTPUT[:3],
+                            result_stdout_compressed=zlib.compress(OUTPUT.encode('utf-8'))))
+        self.db.commit()
+        self.assert_ranges('stored')
+        self.assertEqual(self.get_output('missing').status_code, 404)
+
+    def test_listing_skips_rows_without_uid(self):
+        self.db.add(CodeJob(uid='listed', language='python', status='done', result_exit_code=0))
+        self.db.add(CodeJob(language='python', code='print(1)', stdin='', status='pending'))
+        self.db.commit()
+        response = self.client.get('/jobs')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([job['job_id'] for job in response.json()['jobs']], ['listed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
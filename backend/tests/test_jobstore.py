@@ -0,0 +1,59 @@
+"""
+ジョブ一覧（jobstore.list_jobs）が、uidのない行（/testBで入れた行・uid追加前の行）を含めず、
+カーソルで続きのページを重複なく返すことの確認。
+
+    cd backend && python -m unittest discover -s tests
+"""
+import datetime
+import os
+import sys
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobstore import list_jobs  # noqa: E402
+from models import Base, CodeJob  # noqa: E402
+
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class ListJobsTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        self.addCleanup(engine.dispose)
+        self.addCleanup(self.db.close)
+
+    def add(self, uid, minutes, **columns):
+        self.db.add(CodeJob(uid=uid, language='python', status='done',
+                            created_at=START + datetime.timedelta(minutes=minutes), **columns))
+        self.db.commit()
+
+    def test_rows_without_uid_are_not_listed(self):
+        self.add('a', 0)
+        self.add(None, 1, code='print(1)')
+        self.add('b', 2)
+        rows, next_cursor = list_jobs(self.db)
+        self.assertEqual([row.uid for row in rows], ['b', 'a'])
+        self.assertIsNone(next_cursor)
+
+    def test_pages_follow_the_cursor(self):
+        for i in range(5):
+            self.add(f'j{i}', i)
+        self.add(None, 10)
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = list_jobs(self.db, limit=2, cursor=cursor, order='asc')
+            seen += [row.uid for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['j0', 'j1', 'j2', 'j3', 'j4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
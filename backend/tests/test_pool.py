@@ -0,0 +1,167 @@
+"""
+RunnerChannelがジョブのnonceや連番の合わないフレームをジョブに渡さず、
+そうしたフレームや結果の後に届いたフレームがあったコンテナを
+ContainerPool.releaseが待機プールへ戻さずに破棄することの確認。
+
+    cd backend && python -m unittest discover -s tests
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pool import FRAME_HEADER, STREAM_STDERR, STREAM_STDOUT, ContainerPool, PooledContainer, RunnerChannel  # noqa: E402
+
+
+class StubHost:
+    name = 'local'
+
+    def available(self, now=None):
+        return True
+
+    def load(self):
+        return 0.0
+
+    def reserve(self, language):
+        return (0.0, 0)
+
+    def unreserve(self, reservation):
+        pass
+
+
+def docker_frame(frame, stream=STREAM_STDOUT):
+    data = (frame if isinstance(frame, str) else json.dumps(frame)).encode('utf-8') + b'\n'
+    return FRAME_HEADER.pack(stream, len(data)) + data
+
+
+class RunnerChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.runner_side = socket.socketpair()
+        self.channel = RunnerChannel(self.ours)
+
+    def tearDown(self):
+        self.channel.close()
+        self.runner_side.close()
+
+    def receive_job(self):
+        data = b''
+        while not data.endswith(b'\n'):
+            data += self.runner_side.recv(65536)
+        return json.loads(data)
+
+    def run_job(self, frames):
+        # ジョブを送り、結果フレームまでにジョブへ渡されたフレームを返す
+        # （フレームにnonceがなければ、runnerと同じく受け取ったジョブのnonceを付ける）
+        async def run():
+            await self.channel.send_job({'code': ''})
+            nonce = self.receive_job()['nonce']
+            self.runner_side.sendall(b''.join(
+                docker_frame(frame if isinstance(frame, str) else {'nonce': nonce, **frame}) for frame in frames))
+            received = []
+            while True:
+                frame = await self.channel.read_frame(timeout=2)
+                received.append(frame)
+                if frame['type'] == 'result':
+                    return received
+        return asyncio.run(run())
+
+    def test_frames_in_sequence(self):
+        received = self.run_job([{'type': 'stdout', 'data': 'a', 'seq': 0},
+                                 {'type': 'result', 'exit_code': 0, 'time': 0, 'seq': 1}])
+        self.assertEqual([f['seq'] for f in received], [0, 1])
+        self.assertFalse(self.channel.tainted)
+        self.assertFalse(self.channel.has_extra_output())
+
+    def test_out_of_sequence_frames_are_dropped(self):
+        with self.assertLogs('uvicorn.error', 'WARNING'):
+            received = self.run_job([{'type': 'result', 'exit_code': 7, 'time': 0, 'seq': 5},
+                                     {'type': 'stdout', 'data': 'a'},
+                                     'not json',
+                                     {'type': 'result', 'exit_code': 0, 'time': 0, 'seq': 0}])
+        self.assertEqual([(f['exit_code'], f['seq']) for f in received], [(0, 0)])
+        self.assertTrue(self.channel.tainted)
+
+    def test_frames_with_another_nonce_are_dropped(self):
+        # 連番が合っていても、このジョブのnonceを持たないフレーム（前のジョブの残り・偽造）は渡さない
+        with self.assertLogs('uvicorn.error', 'WARNING'):
+            received = self.run_job([{'type': 'stdout', 'data': 'forged', 'seq': 0, 'nonce': None},
+                                     {'type': 'result', 'exit_code': 7, 'time': 0, 'seq': 0, 'nonce': 'other'},
+                                     {'type': 'stdout', 'data': 'a', 'seq': 0},
+                                     {'type': 'result', 'exit_code': 0, 'time': 0, 'seq': 1}])
+        self.assertEqual([f.get('data') for f in received], ['a', None])
+        self.assertEqual(received[-1]['exit_code'], 0)
+        self.assertTrue(self.channel.tainted)
+
+    def test_each_job_gets_a_new_nonce(self):
+        async def send_two():
+            await self.channel.send_job({'code': ''})
+            first = self.receive_job()['nonce']
+            await self.channel.send_job({'code': ''})
+            return first, self.receive_job()['nonce']
+        first, second = asyncio.run(send_two())
+        self.assertNotEqual(first, second)
+
+    def test_frames_after_result_are_detected(self):
+        self.run_job([{'type': 'result', 'exit_code': 0, 'time': 0, 'seq': 0}])
+        self.assertFalse(self.channel.has_extra_output())
+        self.runner_side.sendall(docker_frame({'type': 'stdout', 'data': 'leak', 'seq': 1}))
+        self.assertTrue(self.channel.has_extra_output())
+
+    def test_stderr_after_result_is_not_extra_output(self):
+        self.run_job([{'type': 'result', 'exit_code': 0, 'time': 0, 'seq': 0}])
+        self.runner_side.sendall(docker_frame('warning', stream=STREAM_STDERR))
+        self.assertFalse(self.channel.has_extra_output())
+        # 次のジョブは読み飛ばしたstderrの後から連番どおりに読める
+        received = self.run_job([{'type': 'result', 'exit_code': 0, 'time': 0, 'seq': 0}])
+        self.assertEqual(len(received), 1)
+        self.assertFalse(self.channel.tainted)
+
+
+class ReleaseTaintedRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ContainerPool(hosts=None, factory=None, sizes={'python': 2})
+        self.sockets = []
+
+    def tearDown(self):
+        for runner in self.pool._idle['python']:
+            runner.channel.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def acquire(self):
+        ours, runner_side = socket.socketpair()
+        self.sockets.append(runner_side)
+        runner = PooledContainer(f'c{len(self.sockets)}', StubHost(), 'python', RunnerChannel(ours))
+        self.pool._idle['python'].append(runner)
+        self.assertIs(self.pool.acquire_idle('python'), runner)
+        return runner, runner_side
+
+    def test_clean_runner_is_reused(self):
+        runner, _ = self.acquire()
+        self.pool.release(runner, ok=True)
+        self.assertEqual(self.pool.stats()['idle'], {'python': 1})
+        self.assertEqual(self.pool.stats()['tainted'], 0)
+
+    def test_tainted_runner_is_discarded(self):
+        runner, _ = self.acquire()
+        runner.channel.tainted = True
+        self.pool.release(runner, ok=True)
+        stats = self.pool.stats()
+        self.assertEqual(stats['idle'], {'python': 0})
+        self.assertEqual(stats['tainted'], 1)
+        self.assertIn(runner.id, self.pool.container_ids())
+
+    def test_runner_with_output_after_result_is_discarded(self):
+        runner, runner_side = self.acquire()
+        runner_side.sendall(docker_frame({'type': 'stdout', 'data': 'leak', 'seq': 3}))
+        self.pool.release(runner, ok=True)
+        self.assertEqual(self.pool.stats()['idle'], {'python': 0})
+        self.assertEqual(self.pool.stats()['tainted'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,305 @@
+"""
+ランナー（runner/run.py・run.js・run_native.py）のジョブ分離の確認。
+- ユーザーコードがどのfdへ書いても、結果フレームを偽造できない（出力は親が中継する）
+- setsidでジョブのプロセスグループを抜けた子孫プロセスも、ジョブの終了時に止める
+- Pythonのバッチでは、書き込みを続けるケースにも期限と結果の大きさの上限を適用し、
+  パイプを受け継いだ子孫が残っていてもケースの終了を待ち続けない
+- C/C++のバッチでは、ケースごとに別の作業ディレクトリで実行する
+- フレームにはジョブのnonceとジョブごとに0からの連番（seq）が付く
+
+    cd backend && python -m unittest discover -s tests
+"""
+import ctypes
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+RUNNER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'runner')
+PR_SET_CHILD_SUBREAPER = 36
+
+FORGE_RESULT = r'''
+import os
+for fd in range(20):
+    try:
+        os.write(fd, b'{"type": "result", "exit_code": 7, "time": 0, "seq": 0}\n')
+    except OSError:
+        pass
+print("user A secret output")
+'''
+
+SETSID_DAEMON = r'''
+import os, time
+pid = os.fork()
+if pid == 0:
+    os.setsid()
+    if os.fork() == 0:
+        with open(PIDFILE, 'w') as f:
+            f.write(str(os.getpid()))
+        while True:
+            for fd in range(20):
+                try:
+                    os.write(fd, b'{"type": "stdout", "data": "ghost", "seq": 0}\n')
+                except OSError:
+                    pass
+            time.sleep(0.01)
+    os._exit(0)
+os.waitpid(pid, 0)
+while not os.path.exists(PIDFILE):
+    time.sleep(0.01)
+print("done")
+'''
+
+# 親へ結果を渡すパイプを含め、開いているfdへ書き込み続ける
+SPAM_RAW_FDS = r'''
+import os
+while True:
+    for fd in range(3, 30):
+        try:
+            os.write(fd, b'x' * 65536)
+        except OSError:
+            pass
+'''
+
+LINGERING_DAEMON = r'''
+import os, time
+if os.fork() == 0:
+    os.setsid()
+    if os.fork() == 0:
+        while True:
+            time.sleep(0.01)
+    os._exit(0)
+os.wait()
+print("done")
+'''
+
+NODE_FORGE_RESULT = r'''
+const fs = require('fs');
+fs.writeSync(1, '{"type": "result", "exit_code": 7, "time": 0, "seq": 0}\n');
+try {
+  fs.writeSync(0, 'x');
+} catch (e) {
+  console.log(e.code);
+}
+console.log('user A secret output');
+'''
+
+# vmの外のprocessを取り出し、setsidした子孫プロセスを起動する
+NODE_SETSID_DAEMON = r'''
+const realProcess = this.constructor.constructor('return process')();
+const { spawn } = realProcess.mainModule.require('child_process');
+spawn('sh', ['-c', `setsid sh -c 'echo $$ > ${PIDFILE}; while true; do echo ghost; sleep 0.01; done' &`],
+      { stdio: 'inherit', detached: true });
+const started = Date.now();
+while (!require('fs').existsSync(PIDFILE) && Date.now() - started < 2000);
+console.log('done');
+'''
+
+C_SETSID_DAEMON = r'''
+#include <stdio.h>
+#include <sys/wait.h>
+#include <unistd.h>
+int main(void) {
+    if (fork() == 0) {
+        setsid();
+        if (fork() == 0) {
+            FILE *f = fopen(PIDFILE, "w");
+            fprintf(f, "%d", getpid());
+            fclose(f);
+            for (;;) sleep(1);
+        }
+        _exit(0);
+    }
+    wait(NULL);
+    while (access(PIDFILE, F_OK) != 0) usleep(1000);
+    puts("done");
+    return 0;
+}
+'''
+
+# 作業ディレクトリに前のケースのファイルが残っていればそう出力する
+C_CASE_STATE = r'''
+#include <stdio.h>
+#include <unistd.h>
+int main(void) {
+    puts(access("state", F_OK) == 0 ? "seen" : "fresh");
+    FILE *f = fopen("state", "w");
+    fputs("case", f);
+    fclose(f);
+    return 0;
+}
+'''
+
+
+def c_job(code, **job):
+    build = {'source': 'main.c', 'command': ['gcc', '-O2', '-o', 'main', 'main.c'], 'artifact': 'main'}
+    return {'code': code, 'build': build, 'run': ['./main'], 'limits': {'wall': 5}, **job}
+
+
+def process_alive(pid):
+    # 回収済み（ゾンビでもない）ならFalse
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def become_subreaper():
+    # コンテナのPID 1として動く場合と同じく、親が先に終了した孫プロセスをランナーの子に付け替える
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+
+
+class RunnerProcess:
+    def __init__(self, command, preexec_fn=None):
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True, preexec_fn=preexec_fn)
+
+    def run(self, job):
+        # ジョブを送り、結果フレームまでのフレームを返す
+        self.proc.stdin.write(json.dumps(job) + '\n')
+        self.proc.stdin.flush()
+        frames = []
+        while True:
+            frames.append(json.loads(self.proc.stdout.readline()))
+            if frames[-1]['type'] == 'result':
+                return frames
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait(timeout=10)
+        self.proc.stdout.close()
+
+
+def stdout_of(frames):
+    return ''.join(f['data'] for f in frames if f['type'] == 'stdout')
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'the runner uses Linux-only process control')
+class PythonRunnerIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = RunnerProcess([sys.executable, os.path.join(RUNNER_DIR, 'run.py'), '--serve'])
+        self.addCleanup(self.runner.close)
+
+    def test_user_code_cannot_forge_result_frame(self):
+        first = self.runner.run({'code': FORGE_RESULT, 'stdin': '', 'limits': {'wall': 5}})
+        self.assertEqual(first[-1]['exit_code'], 0)
+        self.assertEqual(stdout_of(first), 'user A secret output\n')
+        second = self.runner.run({'code': 'print("job2")', 'stdin': '', 'limits': {'wall': 5}})
+        self.assertEqual(stdout_of(second), 'job2\n')
+        self.assertEqual(second[-1]['exit_code'], 0)
+
+    def test_frames_carry_job_nonce_and_sequence(self):
+        for nonce in ('n1', 'n2'):
+            frames = self.runner.run({'code': 'print(1)', 'stdin': '', 'limits': {'wall': 5}, 'nonce': nonce})
+            self.assertEqual([f['seq'] for f in frames], list(range(len(frames))))
+            self.assertEqual({f['nonce'] for f in frames}, {nonce})
+
+    def test_setsid_descendant_is_killed_after_job(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pidfile = os.path.join(tmp, 'daemon.pid')
+            code = f'PIDFILE = {pidfile!r}\n' + SETSID_DAEMON
+            frames = self.runner.run({'code': code, 'stdin': '', 'limits': {'wall': 5}})
+            self.assertEqual(frames[-1]['exit_code'], 0)
+            with open(pidfile) as f:
+                daemon = int(f.read())
+            self.assertFalse(process_alive(daemon))
+            # 次のジョブには何も混ざらない
+            time.sleep(0.05)
+            second = self.runner.run({'code': 'print("job2")', 'stdin': '', 'limits': {'wall': 5}})
+            self.assertEqual(stdout_of(second), 'job2\n')
+
+    def run_cases(self, code, limits, count=2):
+        started = time.monotonic()
+        frames = self.runner.run({'code': code, 'stdin': '', 'limits': limits,
+                                  'cases': [{'stdin': ''}] * count, 'parallel': count})
+        cases = [f for f in frames if f['type'] == 'case_result']
+        self.assertEqual(len(cases), count)
+        return [f['exit_code'] for f in cases], time.monotonic() - started
+
+    def test_case_result_size_is_capped(self):
+        exit_codes, elapsed = self.run_cases(SPAM_RAW_FDS, {'wall': 5, 'stdout': 1000, 'stderr': 1000})
+        self.assertEqual(exit_codes, [1002, 1002])
+        self.assertLess(elapsed, 5)
+
+    def test_case_deadline_is_enforced_while_writing(self):
+        exit_codes, elapsed = self.run_cases(SPAM_RAW_FDS, {'wall': 1})
+        self.assertEqual(exit_codes, [1001, 1001])
+        self.assertLess(elapsed, 3)
+
+    def test_case_finishes_when_its_process_exits(self):
+        # setsidした子孫がパイプを開いたままでも、期限までEOFを待たない
+        exit_codes, elapsed = self.run_cases(LINGERING_DAEMON, {'wall': 5})
+        self.assertEqual(exit_codes, [0, 0])
+        self.assertLess(elapsed, 2)
+
+
+@unittest.skipUnless(sys.platform.startswith('linux') and shutil.which('node'), 'node is not installed')
+class NodeRunnerIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = RunnerProcess(['node', os.path.join(RUNNER_DIR, 'run.js')], preexec_fn=become_subreaper)
+        self.addCleanup(self.runner.close)
+
+    def test_raw_fd_writes_stay_in_the_job(self):
+        first = self.runner.run({'code': NODE_FORGE_RESULT, 'stdin': '', 'limits': {'wall': 5}, 'nonce': 'a'})
+        self.assertEqual(first[-1]['exit_code'], 0)
+        self.assertEqual(stdout_of(first).splitlines()[1:], ['EBADF', 'user A secret output'])
+        self.assertEqual({f['nonce'] for f in first}, {'a'})
+        second = self.runner.run({'code': 'console.log("job2")', 'stdin': '', 'limits': {'wall': 5}})
+        self.assertEqual(stdout_of(second), 'job2\n')
+
+    def test_process_modules_are_denied(self):
+        code = ("for (const name of ['child_process', 'node:cluster', 'worker_threads']) {"
+                "  try { require(name); console.log('loaded'); } catch (e) { console.log(e.code); } }"
+                "console.log(typeof process.send, typeof process.binding);")
+        frames = self.runner.run({'code': code, 'stdin': '', 'limits': {'wall': 5}})
+        self.assertEqual(stdout_of(frames), 'ERR_ACCESS_DENIED\n' * 3 + 'undefined undefined\n')
+
+    def test_setsid_descendant_is_killed_after_job(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pidfile = os.path.join(tmp, 'daemon.pid')
+            code = f'const PIDFILE = {json.dumps(pidfile)};\n' + NODE_SETSID_DAEMON
+            frames = self.runner.run({'code': code, 'stdin': '', 'limits': {'wall': 5}})
+            self.assertEqual(stdout_of(frames), 'done\n')
+            with open(pidfile) as f:
+                daemon = int(f.read())
+            self.assertFalse(process_alive(daemon))
+            second = self.runner.run({'code': 'console.log("job2")', 'stdin': '', 'limits': {'wall': 5}})
+            self.assertEqual(stdout_of(second), 'job2\n')
+
+
+@unittest.skipUnless(sys.platform.startswith('linux') and shutil.which('gcc'), 'gcc is not installed')
+class NativeRunnerIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = RunnerProcess([sys.executable, os.path.join(RUNNER_DIR, 'run_native.py'), '--serve'])
+        self.addCleanup(self.runner.close)
+
+    def test_descendants_are_killed_after_normal_exit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pidfile = os.path.join(tmp, 'daemon.pid')
+            frames = self.runner.run(c_job(f'#define PIDFILE {json.dumps(pidfile)}\n' + C_SETSID_DAEMON))
+            self.assertEqual(frames[0]['exit_code'], 0)
+            self.assertEqual(stdout_of(frames), 'done\n')
+            self.assertEqual(frames[-1]['exit_code'], 0)
+            with open(pidfile) as f:
+                daemon = int(f.read())
+            self.assertFalse(process_alive(daemon))
+
+    def test_each_case_gets_its_own_workdir(self):
+        frames = self.runner.run(c_job(C_CASE_STATE, cases=[{'stdin': ''}] * 4, parallel=2))
+        cases = [f for f in frames if f['type'] == 'case_result']
+        self.assertEqual(sorted(f['index'] for f in cases), [0, 1, 2, 3])
+        self.assertEqual({f['stdout'] for f in cases}, {'fresh\n'})
+        # 最初のジョブのコンパイル結果をbinaryとして渡しても同じ
+        artifact = frames[0]['artifact']
+        frames = self.runner.run({'code': '', 'binary': artifact, 'run': ['./main'], 'limits': {'wall': 5},
+                                  'cases': [{'stdin': ''}] * 2})
+        self.assertEqual([f['stdout'] for f in frames if f['type'] == 'case_result'], ['fresh\n'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+JobSchedulerの確認。
+- 言語ごとの上限で待っているジョブがキューにあっても、空きのある他言語のジョブはすぐに実行される
+- 同じ言語のジョブはFIFOの順番を守る
+
+    cd backend && python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import JobScheduler  # noqa: E402
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = JobScheduler(max_concurrency=4, per_language={'python': 1}, max_queue_wait=5)
+        self.started = []
+
+    async def job(self, name, language, release):
+        async with self.scheduler.slot(language):
+            self.started.append(name)
+            await release.wait()
+
+    def test_other_language_is_not_blocked_by_language_limit(self):
+        async def scenario():
+            py1_done = asyncio.Event()
+            others_done = asyncio.Event()
+            tasks = [asyncio.create_task(self.job('py1', 'python', py1_done))]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(self.job('py2', 'python', others_done)))
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(self.job('node', 'node', others_done)))
+            await asyncio.sleep(0.05)
+            # py2はpythonの上限で待つが、nodeは全体の空きで先に始まる
+            self.assertEqual(self.started, ['py1', 'node'])
+            self.assertEqual(self.scheduler.stats()['queue_depth'], 1)
+            py1_done.set()
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.started, ['py1', 'node', 'py2'])
+            others_done.set()
+            await asyncio.gather(*tasks)
+        asyncio.run(scenario())
+        self.assertEqual(self.scheduler.stats()['running'], 0)
+
+    def test_same_language_keeps_fifo_order(self):
+        async def scenario():
+            release = asyncio.Event()
+            tasks = []
+            for name in ('py1', 'py2', 'py3'):
+                tasks.append(asyncio.create_task(self.job(name, 'python', release)))
+                await asyncio.sleep(0)
+            self.assertEqual(self.started, ['py1'])
+            release.set()
+            await asyncio.gather(*tasks)
+        asyncio.run(scenario())
+        self.assertEqual(self.started, ['py1', 'py2', 'py3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,9 +11,15 @@ interface CodeResult {
   stderr?: string;
   exit_code?: number;
   time?: number;
+  stdout_bytes?: number;
+  stderr_bytes?: number;
+  truncated?: boolean;
+  job_id?: string;
   debug?: any;
 }
 
+const apiBase = `http://${window.location.hostname}:8000`;
+
 function renderTemplate(params: {
   language: string;
   code: string;
@@ -109,13 +115,21 @@ function renderTemplate(params: {
             whiteSpace: 'pre-wrap',
             wordBreak: 'break-all',
           }}>
-            {/* 初期から表示。エラー優先、なければ標準出力 */}
-            {result?.stderr ? (
+            {/* 標準出力の後に標準エラー出力を表示 */}
+            <pre style={{ color: '#38ffb3', margin: 0, background: 'none', fontSize: 17 }}>{result?.stdout ?? ''}</pre>
+            {result?.stderr && (
               <pre style={{ color: '#ff6b6b', margin: 0, background: 'none', fontSize: 17 }}>{result.stderr}</pre>
-            ) : (
-              <pre style={{ color: '#38ffb3', margin: 0, background: 'none', fontSize: 17 }}>{result?.stdout ?? ''}</pre>
             )}
           </div>
+          {/* 大きな出力は先頭・末尾だけを表示し、全体はダウンロードできるようにする */}
+          {result?.truncated && result.job_id && (
+            <div style={{ fontSize: 14, color: '#555' }}>
+              出力が大きいため先頭と末尾のみ表示しています（標準出力 {result.stdout_bytes ?? '-'} バイト・標準エラー出力 {result.stderr_bytes ?? '-'} バイト）。
+              全体: <a href={`${apiBase}/jobs/${result.job_id}/output/stdout`} target="_blank" rel="noreferrer">標準出力</a>
+              {' / '}
+              <a href={`${apiBase}/jobs/${result.job_id}/output/stderr`} target="_blank" rel="noreferrer">標準エラー出力</a>
+            </div>
+          )}
           {/* メタ情報（終了コード・実行時間）を分離表示 */}
           <div style={{
             marginTop: 8,
@@ -152,18 +166,48 @@ function App() {
     setLoading(true);
     setResult(null);
     try {
-      const apiUrl = `http://${window.location.hostname}:8000/run`;
-      const res = await fetch(apiUrl, {
+      // ジョブを投入し、出力はSSEで逐次受け取る
+      const res = await fetch(`${apiBase}/jobs`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ language, code, stdin })
       });
-      const data = await res.json();
-      setResult(data);
+      const job = await res.json();
+      if (job.result) {
+        setResult(job.result);
+        setLoading(false);
+        return;
+      }
+      let stdout = '';
+      let stderr = '';
+      const source = new EventSource(`${apiBase}/jobs/${job.job_id}/stream`);
+      source.addEventListener('stdout', (e) => {
+        stdout += JSON.parse((e as MessageEvent).data);
+        setResult({ stdout, stderr });
+      });
+      source.addEventListener('stderr', (e) => {
+        stderr += JSON.parse((e as MessageEvent).data);
+        setResult({ stdout, stderr });
+      });
+      // 再送できる範囲より前の出力は届かない（結果のプレビューと出力全体のリンクで補う）
+      source.addEventListener('truncated', () => {
+        stdout += '\n... [output truncated] ...\n';
+        setResult({ stdout, stderr });
+      });
+      source.addEventListener('result', (e) => {
+        source.close();
+        setResult(JSON.parse((e as MessageEvent).data));
+        setLoading(false);
+      });
+      source.onerror = () => {
+        source.close();
+        setResult({ stdout, stderr: stderr || 'stream error' });
+        setLoading(false);
+      };
     } catch (e) {
       setResult({ stderr: String(e) });
+      setLoading(false);
     }
-    setLoading(false);
   };
 
   return renderTemplate({
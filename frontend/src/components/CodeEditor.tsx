@@ -11,6 +11,8 @@ type CodeEditorProps = {
 const languageMap: Record<string, string> = {
   python: 'python',
   node: 'javascript',
+  c: 'c',
+  cpp: 'cpp',
 };
 
 function CodeEditor({ language, code, onLanguageChange, onCodeChange }: CodeEditorProps) {
@@ -21,6 +23,8 @@ function CodeEditor({ language, code, onLanguageChange, onCodeChange }: CodeEdit
         <select value={language} onChange={e => onLanguageChange(e.target.value)} style={{ marginLeft: 8 }}>
           <option value="python">Python</option>
           <option value="node">Node.js</option>
+          <option value="c">C</option>
+          <option value="cpp">C++</option>
         </select>
       </label>
       <div style={{ marginTop: 8 }}>
@@ -1,28 +1,685 @@
 const fs = require('fs');
+const childProcess = require('child_process');
+const crypto = require('crypto');
+const readline = require('readline');
+const { Readable, Writable } = require('stream');
+const vm = require('vm');
 const { performance } = require('perf_hooks');
 
+// 標準入力から1行1ジョブのJSON（{"code": ..., "stdin": ...}）を読み、1行1フレームのJSONを返す。
+// - {"type": "stdout" | "stderr", "data": ...}  実行中の出力（一定量・一定時間ごとにまとめて送出）
+// - {"type": "result", "exit_code": ..., "time": ..., "usage": {...}}  ジョブ終了（usageは実行時間・CPU時間・最大RSS・出力バイト数）
+// ジョブの "limits" の wall（秒）・stdout / stderr（バイト）を超えると打ち切り、exit_codeは1001 / 1002になる。
+// heap_mb（MB）はエンジンのプロセスのヒープ上限になる。
+// フレームはfd 1へ直接書き込み、ユーザーコードの出力はすべてフレーム経由で送る。
+// 各フレームにはジョブの "nonce"（バックエンドがジョブごとに付ける）とジョブごとの連番 "seq"（0から）を付ける。
+//
+// ジョブは子プロセス（エンジン）上で、新しいvm.Contextを作って実行する。エンジンのfd 0/1は/dev/nullで
+// プロトコル用のfdを持たず、出力はIPCで受け取ってこのプロセスだけがフレームを書く。
+// エンジンはジョブ1件ごとにプロセスグループごと止め、次のジョブ用のエンジンを先に起動しておく
+// （前のジョブのタイマーやグローバルへの変更、起動したプロセスを持ち越さない）。
+// コンパイルキャッシュ（vm.ScriptのcachedData）はこのプロセスでソースのハッシュごとに保持し、エンジンへ渡す。
+//
+// バッチジョブ（{"code": ..., "cases": [{"stdin": ..., "expected_stdout": ...}, ...], "parallel": N,
+// "stop_on_failure": bool}）では、最大N個のエンジンでケースを並列に実行して
+// {"type": "case_result", "index": ..., "stdout": ..., "stderr": ..., "exit_code": ..., "time": ..., "passed": ..., "usage": {...}}
+// を完了順に返し、最後に {"type": "result", "exit_code": 0, "time": ..., "skipped": ...} を返す。
 
-let code = '';
-let stdinData = '';
-if (process.argv.length > 3) {
-  code = fs.readFileSync(process.argv[2], 'utf-8');
-  stdinData = fs.readFileSync(process.argv[5], 'utf-8');
-  runCode(code, stdinData);
-} else {
-  process.stdin.on('data', chunk => code += chunk);
-  process.stdin.on('end', () => runCode(code, ''));
+const OUTPUT_FLUSH_CHARS = 4096;
+const OUTPUT_FLUSH_INTERVAL_MS = 50;
+
+// 実行制限を超えたときの終了コード
+const EXIT_TIME_LIMIT = 1001;
+const EXIT_OUTPUT_LIMIT = 1002;
+
+// 経過時間の上限を過ぎてもエンジンが応答しない場合に、強制終了するまでの猶予（ミリ秒）
+const WATCHDOG_GRACE_MS = 500;
+
+// limitsにheap_mbがない場合のエンジンのヒープ上限（MB）
+const DEFAULT_HEAP_MB = 256;
+
+// 保持するコンパイルキャッシュの数
+const SCRIPT_CACHE_SIZE = 128;
+
+// エンジンが結果を返さずに終了した場合に原因を調べるため、標準エラー出力の末尾を保持する文字数
+const ENGINE_STDERR_TAIL = 4096;
+
+// ユーザーコードにrequireさせないモジュール（プロセスの起動やプロセス外への接続ができるもの）
+const DENIED_MODULES = new Set(['child_process', 'cluster', 'worker_threads', 'inspector', 'module']);
+
+// ユーザーコードに見せるprocessから隠すプロパティ（ランナーとのIPCやネイティブモジュールの読み込み）
+const HIDDEN_PROCESS_KEYS = ['send', 'channel', 'connected', 'disconnect', 'binding', '_linkedBinding', 'dlopen'];
+
+class OutputLimitError extends Error {
+  constructor(name) {
+    super(`${name} limit exceeded`);
+    this.name = 'OutputLimitError';
+  }
+}
+
+// process.exit() はエンジンを止めず、終了コードとして扱う
+class ExitSignal {
+  constructor(code) {
+    this.code = code;
+  }
+}
+
+// 出力を溜め、一定量または一定時間ごとにチャンクとしてemitへ渡す
+// limit（バイト）に達した時点で以降の書き込みを受け付けず、OutputLimitErrorを投げる
+function createStreamingOutput(name, emit, limit) {
+  let buf = [];
+  let size = 0;
+  let lastFlush = performance.now();
+  const state = { bytesWritten: 0, exceeded: false };
+  const flush = () => {
+    if (buf.length) {
+      emit(name, buf.join(''));
+      buf = [];
+      size = 0;
+    }
+    lastFlush = performance.now();
+  };
+  const write = (chunk) => {
+    if (state.exceeded) throw new OutputLimitError(name);
+    let s = String(chunk);
+    let n = Buffer.byteLength(s);
+    if (limit != null && state.bytesWritten + n > limit) {
+      const remaining = limit - state.bytesWritten;
+      s = Buffer.from(s).subarray(0, remaining).toString();
+      // 途中で切れた文字（置換文字）の分で上限を超えないようにする
+      while (Buffer.byteLength(s) > remaining) s = s.slice(0, -1);
+      n = Buffer.byteLength(s);
+      state.exceeded = true;
+    }
+    if (s) {
+      buf.push(s);
+      size += s.length;
+    }
+    state.bytesWritten += n;
+    if (state.exceeded) {
+      flush();
+      throw new OutputLimitError(name);
+    }
+    if (size >= OUTPUT_FLUSH_CHARS || performance.now() - lastFlush >= OUTPUT_FLUSH_INTERVAL_MS) {
+      flush();
+    }
+    return true;
+  };
+  return { write, flush, state };
+}
+
+// ---- エンジン（子プロセス）側 ----
+
+// cachedDataがあればコンパイルを省く（V8が受け付けなかった場合は普通にコンパイルされる）
+function compileScript(code, cachedData) {
+  return new vm.Script(code, { filename: 'main.js', cachedData: cachedData || undefined });
+}
+
+// 組み込みモジュールはジョブ用の凍結したコピーを返す（モジュールへの書き込みを受け付けない）
+function frozenCopy(mod) {
+  if (mod === null || typeof mod !== 'object') return mod;
+  return Object.freeze(Object.create(Object.getPrototypeOf(mod), Object.getOwnPropertyDescriptors(mod)));
+}
+
+function errorText(e) {
+  return String(e && e.stack ? e.stack : e) + '\n';
+}
+
+function fsError(code, syscall) {
+  const e = new Error(`${code}: bad file descriptor, ${syscall}`);
+  e.code = code;
+  e.syscall = syscall;
+  return e;
+}
+
+// ユーザーコードに見せるグローバル。console / process / require('fs') の入出力をジョブ用に差し替える
+// processは読み取り専用のProxy、require('timers')はジョブのタイマーを返す
+// fs.writeSync / fs.write でfd 1 / 2へ書いた内容はジョブの出力にし、fd 0への書き込みはEBADFにする
+function createSandbox(stdinData, stdout, stderr, onAsyncError) {
+  const handles = new Set();
+  // 最後のハンドルが閉じたときに呼ぶ（waitIdleが待っている間だけ設定される）
+  let onIdle = null;
+  const release = (handle) => {
+    handles.delete(handle);
+    if (handles.size === 0 && onIdle) onIdle();
+  };
+  const waitIdle = () => new Promise((resolve) => {
+    if (handles.size === 0) {
+      resolve();
+      return;
+    }
+    onIdle = () => {
+      onIdle = null;
+      resolve();
+    };
+  });
+  const outStream = new Writable();
+  outStream.write = stdout.write;
+  const errStream = new Writable();
+  errStream.write = stderr.write;
+  const jobConsole = new console.Console({ stdout: outStream, stderr: errStream });
+  const overrides = {
+    stdout: outStream,
+    stderr: errStream,
+    stdin: Readable.from([stdinData]),
+    argv: ['node', 'main.js'],
+    env: {},
+    exit: (code) => {
+      throw new ExitSignal(code === undefined ? 0 : code);
+    },
+  };
+  for (const key of HIDDEN_PROCESS_KEYS) overrides[key] = undefined;
+  const readOnly = () => false;
+  const jobProcess = new Proxy(process, {
+    get: (target, key) => (key in overrides ? overrides[key] : Reflect.get(target, key)),
+    set: readOnly,
+    defineProperty: readOnly,
+    deleteProperty: readOnly,
+    setPrototypeOf: readOnly,
+  });
+  const jobFs = Object.create(fs);
+  jobFs.readFileSync = function (path, ...args) {
+    if (path === 0 || path === '/dev/stdin') {
+      const encoding = typeof args[0] === 'string' ? args[0] : args[0] && args[0].encoding;
+      return encoding ? stdinData : Buffer.from(stdinData);
+    }
+    return fs.readFileSync(path, ...args);
+  };
+  const writeStdio = (fd, data, offset, length) => {
+    let text = data;
+    if (typeof data !== 'string') {
+      const bytes = Buffer.from(data.buffer, data.byteOffset, data.byteLength);
+      const start = typeof offset === 'number' ? offset : 0;
+      text = bytes.subarray(start, typeof length === 'number' ? start + length : undefined).toString();
+    }
+    (fd === 1 ? stdout : stderr).write(text);
+    return Buffer.byteLength(text);
+  };
+  jobFs.writeSync = function (fd, ...args) {
+    if (fd === 0) throw fsError('EBADF', 'write');
+    if (fd === 1 || fd === 2) return writeStdio(fd, ...args);
+    return fs.writeSync(fd, ...args);
+  };
+  jobFs.write = function (fd, ...args) {
+    if (fd !== 0 && fd !== 1 && fd !== 2) return fs.write(fd, ...args);
+    const callback = typeof args[args.length - 1] === 'function' ? args.pop() : () => {};
+    try {
+      const written = jobFs.writeSync(fd, ...args);
+      process.nextTick(callback, null, written, args[0]);
+    } catch (e) {
+      process.nextTick(callback, e);
+    }
+  };
+  const modules = new Map();
+  const jobRequire = (name) => {
+    if (DENIED_MODULES.has(String(name).replace(/^node:/, ''))) {
+      const e = new Error(`Cannot use module '${name}' in this runner`);
+      e.code = 'ERR_ACCESS_DENIED';
+      throw e;
+    }
+    if (name === 'fs' || name === 'node:fs') return jobFs;
+    if (name === 'process' || name === 'node:process') return jobProcess;
+    if (name === 'timers' || name === 'node:timers') return jobTimers;
+    if (!modules.has(name)) modules.set(name, frozenCopy(require(name)));
+    return modules.get(name);
+  };
+
+  // タイマーはジョブ終了時にまとめて止める（次のジョブへ持ち越さない）
+  const guard = (callback) => (...args) => {
+    try {
+      callback(...args);
+    } catch (e) {
+      onAsyncError(e);
+    }
+  };
+  const jobSetTimeout = (callback, delay, ...args) => {
+    const handle = setTimeout(() => {
+      release(handle);
+      guard(callback)(...args);
+    }, delay);
+    handles.add(handle);
+    return handle;
+  };
+  const jobSetImmediate = (callback, ...args) => {
+    const handle = setImmediate(() => {
+      release(handle);
+      guard(callback)(...args);
+    });
+    handles.add(handle);
+    return handle;
+  };
+  const jobSetInterval = (callback, delay, ...args) => {
+    const handle = setInterval(guard(callback), delay, ...args);
+    handles.add(handle);
+    return handle;
+  };
+  const clear = (handle) => {
+    clearTimeout(handle);
+    clearInterval(handle);
+    clearImmediate(handle);
+    release(handle);
+  };
+  const jobTimers = Object.freeze({
+    setTimeout: jobSetTimeout,
+    clearTimeout: clear,
+    setImmediate: jobSetImmediate,
+    clearImmediate: clear,
+    setInterval: jobSetInterval,
+    clearInterval: clear,
+  });
+
+  const sandbox = {
+    console: jobConsole,
+    process: jobProcess,
+    require: jobRequire,
+    module: { exports: {} },
+    Buffer,
+    URL,
+    URLSearchParams,
+    TextEncoder,
+    TextDecoder,
+    structuredClone,
+    atob,
+    btoa,
+    queueMicrotask,
+    setTimeout: jobSetTimeout,
+    clearTimeout: clear,
+    setImmediate: jobSetImmediate,
+    clearImmediate: clear,
+    setInterval: jobSetInterval,
+    clearInterval: clear,
+  };
+  sandbox.exports = sandbox.module.exports;
+  return { sandbox, handles, waitIdle, wake: () => onIdle && onIdle() };
+}
+
+function nextTurn() {
+  return new Promise((resolve) => setImmediate(resolve));
+}
+
+// 経過時間の上限まで待つ（上限がなければ待ち続ける）。cancelで待つのをやめる
+function sleepUntil(deadline) {
+  let timer = null;
+  const promise = new Promise((resolve) => {
+    if (deadline !== Infinity) timer = setTimeout(resolve, Math.max(0, deadline - performance.now()));
+  });
+  return { promise, cancel: () => clearTimeout(timer) };
 }
 
-function runCode(code, stdinData) {
-  // monkey patch process.stdin
-  const { Readable } = require('stream');
-  process.stdin = Readable.from([stdinData]);
+async function executeJob(job, emit) {
+  const limits = job.limits || {};
+  const stdout = createStreamingOutput('stdout', emit, limits.stdout);
+  const stderr = createStreamingOutput('stderr', emit, limits.stderr);
+  let exitCode = 0;
+  let stopped = false;
+  const fail = (e) => {
+    stopped = true;
+    wake();
+    if (e instanceof ExitSignal) {
+      exitCode = typeof e.code === 'number' ? e.code : 1;
+    } else if (e && e.code === 'ERR_SCRIPT_EXECUTION_TIMEOUT') {
+      exitCode = EXIT_TIME_LIMIT;
+    } else if (e instanceof OutputLimitError) {
+      exitCode = EXIT_OUTPUT_LIMIT;
+    } else {
+      try {
+        stderr.write(errorText(e));
+      } catch (writeError) {
+        // 標準エラー出力が上限に達している
+      }
+      exitCode = 1;
+    }
+  };
+  const { sandbox, handles, waitIdle, wake } = createSandbox(job.stdin || '', stdout, stderr, fail);
+  currentJobFail = fail;
+
+  const cpuStart = process.cpuUsage();
   const start = performance.now();
+  const deadline = limits.wall ? start + limits.wall * 1000 : Infinity;
+  let script = null;
   try {
-    eval(code);
+    script = compileScript(job.code, job.cachedData);
+    const options = {};
+    if (limits.wall) options.timeout = Math.ceil(limits.wall * 1000);
+    script.runInContext(vm.createContext(sandbox), options);
+    // 同期部分の後、タイマーやstdinのイベントが残っていれば、最後のハンドルが閉じるか上限に達するまで待つ
+    await nextTurn();
+    await nextTurn();
+    if (handles.size > 0 && !stopped) {
+      const timeout = sleepUntil(deadline);
+      const expired = await Promise.race([waitIdle().then(() => false), timeout.promise.then(() => true)]);
+      timeout.cancel();
+      if (expired && !stopped) exitCode = EXIT_TIME_LIMIT;
+    }
   } catch (e) {
-    console.error(e);
+    fail(e);
+  }
+  currentJobFail = null;
+  for (const handle of handles) {
+    clearTimeout(handle);
+    clearInterval(handle);
+    clearImmediate(handle);
   }
   const end = performance.now();
-  console.error(`\n[EXECUTION_TIME] ${(end-start)/1000}`);
+  const cpu = process.cpuUsage(cpuStart);
+  // ユーザーコードが例外を握りつぶしても、出力上限に達していれば打ち切り扱い
+  if (stdout.state.exceeded || stderr.state.exceeded) {
+    exitCode = EXIT_OUTPUT_LIMIT;
+  }
+  stdout.flush();
+  stderr.flush();
+
+  const usage = {
+    wall_time: (end - start) / 1000,
+    cpu_user: cpu.user / 1e6,
+    cpu_sys: cpu.system / 1e6,
+    max_rss_kb: process.resourceUsage().maxRSS,
+    stdout_bytes: stdout.state.bytesWritten,
+    stderr_bytes: stderr.state.bytesWritten,
+  };
+  const result = { type: 'result', exit_code: exitCode, time: (end - start) / 1000, usage };
+  if (script && (!job.cachedData || script.cachedDataRejected)) {
+    // 実行後に作ると、実行時にコンパイルした関数も含まれる
+    result.cachedData = script.createCachedData();
+  }
+  return result;
+}
+
+// 実行中のジョブのエラー処理（ユーザーコードの未処理のPromise拒否をジョブのエラーとして扱う）
+let currentJobFail = null;
+
+function engineMain() {
+  process.on('unhandledRejection', (reason) => {
+    if (currentJobFail) currentJobFail(reason);
+  });
+  // ランナーが終了してIPCが切れたら、待機中のエンジンも終了する
+  process.on('disconnect', () => process.exit(0));
+  // サンドボックスへそのまま渡すBufferは書き換えられないようにする
+  Object.freeze(Buffer.prototype);
+  Object.freeze(Buffer);
+  // ジョブを受け取り、出力と結果をジョブのidを付けたメッセージで返す
+  process.on('message', async (job) => {
+    const result = await executeJob(job, (type, data) => process.send({ id: job.id, type, data }));
+    process.send({ id: job.id, ...result });
+  });
+}
+
+// ---- ランナー（親プロセス）側 ----
+
+// ソースのハッシュをキーにしたcachedDataのLRU（Mapの挿入順を使う）
+const scriptCache = new Map();
+
+function cachedScript(key) {
+  const cachedData = scriptCache.get(key);
+  if (cachedData) {
+    scriptCache.delete(key);
+    scriptCache.set(key, cachedData);
+  }
+  return cachedData;
+}
+
+function storeScript(key, cachedData) {
+  scriptCache.delete(key);
+  if (scriptCache.size >= SCRIPT_CACHE_SIZE) {
+    scriptCache.delete(scriptCache.keys().next().value);
+  }
+  scriptCache.set(key, cachedData);
+}
+
+function killProcessGroup(pid) {
+  try {
+    process.kill(-pid, 'SIGKILL');
+  } catch (e) {
+    // 終了済み
+  }
+}
+
+// /procをたどり、このプロセスの子孫のうち動いているもの（ゾンビを除く）のPIDを返す。keepの子孫はたどらない
+function liveDescendants(keep) {
+  let entries;
+  try {
+    entries = fs.readdirSync('/proc');
+  } catch (e) {
+    return [];
+  }
+  const children = new Map();
+  for (const entry of entries) {
+    if (!/^\d+$/.test(entry)) continue;
+    let stat;
+    try {
+      stat = fs.readFileSync(`/proc/${entry}/stat`, 'latin1');
+    } catch (e) {
+      continue;
+    }
+    // コマンド名に空白や括弧が含まれうるため、最後の ')' の後ろから読む（state, ppid, ...）
+    const [state, ppid] = stat.slice(stat.lastIndexOf(')') + 2).split(' ');
+    if (!children.has(ppid)) children.set(ppid, []);
+    children.get(ppid).push({ pid: Number(entry), state });
+  }
+  const found = [];
+  const stack = [String(process.pid)];
+  while (stack.length) {
+    for (const child of children.get(stack.pop()) || []) {
+      if (keep.has(child.pid)) continue;
+      if (child.state !== 'Z') found.push(child.pid);
+      stack.push(String(child.pid));
+    }
+  }
+  return found;
+}
+
+// ジョブのプロセスグループから抜けた子孫プロセス（setsidしたものなど）も止める。keepは待機中のエンジン
+// （コンテナではランナーがPID 1なので、親が先に終了した子孫もこのプロセスの子に付け替えられて見つかる）
+function killDescendants(keep) {
+  const pause = new Int32Array(new SharedArrayBuffer(4));
+  const deadline = performance.now() + 1000;
+  for (;;) {
+    const pids = liveDescendants(keep);
+    for (const pid of pids) {
+      try {
+        process.kill(pid, 'SIGKILL');
+      } catch (e) {
+        // 終了済み
+      }
+    }
+    if (pids.length === 0 || performance.now() >= deadline) return;
+    Atomics.wait(pause, 0, 0, 1);
+  }
+}
+
+let lastJobId = 0;
+
+// ジョブを実行する子プロセス。1件実行するごとにプロセスグループごと止め、次のジョブ用のプロセスを起動しておく
+class Engine {
+  constructor(heapMb) {
+    this.heapMb = heapMb;
+    this.child = null;
+  }
+
+  start() {
+    // 新しいセッション（プロセスグループ）で起動する。標準出力は捨て、標準エラー出力は異常終了の原因の確認に使う
+    const child = childProcess.fork(__filename, ['--engine'], {
+      execArgv: [`--max-old-space-size=${this.heapMb}`],
+      stdio: ['ignore', 'ignore', 'pipe', 'ipc'],
+      detached: true,
+      serialization: 'advanced',
+    });
+    child.stderrTail = '';
+    child.stderr.setEncoding('utf8');
+    child.stderr.on('data', (chunk) => {
+      child.stderrTail = (child.stderrTail + chunk).slice(-ENGINE_STDERR_TAIL);
+    });
+    this.child = child;
+  }
+
+  stop() {
+    if (this.child) killProcessGroup(this.child.pid);
+    this.child = null;
+  }
+
+  run(job, emit) {
+    if (this.child === null) this.start();
+    const child = this.child;
+    const id = ++lastJobId;
+    const key = crypto.createHash('sha256').update(job.code).digest('hex');
+    const limits = job.limits || {};
+    const started = performance.now();
+    const elapsed = () => (performance.now() - started) / 1000;
+    return new Promise((resolve) => {
+      let watchdog = null;
+      const finish = (result) => {
+        clearTimeout(watchdog);
+        child.off('message', onMessage);
+        child.off('error', onError);
+        child.off('exit', onExit);
+        child.off('close', onClose);
+        killProcessGroup(child.pid);
+        this.start();
+        resolve(result);
+      };
+      const onMessage = (message) => {
+        // 以前のジョブのメッセージは捨てる
+        if (message.id !== id) return;
+        if (message.type !== 'result') {
+          emit(message.type, message.data);
+          return;
+        }
+        const { id: _, cachedData, ...result } = message;
+        if (cachedData) storeScript(key, Buffer.from(cachedData));
+        finish(result);
+      };
+      const onError = (e) => {
+        emit('stderr', errorText(e));
+        finish({ type: 'result', exit_code: 1, time: elapsed() });
+      };
+      // 結果を返さずに終了した（ヒープ上限など）。グループの残りを止め、標準エラー出力を読み切ってから返す
+      const onExit = () => killProcessGroup(child.pid);
+      const onClose = () => {
+        if (/heap out of memory/.test(child.stderrTail)) emit('stderr', 'JavaScript heap out of memory\n');
+        finish({ type: 'result', exit_code: 1, time: elapsed() });
+      };
+      child.on('message', onMessage);
+      child.on('error', onError);
+      child.on('exit', onExit);
+      child.on('close', onClose);
+      if (limits.wall) {
+        // 非同期処理の中の無限ループなど、vmのtimeoutで止められない場合
+        watchdog = setTimeout(() => finish({ type: 'result', exit_code: EXIT_TIME_LIMIT, time: limits.wall }),
+          limits.wall * 1000 + WATCHDOG_GRACE_MS);
+      }
+      child.send({ ...job, id, cachedData: cachedScript(key) });
+    });
+  }
+}
+
+const engines = [];
+
+// 必要な数のエンジンを用意する（ヒープ上限が変わった場合は作り直す）
+function getEngines(count, heapMb) {
+  for (let i = 0; i < engines.length; i++) {
+    if (engines[i].heapMb !== heapMb) {
+      engines[i].stop();
+      engines[i] = new Engine(heapMb);
+    }
+  }
+  while (engines.length < count) engines.push(new Engine(heapMb));
+  return engines.slice(0, count);
+}
+
+// ジョブの終了後、待機中のエンジン以外の子孫プロセスを止める
+function cleanupJobProcesses() {
+  killDescendants(new Set(engines.filter((engine) => engine.child).map((engine) => engine.child.pid)));
+}
+
+// フレームに付けるジョブのnonceと連番（ジョブごとに0から数える）。
+// バックエンドはどちらかが合わないフレームを受け付けない
+let frameNonce = null;
+let frameSeq = 0;
+
+function sendFrame(frame) {
+  fs.writeSync(1, JSON.stringify({ ...frame, nonce: frameNonce, seq: frameSeq++ }) + '\n');
+}
+
+// 行末の空白と末尾の空行を無視して出力を比較する
+function outputsMatch(actual, expected) {
+  const normalize = (text) => text.trimEnd().split(/\r?\n/).map((line) => line.trimEnd());
+  const a = normalize(actual);
+  const b = normalize(expected);
+  return a.length === b.length && a.every((line, i) => line === b[i]);
+}
+
+// 同じコードを複数の標準入力で、最大parallel件ずつ並列に実行する。実行しなかったケース数を返す
+// 各ケースは新しいエンジンとvm.Contextで動くため、グローバル状態やタイマーはケースごとにまっさら
+async function runCases(job) {
+  const cases = job.cases;
+  const limits = job.limits || {};
+  const lanes = getEngines(Math.max(1, Math.min(job.parallel || 1, cases.length)), limits.heap_mb || DEFAULT_HEAP_MB);
+  let next = 0;
+  let completed = 0;
+  let failed = false;
+  const lane = async (engine) => {
+    while (next < cases.length && !(failed && job.stop_on_failure)) {
+      const index = next++;
+      const testCase = cases[index];
+      const output = { stdout: [], stderr: [] };
+      const result = await engine.run({ code: job.code, stdin: testCase.stdin || '', limits },
+        (type, data) => output[type].push(data));
+      const caseResult = {
+        stdout: output.stdout.join(''),
+        stderr: output.stderr.join(''),
+        exit_code: result.exit_code,
+        time: result.time,
+        usage: result.usage,
+      };
+      if (testCase.expected_stdout != null) {
+        caseResult.passed = outputsMatch(caseResult.stdout, testCase.expected_stdout);
+      }
+      if (caseResult.exit_code !== 0 || caseResult.passed === false) failed = true;
+      completed++;
+      sendFrame({ type: 'case_result', index, ...caseResult });
+    }
+  };
+  await Promise.all(lanes.map(lane));
+  return cases.length - completed;
+}
+
+async function serve() {
+  const rl = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+  for await (const line of rl) {
+    if (!line.trim()) continue;
+    let job;
+    try {
+      job = JSON.parse(line);
+    } catch (e) {
+      fs.writeSync(2, `Error: Invalid job request: ${line.slice(0, 200)}\n`);
+      process.exit(1);
+    }
+    frameNonce = job.nonce ?? null;
+    frameSeq = 0;
+    const start = performance.now();
+    if (Array.isArray(job.cases)) {
+      const skipped = await runCases(job);
+      cleanupJobProcesses();
+      sendFrame({ type: 'result', exit_code: 0, time: (performance.now() - start) / 1000, skipped });
+      continue;
+    }
+    const limits = job.limits || {};
+    const [engine] = getEngines(1, limits.heap_mb || DEFAULT_HEAP_MB);
+    const result = await engine.run({ code: job.code, stdin: job.stdin || '', limits },
+      (type, data) => sendFrame({ type, data }));
+    if (!result.usage) {
+      // エンジンが強制終了された場合はランナーで計測した値のみ
+      result.usage = { wall_time: (performance.now() - start) / 1000 };
+    }
+    cleanupJobProcesses();
+    sendFrame(result);
+  }
+  for (const engine of engines) engine.stop();
+  process.exit(0);
+}
+
+if (process.argv.includes('--engine')) {
+  engineMain();
+} else {
+  serve();
 }
@@ -1,47 +1,173 @@
 #!/usr/bin/env python3
+"""
+Pythonコード実行ランナー。
+
+標準入力から1行1ジョブのJSON（{"code": ..., "stdin": ...}）を読み、標準出力へ1行1フレームのJSONを返す。
+- {"type": "stdout" | "stderr", "data": ...}  実行中の出力（一定量・一定時間ごとにまとめて送出）
+- {"type": "result", "exit_code": ..., "time": ..., "usage": {...}}  ジョブ終了（usageは実行時間・CPU時間・最大RSS・出力バイト数）
+ジョブの "limits" の wall（秒）・stdout / stderr（バイト）を超えると打ち切り、exit_codeは1001 / 1002になる。
+標準入力が閉じられるまで繰り返す（ウォームプールでは複数ジョブを処理する）。
+各フレームには、ジョブの "nonce"（バックエンドがジョブごとに付ける）とジョブごとの連番 "seq"（0から）を付ける。
+ジョブはforkした子プロセスで実行し（子プロセスはジョブの "limits" でrlimitを設定する）、
+前のジョブのスレッドやグローバル状態は次のジョブへ持ち越さない。
+子プロセスはプロトコル用のfdを持たず、出力はパイプで親へ渡して親だけがフレームを書く。
+ジョブが終わるたびに、子プロセスのグループとそこから抜けた子孫プロセスもすべてSIGKILLする。
+
+バッチジョブ（{"code": ..., "cases": [{"stdin": ..., "expected_stdout": ...}, ...], "parallel": N,
+"stop_on_failure": bool}）では、ケースごとにforkした子プロセスで実行して
+{"type": "case_result", "index": ..., "stdout": ..., "stderr": ..., "exit_code": ..., "time": ..., "passed": ..., "usage": {...}}
+を完了順に返し、最後に {"type": "result", "exit_code": 0, "time": ..., "skipped": ...} を返す。
+
+--fork-server を指定すると、よく使うモジュール（--preload）を親プロセスで事前にimportしてからジョブを待つ
+（forkした子プロセスはimport済みのモジュールをコピーオンライトで共有する）。
+"""
 import sys
 import time
 import os
 import io
+import json
+import argparse
 import contextlib
+import ctypes
+import gc
+import importlib
+import resource
+import select
+import selectors
+import signal
+import threading
 import traceback
-import yaml
-
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import SQLAlchemyError
-
-# --- 定数 ---
-# データベース関連（main.pyから環境変数で渡された値のみ使用）
-DB_TABLE_NAME = 'code_jobs'
-
-# ジョブステータス
-JOB_STATUS_DONE = 'done'
-JOB_STATUS_ERROR = 'error'
-JOB_STATUS_PENDING = 'pending'
-
-# --- モデル定義 ---
-Base = declarative_base()
-
-class CodeJob(Base):
-    __tablename__ = DB_TABLE_NAME
-    id = Column(Integer, primary_key=True, index=True)
-    language = Column(String(16))
-    code = Column(Text)
-    stdin = Column(Text)
-    status = Column(String(16), default=JOB_STATUS_PENDING)
-    result_stdout = Column(Text)
-    result_stderr = Column(Text)
-    result_exit_code = Column(Integer)
-    result_time = Column(Float)
+
+# 出力チャンクを送出する目安（文字数・秒）
+OUTPUT_FLUSH_CHARS = 4096
+OUTPUT_FLUSH_INTERVAL = 0.05
+
+# fork-serverモードで事前にimportしておくモジュール（--preloadで上書き可能）
+DEFAULT_PRELOAD = [
+    'array', 'bisect', 'collections', 'copy', 'dataclasses', 'datetime', 'decimal', 'fractions',
+    'functools', 'heapq', 'itertools', 'json', 'math', 'operator', 'random', 're', 'statistics',
+    'string', 'typing',
+]
+
+# ジョブの "limits" のキーと対応するrlimit
+RLIMITS = {
+    'cpu': resource.RLIMIT_CPU,       # CPU時間（秒）
+    'as': resource.RLIMIT_AS,         # アドレス空間（バイト）
+    'nofile': resource.RLIMIT_NOFILE, # 同時に開けるファイル数
+    'fsize': resource.RLIMIT_FSIZE,   # 書き込めるファイルサイズ（バイト）
+}
+
+# 実行制限を超えたときの終了コード
+EXIT_TIME_LIMIT = 1001
+EXIT_OUTPUT_LIMIT = 1002
+
+# 経過時間の上限を過ぎても子プロセスが終わらない場合に、親がSIGKILLするまでの猶予（秒）
+WATCHDOG_GRACE = 0.5
+
+# 子プロセスが親へパイプで渡す出力チャンクの最大文字数と、親が受け付ける1行の最大バイト数
+RELAY_CHUNK_CHARS = 16384
+MAX_RELAY_LINE = 1 << 20
+
+# バッチのケースの結果（JSON）として親が受け付ける最大バイト数は、stdout + stderr の上限の
+# CASE_RESULT_ESCAPE_RATIO倍（JSONのエスケープで1バイトが最大6文字になる）にCASE_RESULT_OVERHEADを足したもの
+CASE_RESULT_ESCAPE_RATIO = 6
+CASE_RESULT_OVERHEAD = 65536
+
+# ランナー自身に設定するprctl（linux/prctl.h）
+PR_SET_DUMPABLE = 4
+PR_SET_CHILD_SUBREAPER = 36
+
+# open_protocol_streamsで退避したプロトコル用のfd（ジョブの子プロセスではfork直後に塞ぐ）
+PROTOCOL_FDS = []
 
 # --- ヘルパー関数 ---
 
-# --- ヘルパー関数（不要なので削除） ---
+class LimitExceeded(BaseException):
+    """実行制限の超過（ユーザーコードの except Exception では捕まえられない）"""
+    exit_code = 1
+
+class TimeLimitExceeded(LimitExceeded):
+    exit_code = EXIT_TIME_LIMIT
+
+class OutputLimitExceeded(LimitExceeded):
+    exit_code = EXIT_OUTPUT_LIMIT
+
+class StreamingOutput(io.TextIOBase):
+    """
+    書き込まれた出力を溜め、一定量または一定時間ごとにチャンクとして送出するストリーム。
+    limit（バイト）に達した時点で以降の書き込みを受け付けず、OutputLimitExceededを送出する。
+    """
+
+    def __init__(self, name: str, emit, limit=None):
+        self.name = name
+        self._emit = emit
+        self._buf = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.limit = limit
+        self.bytes_written = 0
+        self.exceeded = False
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if not isinstance(s, str):
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        with self._lock:
+            if self.exceeded:
+                raise OutputLimitExceeded(self.name)
+            n = len(s) if s.isascii() else len(s.encode('utf-8'))
+            chunk = s
+            if self.limit is not None and self.bytes_written + n > self.limit:
+                chunk = s.encode('utf-8')[:self.limit - self.bytes_written].decode('utf-8', errors='ignore')
+                n = len(chunk.encode('utf-8'))
+                self.exceeded = True
+            if chunk:
+                self._buf.append(chunk)
+                self._size += len(chunk)
+            self.bytes_written += n
+            if self.exceeded:
+                self._flush_locked()
+                raise OutputLimitExceeded(self.name)
+            if self._size >= OUTPUT_FLUSH_CHARS or time.monotonic() - self._last_flush >= OUTPUT_FLUSH_INTERVAL:
+                self._flush_locked()
+        return len(s)
+
+    def _flush_locked(self):
+        if self._buf:
+            self._emit(self.name, ''.join(self._buf))
+            self._buf = []
+            self._size = 0
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+@contextlib.contextmanager
+def periodic_flush(*streams):
+    """
+    書き込みが途絶えても溜まった出力が届くよう、一定間隔でストリームをflushするスレッドを動かす。
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(OUTPUT_FLUSH_INTERVAL):
+            for stream in streams:
+                stream.flush()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
 
 @contextlib.contextmanager
-def redirect_stdout_stderr_stdin(stdout_stream: io.StringIO, stderr_stream: io.StringIO, stdin_stream: io.StringIO):
+def redirect_stdout_stderr_stdin(stdout_stream: io.TextIOBase, stderr_stream: io.TextIOBase, stdin_stream: io.StringIO):
     """
     標準出力、標準エラー出力、標準入力を一時的にリダイレクトするコンテキストマネージャ。
     """
@@ -54,118 +180,644 @@ def redirect_stdout_stderr_stdin(stdout_stream: io.StringIO, stderr_stream: io.S
     finally:
         sys.stdin, sys.stdout, sys.stderr = original_stdin, original_stdout, original_stderr
 
-# --- メインロジック ---
+@contextlib.contextmanager
+def time_limits(wall_seconds):
+    """
+    経過時間の上限（SIGALRM）とCPU時間のソフトリミット超過（SIGXCPU）でTimeLimitExceededを送出する。
+    シグナルハンドラはメインスレッドでしか設定できないため、それ以外では何もしない。
+    ユーザーコードが例外を捕まえれば止まらないので、上限はforkした親のウォッチドッグ（SIGKILL）で強制する。
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
 
-def get_db_url(db_user, db_password, db_name, db_host, db_port) -> str:
-    """データベース接続URLを引数から構築する（main.pyから渡された値のみ使用）"""
-    if not all([db_user, db_password, db_name, db_host, db_port]):
-        print("Error: Database connection parameters are incomplete. Exiting.", file=sys.stderr)
-        sys.exit(1)
-    return f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-
-def initialize_db(database_url: str):
-    """データベース接続とテーブル作成を行う"""
-    global engine, SessionLocal
-    engine = create_engine(database_url)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    
+    def on_limit(signum, frame):
+        raise TimeLimitExceeded()
+
+    previous = {signum: signal.signal(signum, on_limit) for signum in (signal.SIGALRM, signal.SIGXCPU)}
+    if wall_seconds:
+        signal.setitimer(signal.ITIMER_REAL, wall_seconds)
     try:
-        Base.metadata.create_all(bind=engine)
-    except SQLAlchemyError as e:
-        print(f"Error: Failed to connect to database or create tables: {e}", file=sys.stderr)
-        sys.exit(1)
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+def make_usage(wall_time, cpu_user, cpu_sys, max_rss_kb, written) -> dict:
+    return {
+        'wall_time': wall_time,
+        'cpu_user': cpu_user,
+        'cpu_sys': cpu_sys,
+        'max_rss_kb': max_rss_kb,
+        'stdout_bytes': written['stdout'],
+        'stderr_bytes': written['stderr'],
+    }
 
-def execute_code_in_memory(code_str: str, stdin_data: str) -> tuple[str, str, int, float]:
+# --- メインロジック ---
+
+def execute_code_in_memory(code_str: str, stdin_data: str, emit, limits=None) -> tuple[int, float, dict]:
     """
-    メモリ上でPythonコードを実行し、標準入出力と実行時間、終了コードをキャプチャする。
+    メモリ上でPythonコードを実行し、標準出力・標準エラー出力をemit(stream, data)へ逐次送出する。
+    limitsの wall（秒）・stdout / stderr（バイト）を超えた時点で打ち切る。
+    終了コード・実行時間・リソース使用量を返す。
     """
-    stdout_stream = io.StringIO()
-    stderr_stream = io.StringIO()
+    limits = limits or {}
+    stdout_stream = StreamingOutput('stdout', emit, limits.get('stdout'))
+    stderr_stream = StreamingOutput('stderr', emit, limits.get('stderr'))
     stdin_stream = io.StringIO(stdin_data)
-    
+
     exit_code = 0
+    rusage_before = resource.getrusage(resource.RUSAGE_SELF)
     start_time = time.time()
 
-    with redirect_stdout_stderr_stdin(stdout_stream, stderr_stream, stdin_stream):
-        try:
-            exec(code_str, {})
-        except Exception:
-            stderr_stream.write(traceback.format_exc())
-            exit_code = 1
+    try:
+        with periodic_flush(stdout_stream, stderr_stream), \
+                redirect_stdout_stderr_stdin(stdout_stream, stderr_stream, stdin_stream), \
+                time_limits(limits.get('wall')):
+            try:
+                exec(code_str, {})
+            except SystemExit as e:
+                # sys.exit() / exit() はランナーを止めず、終了コードとして扱う
+                if e.code is None or isinstance(e.code, int):
+                    exit_code = e.code or 0
+                else:
+                    stderr_stream.write(f"{e.code}\n")
+                    exit_code = 1
+            except Exception:
+                stderr_stream.write(traceback.format_exc())
+                exit_code = 1
+    except LimitExceeded as e:
+        exit_code = e.exit_code
 
     end_time = time.time()
-    
-    return (
-        stdout_stream.getvalue(),
-        stderr_stream.getvalue(),
-        exit_code,
-        end_time - start_time
-    )
+    # ユーザーコードが例外を握りつぶしても、時間・出力の上限に達していれば打ち切り扱い
+    if limits.get('wall') and end_time - start_time >= limits['wall']:
+        exit_code = EXIT_TIME_LIMIT
+    if stdout_stream.exceeded or stderr_stream.exceeded:
+        exit_code = EXIT_OUTPUT_LIMIT
+    stdout_stream.flush()
+    stderr_stream.flush()
 
-def main():
-    """スクリプトのメイン実行ロジック"""
-    if len(sys.argv) < 7:
-        print("Usage: python runner.py <job_id> <db_user> <db_password> <db_name> <db_host> <db_port>", file=sys.stderr)
-        sys.exit(1)
+    rusage_after = resource.getrusage(resource.RUSAGE_SELF)
+    usage = make_usage(end_time - start_time,
+                       rusage_after.ru_utime - rusage_before.ru_utime,
+                       rusage_after.ru_stime - rusage_before.ru_stime,
+                       rusage_after.ru_maxrss,
+                       {'stdout': stdout_stream.bytes_written, 'stderr': stderr_stream.bytes_written})
+    return exit_code, end_time - start_time, usage
 
+def preload_modules(names):
+    """
+    fork前に親プロセスでモジュールをimportしておく（子プロセスはコピーオンライトで共有する）。
+    importできないモジュールは無視する。
+    """
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Warning: preload {name} failed: {e}", file=sys.stderr)
+    # 以降のGCで共有ページに書き込まないよう、既存オブジェクトをGC対象から外す
+    gc.collect()
+    gc.freeze()
+
+def apply_rlimits(limits):
+    """子プロセスにrlimitを設定する（ハードリミットを超える値は切り詰める）"""
+    for key, value in (limits or {}).items():
+        if key not in RLIMITS or not value:
+            continue
+        soft, hard = resource.getrlimit(RLIMITS[key])
+        value = int(value)
+        if key == 'cpu':
+            # ソフトリミットでSIGXCPU（TimeLimitExceeded）、無視されても1秒後にハードリミットでSIGKILL
+            hard = value + 1 if hard == resource.RLIM_INFINITY else min(value + 1, hard)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        try:
+            resource.setrlimit(RLIMITS[key], (value, hard))
+        except (ValueError, OSError) as e:
+            print(f"Warning: setrlimit {key}={value} failed: {e}", file=sys.stderr)
+
+def signal_exit_code(status: int) -> int:
+    # シグナルで終了した場合はシェルと同じく128+シグナル番号
+    code = os.waitstatus_to_exitcode(status)
+    return 128 - code if code < 0 else code
+
+def killed_by_time_limit(status: int) -> bool:
+    return os.WIFSIGNALED(status) and os.WTERMSIG(status) in (signal.SIGXCPU, signal.SIGKILL)
+
+def watchdog_deadline(limits: dict):
+    wall = (limits or {}).get('wall')
+    return time.monotonic() + wall + WATCHDOG_GRACE if wall else None
+
+def enter_job_process():
+    """
+    fork直後の子プロセスで、ユーザーコードを動かす前に呼ぶ。
+    自分のプロセスグループを作り（ジョブ終了時に親がグループごとSIGKILLする）、
+    プロトコル用のfdを/dev/nullで塞いでユーザーコードからフレームを書けないようにする。
+    （fdを閉じるだけだと、同じ番号で開き直したfdを親のファイルオブジェクトが後から閉じうる）
+    """
+    os.setpgid(0, 0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in PROTOCOL_FDS:
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+def claim_process_group(pid: int):
+    # 子プロセスがsetpgidする前にkillpgしても届くよう、親からも設定する（設定済み・終了済みなら失敗してよい）
     try:
-        job_id = int(sys.argv[1])
-        db_user = sys.argv[2]
-        db_password = sys.argv[3]
-        db_name = sys.argv[4]
-        db_host = sys.argv[5]
-        db_port = sys.argv[6]
-    except Exception:
-        print("Error: Invalid arguments.", file=sys.stderr)
-        sys.exit(1)
-
-    db_url = get_db_url(db_user, db_password, db_name, db_host, db_port)
-    initialize_db(db_url)
-
-    db: Session | None = None
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+def kill_process_group(pid: int):
     try:
-        db = SessionLocal()
-        job = db.query(CodeJob).filter(CodeJob.id == job_id).first()
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
 
-        if not job:
-            print(f"Error: Job with ID {job_id} not found in database.", file=sys.stderr)
-            sys.exit(1)
+def descendant_pids() -> list:
+    """/procをたどり、このプロセスの子孫（孫以降を含む）のPIDを返す"""
+    children = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # コマンド名に空白や括弧が含まれうるため、最後の ')' の後ろから読む（state, ppid, ...）
+        ppid = int(stat.rsplit(b')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    stack = [os.getpid()]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            found.append(child)
+            stack.append(child)
+    return found
+
+def kill_descendants(exclude=None, timeout=1.0):
+    """
+    setsidなどでジョブのプロセスグループから抜けた子孫プロセスも含め、すべてSIGKILLして回収する。
+    exclude（終了を待ち受ける子プロセス）は止めるだけで回収しない。
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        pids = [pid for pid in descendant_pids() if pid != exclude]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        # 親が先に終了した孫プロセスはサブリーパーのこのプロセスに付け替えられるので、ここで回収する
+        for pid in pids:
+            try:
+                os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                pass
+        if not pids or time.monotonic() >= deadline:
+            return
+        time.sleep(0.001)
+
+def finish_job_process(pid: int):
+    """ジョブの子プロセスをグループごとSIGKILLして回収し、(status, rusage) を返す"""
+    kill_process_group(pid)
+    _, status, rusage = os.wait4(pid, 0)
+    kill_descendants()
+    return status, rusage
+
+class PipeEmitter:
+    """
+    forkした子プロセスの出力チャンクを、親が読むパイプへ1行1チャンクのJSONで書くemit。
+    最後に {"type": "exit", "exit_code": ..., "time": ...} を書く。
+    """
+
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._lock = threading.Lock()
+
+    def write_line(self, message: dict):
+        data = memoryview((json.dumps(message) + '\n').encode('utf-8'))
+        with self._lock:
+            # 書き込みの途中でSIGALRMの例外が割り込むと行が壊れるため、書き終えるまでシグナルを保留する
+            blocked = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM, signal.SIGXCPU})
+            try:
+                while data:
+                    data = data[os.write(self._fd, data):]
+            finally:
+                signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+    def __call__(self, stream, data):
+        for i in range(0, len(data), RELAY_CHUNK_CHARS):
+            self.write_line({'type': stream, 'data': data[i:i + RELAY_CHUNK_CHARS]})
 
-        # DB接続後、ユーザーコード実行前にstatusを"TEST"に更新してcommit
-        job.status = "TEST"
+def relay_output(pid: int, read_fd: int, limits: dict, emit, deadline):
+    """
+    子プロセスがパイプに書いた出力チャンクを読み、emit(stream, data)で送る。
+    子プロセスが終了したら残りのプロセス（パイプを受け継いだものを含む）を止め、パイプに残った分を読み切る。
+    子プロセスが書き込みを続けていても、deadlineは毎回確認する。
+    stdout / stderr（バイト）を超えた分は送らず、子プロセスのグループをSIGKILLする。
+    (終了情報（exitの行、なければNone）, ストリームごとのバイト数, 打ち切った場合の終了コード) を返す。
+    """
+    written = {'stdout': 0, 'stderr': 0}
+    exit_info = None
+    killed = None
+    pending = b''
+    pidfd = os.pidfd_open(pid)
+    watched = [read_fd, pidfd]
+    while killed is None and watched:
+        if deadline is not None and time.monotonic() >= deadline:
+            killed = EXIT_TIME_LIMIT
+            break
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        ready = select.select(watched, [], [], timeout)[0]
+        if pidfd in ready:
+            watched.remove(pidfd)
+            kill_process_group(pid)
+            kill_descendants(exclude=pid)
+        if read_fd not in ready:
+            continue
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            watched.remove(read_fd)
+            continue
+        *lines, pending = (pending + chunk).split(b'\n')
+        for line in lines:
+            try:
+                message = json.loads(line)
+                name = message['type']
+            except (ValueError, TypeError, KeyError):
+                continue
+            if name == 'exit':
+                exit_info = message
+                continue
+            data = message.get('data')
+            if name not in written or not isinstance(data, str):
+                continue
+            encoded = data.encode('utf-8', errors='replace')
+            limit = limits.get(name)
+            if limit is not None and written[name] + len(encoded) > limit:
+                encoded = encoded[:max(limit - written[name], 0)]
+                data = encoded.decode('utf-8', errors='ignore')
+                killed = EXIT_OUTPUT_LIMIT
+            written[name] += len(encoded)
+            if data:
+                emit(name, data)
+            if killed is not None:
+                break
+        if killed is None and len(pending) > MAX_RELAY_LINE:
+            # ユーザーコードがパイプへ直接書いた改行のないデータは溜め続けない
+            killed = EXIT_OUTPUT_LIMIT
+    if killed is not None:
+        kill_process_group(pid)
+    os.close(pidfd)
+    os.close(read_fd)
+    return exit_info, written, killed
+
+def execute_forked(code_str: str, stdin_data: str, limits: dict, emit) -> tuple[int, float, dict]:
+    """
+    forkした子プロセスでexecute_code_in_memoryを実行する。
+    子プロセスは出力チャンクと最後の終了コード・実行時間をパイプで親へ渡し、親がemitで送る。
+    経過時間の上限を過ぎても終わらなければ親がSIGKILLする（exit_code=1001）。
+    rlimit超過などで子プロセスが結果を返さずに終了した場合は、待ち受けた親がシグナルから終了コードを作る。
+    CPU時間・最大RSSはwait4で親が子プロセスの値を取る。
+    """
+    start_time = time.time()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
         try:
-            db.commit()
-            print(f"DB status TEST commit success for job_id={job_id}", file=sys.stderr)
-        except Exception as e:
-            print(f"DB status TEST commit failed for job_id={job_id}: {e}", file=sys.stderr)
+            enter_job_process()
+            apply_rlimits(limits)
+            pipe = PipeEmitter(write_fd)
+            exit_code, elapsed, _ = execute_code_in_memory(code_str, stdin_data, pipe, limits)
+            pipe.write_line({'type': 'exit', 'exit_code': exit_code, 'time': elapsed})
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    claim_process_group(pid)
+    exit_info, written, killed = relay_output(pid, read_fd, limits, emit, watchdog_deadline(limits))
+    status, rusage = finish_job_process(pid)
+    wall_time = time.time() - start_time
+    try:
+        if killed is not None:
+            raise ValueError('killed')
+        exit_code, elapsed = int(exit_info['exit_code']), float(exit_info['time'])
+    except (ValueError, TypeError, KeyError):
+        exit_code, elapsed = signal_exit_code(status) or 1, wall_time
+        if killed == EXIT_OUTPUT_LIMIT or any(
+                limits.get(name) is not None and written[name] >= limits[name] for name in written):
+            # 出力上限に達した後も例外を握りつぶして動き続け、強制終了された
+            exit_code = EXIT_OUTPUT_LIMIT
+        elif (killed == EXIT_TIME_LIMIT or killed_by_time_limit(status)
+              or (limits.get('wall') and wall_time >= limits['wall'])):
+            exit_code = EXIT_TIME_LIMIT
+        elif os.WIFSIGNALED(status):
+            emit('stderr', f"\nKilled by signal {signal.Signals(os.WTERMSIG(status)).name}\n")
+    usage = make_usage(wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss, written)
+    return exit_code, elapsed, usage
+
+def outputs_match(actual: str, expected: str) -> bool:
+    """行末の空白と末尾の空行を無視して出力を比較する"""
+    def normalize(text):
+        return [line.rstrip() for line in text.rstrip().splitlines()]
+    return normalize(actual) == normalize(expected)
+
+def run_case(code_str: str, stdin_data: str, limits: dict) -> dict:
+    """1ケースを実行し、出力をまとめて返す（バッチの子プロセス内で呼ぶ）"""
+    collected = {'stdout': [], 'stderr': []}
+
+    def collect(stream, data):
+        collected[stream].append(data)
+
+    exit_code, elapsed, usage = execute_code_in_memory(code_str, stdin_data, collect, limits)
+    return {
+        'stdout': ''.join(collected['stdout']),
+        'stderr': ''.join(collected['stderr']),
+        'exit_code': exit_code,
+        'time': elapsed,
+        'usage': usage,
+    }
+
+def fork_case(code_str: str, stdin_data: str, limits: dict):
+    """子プロセスで1ケースを実行する。親はパイプから結果のJSONを読む"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            enter_job_process()
+            apply_rlimits(limits)
+            result = run_case(code_str, stdin_data, limits)
+        except BaseException:
+            result = {'stdout': '', 'stderr': traceback.format_exc(), 'exit_code': 1, 'time': 0}
+        with os.fdopen(write_fd, 'wb') as f:
+            f.write(json.dumps(result).encode('utf-8'))
+        os._exit(0)
+    os.close(write_fd)
+    claim_process_group(pid)
+    return pid, read_fd
+
+def case_result_limit(limits: dict):
+    # ケースの子プロセスから読む結果の上限（バイト、出力の上限がなければNone）
+    if (limits or {}).get('stdout') is None or limits.get('stderr') is None:
+        return None
+    return CASE_RESULT_ESCAPE_RATIO * (limits['stdout'] + limits['stderr']) + CASE_RESULT_OVERHEAD
+
+class CaseProcess:
+    """execute_casesで実行中の1ケース（子プロセスと、パイプから読んだ結果）"""
+
+    def __init__(self, pid: int, read_fd: int, index: int, case: dict, limits: dict):
+        self.pid = pid
+        self.read_fd = read_fd
+        self.pidfd = os.pidfd_open(pid)
+        self.index = index
+        self.case = case
+        self.parts = []
+        self.size = 0
+        self.started_at = time.monotonic()
+        self.deadline = watchdog_deadline(limits)
+        self.limit = case_result_limit(limits)
+        # 打ち切った理由の終了コード（EXIT_TIME_LIMIT / EXIT_OUTPUT_LIMIT）
+        self.killed = None
+
+    def append(self, chunk: bytes) -> bool:
+        # 上限を超えたらFalse（それ以上は溜めない）
+        self.size += len(chunk)
+        if self.limit is not None and self.size > self.limit:
+            return False
+        self.parts.append(chunk)
+        return True
+
+    def drain(self) -> bool:
+        """
+        子プロセスの終了後、パイプに残っている分だけを読む（書き込み側を受け継いだ子孫がいてもEOFを待たない）。
+        上限を超えたらFalse
+        """
+        os.set_blocking(self.read_fd, False)
+        while True:
+            try:
+                chunk = os.read(self.read_fd, 65536)
+            except BlockingIOError:
+                return True
+            if not chunk:
+                return True
+            if not self.append(chunk):
+                return False
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.pidfd)
+
+def reap_case(pid: int, data: bytes, killed, started_at: float, limits: dict) -> dict:
+    # 結果を書いた後も残っているプロセス（ケースが起動したものを含む）はグループごと止める
+    kill_process_group(pid)
+    _, status, rusage = os.wait4(pid, 0)
+    try:
+        if killed == EXIT_OUTPUT_LIMIT:
+            raise ValueError('case result too large')
+        result = json.loads(data)
+    except ValueError:
+        elapsed = time.monotonic() - started_at
+        result = {'stdout': '', 'stderr': 'case process exited abnormally\n',
+                  'exit_code': signal_exit_code(status) or 1, 'time': elapsed}
+        if killed is not None:
+            result.update(stderr='', exit_code=killed)
+        elif killed_by_time_limit(status) or elapsed >= ((limits or {}).get('wall') or float('inf')):
+            # 経過時間の上限で止まったときの結果が、ケースが直接書いた出力で壊れた場合も含む
+            result.update(stderr='', exit_code=EXIT_TIME_LIMIT)
+    # CPU時間・最大RSSは子プロセス全体の値で上書きする
+    usage = result.get('usage') or {'wall_time': result['time'], 'stdout_bytes': 0, 'stderr_bytes': 0}
+    usage.update(cpu_user=rusage.ru_utime, cpu_sys=rusage.ru_stime, max_rss_kb=rusage.ru_maxrss)
+    result['usage'] = usage
+    return result
+
+def execute_cases(code_str: str, cases: list, parallel: int, stop_on_failure: bool, limits: dict, emit_case) -> int:
+    """
+    同じコードを複数の標準入力で実行する。
+    各ケースはforkした子プロセスで動くため、グローバル状態はケースごとにまっさらになる。
+    同時実行数はparallelまで。stop_on_failureなら最初の失敗以降は新しいケースを始めず、実行中のものも打ち切る。
+    経過時間の上限を過ぎたケース（exit_code=1001）と、結果の大きさがcase_result_limitを超えたケース
+    （exit_code=1002）はSIGKILLする。
+    ケースのプロセスグループは終わるたびに、グループから抜けた子孫プロセスは全ケースの終了後にSIGKILLする。
+    実行しなかったケース数を返す。
+    """
+    selector = selectors.DefaultSelector()
+    pending = list(enumerate(cases))
+    running = {}
+    failed = False
+    completed = 0
+    while pending or running:
+        while pending and len(running) < max(1, parallel) and not (failed and stop_on_failure):
+            index, case = pending.pop(0)
+            pid, read_fd = fork_case(code_str, case.get('stdin') or '', limits)
+            proc = CaseProcess(pid, read_fd, index, case, limits)
+            running[pid] = proc
+            selector.register(read_fd, selectors.EVENT_READ, proc)
+            selector.register(proc.pidfd, selectors.EVENT_READ, proc)
+        if failed and stop_on_failure:
+            for proc in running.values():
+                kill_process_group(proc.pid)
+                os.waitpid(proc.pid, 0)
+                selector.unregister(proc.read_fd)
+                selector.unregister(proc.pidfd)
+                proc.close()
+            running.clear()
+            break
+        deadlines = [proc.deadline for proc in running.values() if proc.deadline is not None]
+        timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+        events = selector.select(timeout)
+        finished = {}
+        for key, _ in events:
+            proc = key.data
+            if proc.pid in finished:
+                continue
+            if key.fd == proc.pidfd:
+                # 子プロセスは結果を書き終えてから終了するので、パイプに残っている分で結果はそろう
+                kill_process_group(proc.pid)
+                if not proc.drain():
+                    proc.killed = EXIT_OUTPUT_LIMIT
+                finished[proc.pid] = proc
+                continue
+            chunk = os.read(key.fd, 65536)
+            if not chunk:
+                finished[proc.pid] = proc
+            elif not proc.append(chunk):
+                kill_process_group(proc.pid)
+                proc.killed = EXIT_OUTPUT_LIMIT
+                finished[proc.pid] = proc
+        # 書き込みを続けるケースではselectがタイムアウトしないので、毎回期限を確認する
+        now = time.monotonic()
+        for proc in running.values():
+            if proc.pid not in finished and proc.deadline is not None and proc.deadline <= now:
+                kill_process_group(proc.pid)
+                proc.killed = EXIT_TIME_LIMIT
+                finished[proc.pid] = proc
+        for proc in finished.values():
+            del running[proc.pid]
+            selector.unregister(proc.read_fd)
+            selector.unregister(proc.pidfd)
+            proc.close()
+            result = reap_case(proc.pid, b''.join(proc.parts), proc.killed, proc.started_at, limits)
+            if proc.case.get('expected_stdout') is not None:
+                result['passed'] = outputs_match(result['stdout'], proc.case['expected_stdout'])
+            if result['exit_code'] != 0 or result.get('passed') is False:
+                failed = True
+            completed += 1
+            emit_case(proc.index, result)
+    selector.close()
+    kill_descendants()
+    return len(cases) - completed
+
+def open_protocol_streams():
+    """
+    ジョブ受信・結果返却用のストリームを専用fdへ退避する。
+    ユーザーコードがfd 0/1を直接読み書きしても、プロトコルが壊れないようにする。
+    """
+    protocol_in = os.fdopen(os.dup(0), 'r', encoding='utf-8')
+    protocol_out = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+    PROTOCOL_FDS[:] = [protocol_in.fileno(), protocol_out.fileno()]
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(2, 1)
+    return protocol_in, protocol_out
+
+def harden_runner_process():
+    """
+    ランナー自身の設定（Linuxのみ。失敗しても続行する）。
+    - 子サブリーパーになり、親が先に終了したジョブの孫プロセスも自分の子として止めて回収できるようにする
+    - dumpableを外し、同じuidで動くユーザーコードから /proc/<pid>/fd 経由でプロトコル用fdを開けないようにする
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+        libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    except (OSError, AttributeError) as e:
+        print(f"Warning: prctl failed: {e}", file=sys.stderr)
+
+class ProtocolWriter:
+    """
+    フレームをプロトコル用のストリームへ1行ずつ書く。
+    フレームにはジョブのnonceと連番（seq）を付け、バックエンドはどちらかが合わないフレームを受け付けない。
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._nonce = None
+        self._seq = 0
+
+    def start_job(self, job: dict):
+        with self._lock:
+            self._nonce = job.get('nonce')
+            self._seq = 0
+
+    def send(self, frame: dict):
+        # stdout/stderrのflushが別スレッドから同時に来てもフレームが混ざらないようにする
+        with self._lock:
+            self._stream.write(json.dumps({**frame, 'nonce': self._nonce, 'seq': self._seq}) + '\n')
+            self._stream.flush()
+            self._seq += 1
+
+def serve():
+    """
+    標準入力が閉じられるまでジョブを読み、出力チャンクと結果フレームを返す。
+    ユーザーコードは親プロセスでは実行せず、単発ジョブもforkした子プロセスで実行する
+    （前のジョブが残したスレッドやbuiltinsへの変更が次のジョブに影響しない）。
+    """
+    protocol_in, protocol_out = open_protocol_streams()
+    harden_runner_process()
+    writer = ProtocolWriter(protocol_out)
+    send = writer.send
+
+    def emit(stream, data):
+        send({'type': stream, 'data': data})
+
+    for line in protocol_in:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            code = job['code']
+            stdin_data = job.get('stdin') or ''
+            limits = job.get('limits') or {}
+        except Exception:
+            print(f"Error: Invalid job request: {line[:200]!r}", file=sys.stderr)
             sys.exit(1)
 
-        # コード実行
-        stdout_result, stderr_result, exit_code_result, time_result = \
-            execute_code_in_memory(job.code, job.stdin or '')
-
-        # 結果をDBに保存
-        job.result_stdout = stdout_result
-        job.result_stderr = stderr_result
-        job.result_exit_code = exit_code_result
-        job.result_time = time_result
-        job.status = JOB_STATUS_DONE if exit_code_result == 0 else JOB_STATUS_ERROR
-
-        db.commit()
-
-    except SQLAlchemyError as e:
-        print(f"Error: Database error while processing job {job_id}: {e}", file=sys.stderr)
-        if db:
-            db.rollback()
-        sys.exit(1)
-    except Exception as e:
-        print(f"Error: An unexpected error occurred while processing job {job_id}: {e}", file=sys.stderr)
-        if db:
-            db.rollback()
-        sys.exit(1)
-    finally:
-        if db:
-            db.close()
+        writer.start_job(job)
+        if 'cases' in job:
+            start_time = time.time()
+            skipped = execute_cases(
+                code, job['cases'], int(job.get('parallel') or 1), bool(job.get('stop_on_failure')), limits,
+                lambda index, result: send({'type': 'case_result', 'index': index, **result}))
+            send({'type': 'result', 'exit_code': 0, 'time': time.time() - start_time, 'skipped': skipped})
+            continue
+
+        exit_code_result, time_result, usage = execute_forked(code, stdin_data, limits, emit)
+        send({'type': 'result', 'exit_code': exit_code_result, 'time': time_result, 'usage': usage})
+
+def main():
+    """スクリプトのメイン実行ロジック"""
+    parser = argparse.ArgumentParser(description='jobs are read from stdin as JSON lines')
+    # 互換のため --serve 引数も受け付ける（動作は同じ）
+    parser.add_argument('--serve', action='store_true')
+    parser.add_argument('--fork-server', action='store_true',
+                        help='import the --preload modules before forking job children')
+    parser.add_argument('--preload', default=','.join(DEFAULT_PRELOAD),
+                        help='comma-separated modules imported before forking (fork-server mode)')
+    args = parser.parse_args()
+    if args.fork_server:
+        preload_modules([name for name in args.preload.split(',') if name])
+    serve()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+コンパイル型言語（C/C++など）のランナー。プロトコルはrun.pyと同じ（標準入力から1行1ジョブのJSON、標準出力へ1行1フレームのJSON）。
+
+ジョブには次のどちらかを含める。
+- "build": {"source": "main.c", "command": ["gcc", ...], "artifact": "main", "limits": {...}}
+  ソースを書き出してコンパイルし、{"type": "compile", "exit_code": ..., "time": ..., "output": ..., "artifact": ...}
+  を返してから実行する。artifactはコンパイル済みの実行ファイル（base64、成功時のみ）。
+  コンパイルに失敗した場合は実行せず、exit_code=1の結果を返す（コンパイラの出力はoutput）。
+- "binary": コンパイル済みの実行ファイル（base64、バックエンドのキャッシュから）。コンパイルせずに実行する。
+"run" は実行するコマンド（作業ディレクトリからの相対、例: ["./main"]）。
+実行中の出力・結果フレームはrun.pyと同じで、"limits" の wall・stdout / stderr と rlimit（cpu・as・nofile・fsize）を適用する。
+バッチジョブ（"cases"）ではコンパイル（またはbinaryの書き出し）を1回だけ行い、ケースごとに実行ファイルを
+専用の作業ディレクトリへ複製してプロセスを起動する（前のケースや並列に動くケースが書いたファイルは見えない）。
+ジョブ（コンパイルを含む）の各プロセスは終了後にプロセスグループごと止め、グループから抜けた子孫プロセスも
+ジョブの終了時に止める。コンパイル結果はジョブのプロセスが何も動いていない状態で読み出す。
+"""
+import argparse
+import base64
+import codecs
+import json
+import os
+import select
+import selectors
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from run import (EXIT_OUTPUT_LIMIT, EXIT_TIME_LIMIT, WATCHDOG_GRACE, ProtocolWriter, apply_rlimits,
+                 harden_runner_process, kill_descendants, kill_process_group, killed_by_time_limit,
+                 open_protocol_streams, outputs_match, signal_exit_code)
+
+# ジョブごとの作業ディレクトリを作る場所（なければ一時ディレクトリ）
+WORK_ROOT = os.environ.get('RUNNER_WORKDIR', '/home/runner/tmp')
+# コンパイラの出力としてバックエンドへ返す最大バイト数
+MAX_COMPILE_OUTPUT = 65536
+# 子プロセスの終了後、パイプに残った出力を読み切るまで待つ最大秒数
+# （グループから抜けた子孫がパイプを開いたままならそこで打ち切り、子孫はジョブの終了時に止める）
+EXIT_DRAIN_SECONDS = 0.5
+
+
+def make_workdir():
+    return tempfile.mkdtemp(prefix='job-', dir=WORK_ROOT if os.path.isdir(WORK_ROOT) else None)
+
+
+def feed_stdin(pipe, data):
+    # 読まれない標準入力で止まらないよう、別スレッドで書き込む
+    try:
+        pipe.write(data)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def execute_process(command, workdir, stdin_data, limits, emit):
+    """
+    コマンドを子プロセスで実行し、標準出力・標準エラー出力をemit(stream, data)へ逐次送出する。
+    limitsの wall（秒）を過ぎるか stdout / stderr（バイト）を超えたらSIGKILLする（exit_code=1001 / 1002）。
+    子プロセスにはlimitsのrlimitを設定する。終了コード・実行時間・リソース使用量を返す。
+    終了後は子プロセスが起動したプロセスも残さないよう、プロセスグループごとSIGKILLする。
+    """
+    limits = limits or {}
+    start_time = time.time()
+    proc = subprocess.Popen(command, cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, preexec_fn=lambda: apply_rlimits(limits),
+                            start_new_session=True)
+    threading.Thread(target=feed_stdin, args=(proc.stdin, stdin_data.encode('utf-8')), daemon=True).start()
+    streams = {proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+    decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in streams.values()}
+    written = {'stdout': 0, 'stderr': 0}
+    selector = selectors.DefaultSelector()
+    for fd in streams:
+        selector.register(fd, selectors.EVENT_READ)
+    # 子プロセスの終了も待ち受ける（setsidした子孫が出力を開いたままでもEOFを待ち続けない）
+    pidfd = os.pidfd_open(proc.pid)
+    selector.register(pidfd, selectors.EVENT_READ)
+    deadline = time.monotonic() + limits['wall'] + WATCHDOG_GRACE if limits.get('wall') else None
+    drain_deadline = None
+    killed = None
+    while any(fd in streams for fd in selector.get_map()):
+        # 出力し続けるプログラムではselectがタイムアウトしないので、毎回期限を確認する
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            killed = EXIT_TIME_LIMIT
+            break
+        if drain_deadline is not None and now >= drain_deadline:
+            break
+        timeout = min((d for d in (deadline, drain_deadline) if d is not None), default=None)
+        events = selector.select(None if timeout is None else max(0.0, timeout - now))
+        for key, _ in events:
+            if key.fd == pidfd:
+                # 終了したらグループに残ったプロセスを止め、パイプに残った出力だけを読み切る
+                selector.unregister(pidfd)
+                kill_process_group(proc.pid)
+                drain_deadline = time.monotonic() + EXIT_DRAIN_SECONDS
+                continue
+            name = streams[key.fd]
+            chunk = os.read(key.fd, 65536)
+            if not chunk:
+                selector.unregister(key.fd)
+                continue
+            limit = limits.get(name)
+            if limit is not None and written[name] + len(chunk) > limit:
+                chunk = chunk[:max(limit - written[name], 0)]
+                killed = EXIT_OUTPUT_LIMIT
+            written[name] += len(chunk)
+            data = decoders[name].decode(chunk)
+            if data:
+                emit(name, data)
+        if killed is not None:
+            break
+    if killed is None and drain_deadline is None:
+        # 標準出力・標準エラー出力を閉じた後も動き続ける場合も、期限まで待って止める
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not select.select([pidfd], [], [], timeout)[0]:
+            killed = EXIT_TIME_LIMIT
+    kill_process_group(proc.pid)
+    selector.close()
+    os.close(pidfd)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    proc.stdout.close()
+    proc.stderr.close()
+    wall_time = time.time() - start_time
+    for name, decoder in decoders.items():
+        rest = decoder.decode(b'', final=True)
+        if rest:
+            emit(name, rest)
+    if killed is not None:
+        exit_code = killed
+    elif killed_by_time_limit(status):
+        exit_code = EXIT_TIME_LIMIT
+    else:
+        exit_code = signal_exit_code(status)
+        if os.WIFSIGNALED(status):
+            emit('stderr', f"\nKilled by signal {signal.Signals(os.WTERMSIG(status)).name}\n")
+    usage = {
+        'wall_time': wall_time,
+        'cpu_user': rusage.ru_utime,
+        'cpu_sys': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'stdout_bytes': written['stdout'],
+        'stderr_bytes': written['stderr'],
+    }
+    return exit_code, wall_time, usage
+
+
+def compile_source(build, code, workdir):
+    """
+    ソースを書き出してコンパイルし、compileフレームを返す（成功時は実行ファイルをbase64で含める）。
+    コンパイラの出力（標準出力・標準エラー出力をまとめたもの）はMAX_COMPILE_OUTPUTまで
+    """
+    with open(os.path.join(workdir, build['source']), 'w', encoding='utf-8') as f:
+        f.write(code)
+    output = []
+    limits = {'stdout': MAX_COMPILE_OUTPUT, 'stderr': MAX_COMPILE_OUTPUT, **(build.get('limits') or {})}
+    exit_code, elapsed, _ = execute_process(build['command'], workdir, '', limits,
+                                            lambda stream, data: output.append(data))
+    # 成果物を読む前に、コンパイラが残したプロセスも止める
+    kill_descendants()
+    output = ''.join(output)[:MAX_COMPILE_OUTPUT]
+    if exit_code == EXIT_TIME_LIMIT:
+        output += '\nCompile time limit exceeded\n'
+    frame = {'type': 'compile', 'exit_code': exit_code, 'time': elapsed, 'output': output}
+    artifact = os.path.join(workdir, build['artifact'])
+    if exit_code == 0 and os.path.isfile(artifact):
+        with open(artifact, 'rb') as f:
+            frame['artifact'] = base64.b64encode(f.read()).decode('ascii')
+    elif exit_code == 0:
+        frame.update(exit_code=1, output=output + f"\n{build['artifact']}: not produced by the compiler\n")
+    return frame
+
+
+def write_binary(binary, run_command, workdir):
+    # キャッシュから受け取った実行ファイルを作業ディレクトリに置く
+    path = os.path.join(workdir, os.path.basename(run_command[0]))
+    with open(path, 'wb') as f:
+        f.write(base64.b64decode(binary))
+    os.chmod(path, 0o755)
+
+
+def copy_binary(run_command, workdir, case_dir):
+    # ケース用の作業ディレクトリへ実行ファイルを複製する
+    path = os.path.join(case_dir, os.path.basename(run_command[0]))
+    shutil.copyfile(os.path.join(workdir, run_command[0]), path)
+    os.chmod(path, 0o755)
+
+
+def run_case(command, workdir, stdin_data, limits):
+    collected = {'stdout': [], 'stderr': []}
+    case_dir = make_workdir()
+    try:
+        copy_binary(command, workdir, case_dir)
+        exit_code, elapsed, usage = execute_process(
+            command, case_dir, stdin_data, limits, lambda stream, data: collected[stream].append(data))
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+    return {
+        'stdout': ''.join(collected['stdout']),
+        'stderr': ''.join(collected['stderr']),
+        'exit_code': exit_code,
+        'time': elapsed,
+        'usage': usage,
+    }
+
+
+def execute_cases(command, workdir, cases, parallel, stop_on_failure, limits, emit_case):
+    """
+    ケースごとにプロセスを起動して実行し、完了順にemit_caseする（同時実行数はparallelまで）。
+    stop_on_failureなら最初の失敗以降は新しいケースを始めない。実行しなかったケース数を返す。
+    """
+    failed = threading.Event()
+    completed = [0]
+    lock = threading.Lock()
+
+    def run_one(index, case):
+        if stop_on_failure and failed.is_set():
+            return
+        result = run_case(command, workdir, case.get('stdin') or '', limits)
+        if case.get('expected_stdout') is not None:
+            result['passed'] = outputs_match(result['stdout'], case['expected_stdout'])
+        if result['exit_code'] != 0 or result.get('passed') is False:
+            failed.set()
+        with lock:
+            completed[0] += 1
+        emit_case(index, result)
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        for index, case in enumerate(cases):
+            executor.submit(run_one, index, case)
+    return len(cases) - completed[0]
+
+
+def serve():
+    protocol_in, protocol_out = open_protocol_streams()
+    harden_runner_process()
+    writer = ProtocolWriter(protocol_out)
+    send = writer.send
+
+    def emit(stream, data):
+        send({'type': stream, 'data': data})
+
+    for line in protocol_in:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            code = job['code']
+            run_command = job['run']
+            limits = job.get('limits') or {}
+        except Exception:
+            print(f"Error: Invalid job request: {line[:200]!r}", file=sys.stderr)
+            sys.exit(1)
+
+        writer.start_job(job)
+        start_time = time.time()
+        workdir = make_workdir()
+        try:
+            if job.get('binary'):
+                write_binary(job['binary'], run_command, workdir)
+            else:
+                frame = compile_source(job['build'], code, workdir)
+                send(frame)
+            if not job.get('binary') and frame['exit_code'] != 0:
+                result = {'type': 'result', 'exit_code': 1, 'time': 0}
+                if 'cases' in job:
+                    result['skipped'] = len(job['cases'])
+            elif 'cases' in job:
+                skipped = execute_cases(
+                    run_command, workdir, job['cases'], int(job.get('parallel') or 1),
+                    bool(job.get('stop_on_failure')), limits,
+                    lambda index, result: send({'type': 'case_result', 'index': index, **result}))
+                result = {'type': 'result', 'exit_code': 0, 'time': time.time() - start_time, 'skipped': skipped}
+            else:
+                exit_code, elapsed, usage = execute_process(run_command, workdir, job.get('stdin') or '', limits, emit)
+                result = {'type': 'result', 'exit_code': exit_code, 'time': elapsed, 'usage': usage}
+        finally:
+            # setsidなどでプロセスグループから抜けたプロセスも、結果を返す前に止める
+            kill_descendants()
+            shutil.rmtree(workdir, ignore_errors=True)
+        send(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='jobs are read from stdin as JSON lines')
+    # run.pyと同じ引数で起動できるようにする（動作は同じ）
+    parser.add_argument('--serve', action='store_true')
+    parser.parse_args()
+    serve()
+
+
+if __name__ == "__main__":
+    main()